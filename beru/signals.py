@@ -5,7 +5,8 @@ from django.dispatch import receiver
 
 from sewingworld.tasks import PRIORITY_IDLE
 
-from shop.models import Product, ProductIntegration, Order
+from shop.models import Product, ProductIntegration, Integration, Order
+from shop.models.availability import availability_changed
 
 from .tasks import notify_beru_order_status
 
@@ -28,6 +29,14 @@ def product_saved(sender, **kwargs):
             except:
                 pass
 
+
+@receiver(availability_changed, dispatch_uid='availability_changed_beru_receiver')
+def availability_changed_beru(sender, product_ids, **kwargs):
+    integrations = [integration.pk for integration in Integration.objects.filter(settings__has_key='ym_campaign')
+                    if integration.settings.get('warehouse_id', '') != '']
+    ProductIntegration.objects.filter(product_id__in=product_ids, integration_id__in=integrations).update(notify_stock=True)
+
+
 @receiver(post_save, sender=Order, dispatch_uid='order_saved_beru_receiver')
 def order_saved(sender, **kwargs):
     order = kwargs['instance']
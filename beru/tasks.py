@@ -2,17 +2,16 @@ import json
 import logging
 from datetime import datetime
 from itertools import batched
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError
 
 import django.db
 from django.db.models import Sum, F, Q
 
 from celery import shared_task
 
+from sewingworld.integration_client import IntegrationClient, ResponseError
 from sewingworld.tasks import PRIORITY_IDLE
 
-from shop.models import Integration, Order, Product, ProductIntegration
+from shop.models import Integration, Order, Product, ProductAvailability, ProductIntegration
 
 
 logger = logging.getLogger('beru')
@@ -22,6 +21,14 @@ class TaskFailure(Exception):
     pass
 
 
+def get_client(integration):
+    headers = {
+        'Api-Key': integration.settings.get('api_key', ''),
+        'Content-Type': 'application/json; charset=utf-8'
+    }
+    return IntegrationClient('beru', account=integration.utm_source, base_url='https://api.partner.market.yandex.ru', headers=headers)
+
+
 @shared_task(bind=True, autoretry_for=(OSError, django.db.Error, json.decoder.JSONDecodeError), retry_backoff=3, retry_jitter=False)
 def notify_beru_order_status(self, order_id, status, substatus):
     order = Order.objects.get(id=order_id)
@@ -34,7 +41,7 @@ def notify_beru_order_status(self, order_id, status, substatus):
         return '{}: {} {} (already set)'.format(order_id, status, substatus)
 
     campaign_id = order.integration.settings.get('ym_campaign', '')
-    api_key = order.integration.settings.get('api_key', '')
+    client = get_client(order.integration)
 
     beru_order_id = str(beru_order.get('id', 0))
     if status == 'PROCESSING' and substatus == 'READY_TO_SHIP':
@@ -54,18 +61,10 @@ def notify_beru_order_status(self, order_id, status, substatus):
                 'items': items
             })
         data = {'boxes': boxes, 'allowRemove': False}
-        data_encoded = json.dumps(data).encode('utf-8')
-        url = 'https://api.partner.market.yandex.ru/campaigns/{campaignId}/orders/{orderId}/boxes'.format(campaignId=campaign_id, orderId=beru_order_id)
-        headers = {
-            'Api-Key': api_key,
-            'Content-Type': 'application/json; charset=utf-8'
-        }
-        request = Request(url, data_encoded, headers, method='PUT')
-        logger.info('<<< ' + request.full_url)
-        logger.info(data_encoded)
+        url = '/campaigns/{campaignId}/orders/{orderId}/boxes'.format(campaignId=campaign_id, orderId=beru_order_id)
         try:
-            response = urlopen(request)
-            result = json.loads(response.read().decode('utf-8'))
+            response = client.put(url, data)
+            result = response.json()
             boxes_status = result.get('status', 'ERROR')
             if boxes_status != 'OK':
                 message = result.get('errors', [{}])[0].get('message', None)
@@ -77,11 +76,10 @@ def notify_beru_order_status(self, order_id, status, substatus):
                         order.delivery_info = message
                     order.save()
                 raise self.retry(countdown=60 * 10, max_retries=12)  # 10 minutes
-        except HTTPError as e:
-            content = e.read()
+        except ResponseError as e:
+            content = e.content
             logger.error(content)
-            error = json.loads(content.decode('utf-8'))
-            message = error.get('errors', [{}])[0].get('message', 'Неизвестная ошибка взаимодействия с Беру!')
+            message = e.message('Неизвестная ошибка взаимодействия с Беру!', 'errors', 0, 'message')
             order.status = Order.STATUS_PROBLEM
             if order.delivery_info:
                 order.delivery_info = '\n'.join([order.delivery_info, message])
@@ -91,32 +89,23 @@ def notify_beru_order_status(self, order_id, status, substatus):
             raise self.retry(countdown=60 * 10, max_retries=12, exc=Exception(content))  # 10 minutes
 
     data = {"order": {"status": status, "substatus": substatus}}
-    data_encoded = json.dumps(data).encode('utf-8')
 
-    url = 'https://api.partner.market.yandex.ru/v2/campaigns/{campaignId}/orders/{orderId}/status.json'.format(campaignId=campaign_id, orderId=beru_order_id)
-    headers = {
-        'Api-Key': api_key,
-        'Content-Type': 'application/json; charset=utf-8'
-    }
-    request = Request(url, data_encoded, headers, method='PUT')
-    logger.info('<<< ' + request.full_url)
-    logger.info(data_encoded)
+    url = '/v2/campaigns/{campaignId}/orders/{orderId}/status.json'.format(campaignId=campaign_id, orderId=beru_order_id)
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = client.put(url, data)
+        result = response.json()
         beru_order = result.get('order', {})
         order_id = str(beru_order.get('id', 0))
         status = beru_order.get('status', 'PROCESSING')
         substatus = beru_order.get('substatus', '')
         return '{}: {} {}'.format(order_id, status, substatus)
-    except HTTPError as e:
-        content = e.read()
+    except ResponseError as e:
+        content = e.content
         logger.error(content)
         """
         {"error":{"code":400,"message":"status update is not allowed if there are items unassigned to boxes"},"errors":[{"code":"BAD_REQUEST","message":"status update is not allowed if there are items unassigned to boxes"}],"status":"ERROR"}
         """
-        error = json.loads(content.decode('utf-8'))
-        message = error.get('errors', [{}])[0].get('message', 'Неизвестная ошибка взаимодействия с Беру!')
+        message = e.message('Неизвестная ошибка взаимодействия с Беру!', 'errors', 0, 'message')
         order.status = Order.STATUS_PROBLEM
         if order.delivery_info:
             order.delivery_info = '\n'.join([order.delivery_info, message])
@@ -133,24 +122,16 @@ def get_beru_order_details(order_id):
         raise TaskFailure('Order {} does not have beru order number'.format(order_id))
 
     campaign_id = order.integration.settings.get('ym_campaign', '')
-    api_key = order.integration.settings.get('api_key', '')
 
-    url = 'https://api.partner.market.yandex.ru/v2/campaigns/{campaignId}/orders/{orderId}.json'.format(campaignId=campaign_id, orderId=beru_order)
-    headers = {
-        'Api-Key': api_key,
-    }
-    request = Request(url, None, headers)
-    logger.info('<<< ' + request.full_url)
+    url = '/v2/campaigns/{campaignId}/orders/{orderId}.json'.format(campaignId=campaign_id, orderId=beru_order)
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client(order.integration).get(url)
+        result = response.json()
         logger.debug(result)
         return result.get('order', {})
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
-        logger.error(error)
-        message = error.get('errors', [{}])[0].get('message', 'Неизвестная ошибка взаимодействия с Беру!')
+    except ResponseError as e:
+        logger.error(e.content)
+        message = e.message('Неизвестная ошибка взаимодействия с Беру!', 'errors', 0, 'message')
         raise TaskFailure(message) from e
 
 
@@ -161,24 +142,16 @@ def get_beru_labels_data(order_id):
         raise TaskFailure('Order {} does not have beru order number'.format(order_id))
 
     campaign_id = order.integration.settings.get('ym_campaign', '')
-    api_key = order.integration.settings.get('api_key', '')
 
-    url = 'https://api.partner.market.yandex.ru/v2/campaigns/{campaignId}/orders/{orderId}/delivery/labels/data.json'.format(campaignId=campaign_id, orderId=beru_order)
-    headers = {
-        'Api-Key': api_key,
-    }
-    request = Request(url, None, headers)
-    logger.info('<<< ' + request.full_url)
+    url = '/v2/campaigns/{campaignId}/orders/{orderId}/delivery/labels/data.json'.format(campaignId=campaign_id, orderId=beru_order)
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client(order.integration).get(url)
+        result = response.json()
         logger.debug(result)
         return result.get('result', {})
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
-        logger.error(error)
-        message = error.get('errors', [{}])[0].get('message', 'Неизвестная ошибка взаимодействия с Беру!')
+    except ResponseError as e:
+        logger.error(e.content)
+        message = e.message('Неизвестная ошибка взаимодействия с Беру!', 'errors', 0, 'message')
         raise TaskFailure(message) from e
 
 
@@ -187,37 +160,28 @@ def notify_beru_product_stocks(self, products, account):
     integration = Integration.objects.get(utm_source=account)
 
     campaign_id = integration.settings.get('ym_campaign', '')
-    api_key = integration.settings.get('api_key', '')
 
-    url = 'https://api.partner.market.yandex.ru/campaigns/{campaignId}/offers/stocks'.format(campaignId=campaign_id)
-    headers = {
-        'Api-Key': api_key,
-        'Content-Type': 'application/json'
-    }
+    url = '/campaigns/{campaignId}/offers/stocks'.format(campaignId=campaign_id)
 
     updatedAt = datetime.utcnow().replace(microsecond=0).isoformat() + '+00:00'
     skus = []
 
-    products = Product.objects.filter(pk__in=products)
+    products = ProductAvailability.objects.annotate_products(Product.objects.filter(pk__in=products), integration=integration)
     for product in products:
         skus.append({
             'sku': product.article,
             'items': [
                 {
-                    'count': max(0, min(20, int(product.get_stock(integration=integration)))),
+                    'count': max(0, min(20, int(product.available))),
                     'updatedAt': updatedAt
                 }
             ]
         })
 
     data = {'skus': skus}
-    data_encoded = json.dumps(data).encode('utf-8')
-    request = Request(url, data_encoded, headers, method='PUT')
-    logger.info('<<< ' + request.full_url)
-    logger.info(data_encoded)
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client(integration).put(url, data)
+        result = response.json()
 
         for product in products:
             product_integration = ProductIntegration.objects.order_by().filter(product=product, integration=integration).first()
@@ -226,11 +190,9 @@ def notify_beru_product_stocks(self, products, account):
                 product_integration.save()
 
         return result
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
-        logger.error(error)
-        message = error.get('errors', [{}])[0].get('message', 'Неизвестная ошибка взаимодействия с Беру!')
+    except ResponseError as e:
+        logger.error(e.content)
+        message = e.message('Неизвестная ошибка взаимодействия с Беру!', 'errors', 0, 'message')
         raise TaskFailure(message) from e
 
 
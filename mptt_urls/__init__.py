@@ -5,7 +5,7 @@ def _load(module):
     return import_string(module) if isinstance(module, str) else module
 
 class view():
-    def __init__(self, model, view, slug_field, root=None):
+    def __init__(self, model, view, slug_field, root=None, resolver=None):
         def get_path(instance):
             path = '/'.join([getattr(item, slug_field) for item in instance.get_ancestors(include_self=True)]) + '/'
             if len(root) and path.startswith(root):
@@ -16,6 +16,8 @@ class view():
         self.view = _load(view)
         self.slug_field = slug_field
         self.root = root
+        # optional callable returning instance for path, e.g. backed by cached tree, slug candidates are queried otherwise
+        self.resolver = _load(resolver) if resolver is not None else None
 
         # define 'get_path' method for model
         self.model.get_path = get_path
@@ -32,7 +34,9 @@ class view():
         except IndexError:
             instance_slug = None
 
-        if instance_slug:
+        if instance_slug and self.resolver is not None:
+            instance = self.resolver(path)
+        elif instance_slug:
             candidates = self.model.objects.filter(**{self.slug_field: instance_slug})  # candidates to be the instance
             for candidate in candidates:
                 # here we compare each candidate's path to the path passed to this view
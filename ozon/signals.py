@@ -5,6 +5,7 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 from shop.models import Product, ProductIntegration, Integration
+from shop.models.availability import availability_changed
 
 
 logger = logging.getLogger('ozon')
@@ -24,3 +25,8 @@ def product_saved(sender, **kwargs):
             product_integration.save()
         except:
             pass
+
+
+@receiver(availability_changed, dispatch_uid='availability_changed_ozon_receiver')
+def availability_changed_ozon(sender, product_ids, **kwargs):
+    ProductIntegration.objects.filter(product_id__in=product_ids, integration__site=SITE_OZON).update(notify_stock=True)
@@ -1,43 +1,44 @@
 import json
 import logging
 from datetime import datetime, timedelta
-from importlib import import_module
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError
 
 from decimal import Decimal
 
 import django.db
-from django.conf import settings
-from django.contrib import auth
 from django.contrib.sites.models import Site
 from django.utils import timezone
 
 from celery import shared_task
 
+from sewingworld.integration_client import IntegrationClient, ResponseError, fan_out, get_user_session
 from sewingworld.tasks import PRIORITY_IDLE
 
-from shop.models import Integration, Basket, Order, Product, ProductIntegration, ShopUser
+from shop.models import Integration, Basket, Order, Product, ProductAvailability, ProductIntegration, ShopUser
 
 logger = logging.getLogger('ozon')
 SITE_OZON = Site.objects.get(domain='ozon.ru')
 
+OZON_STOCKS_BATCH_SIZE = 100  # maximum number of stocks in one request
+OZON_STOCKS_RATE = 80  # stocks requests per minute
+
+
 class TaskFailure(Exception):
     pass
 
 
+def get_client(integration, **kwargs):
+    headers = {
+        'Client-Id': integration.settings.get('client_id', ''),
+        'Api-Key': integration.settings.get('api_key', ''),
+        'Content-Type': 'application/json'
+    }
+    return IntegrationClient('ozon', account=integration.utm_source, base_url='https://api-seller.ozon.ru', headers=headers, **kwargs)
+
+
 @shared_task(bind=True, autoretry_for=(OSError, django.db.Error, json.decoder.JSONDecodeError), retry_backoff=300, retry_jitter=False)
 def get_integration_unfulfilled_orders(self, account):
     integration = Integration.objects.get(utm_source=account)
-    client_id = integration.settings.get('client_id', '')
-    api_key = integration.settings.get('api_key', '')
 
-    url = 'https://api-seller.ozon.ru/v3/posting/fbs/list'
-    headers = {
-        'Client-Id': client_id,
-        'Api-Key': api_key,
-        'Content-Type': 'application/json'
-    }
     now = timezone.now().replace(microsecond=0)
     week_ago = now - timedelta(days=7)
 
@@ -55,22 +56,12 @@ def get_integration_unfulfilled_orders(self, account):
             "financial_data": True
         }
     }
-    data_encoded = json.dumps(data).encode('utf-8')
-    request = Request(url, data_encoded, headers, method='POST')
-    logger.info('<<< ' + request.full_url)
-    logger.info(data_encoded)
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client(integration).post('/v3/posting/fbs/list', data)
+        result = response.json()
         num = 0
         user = ShopUser.objects.get(phone='0002')
-        SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
-        session = SessionStore()
-        session.cycle_key()
-        session[auth.SESSION_KEY] = user._meta.pk.value_to_string(user)
-        session[auth.BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
-        session[auth.HASH_SESSION_KEY] = user.get_session_auth_hash()
-        session.save()
+        session_key = get_user_session(user)
         for posting in result.get('result', {}).get('postings', []):
             logger.debug(posting)
             posting_number = posting.get('posting_number', '')
@@ -79,7 +70,7 @@ def get_integration_unfulfilled_orders(self, account):
 
             order = Order.objects.filter(delivery_tracking_number=posting_number).first()
             if order is None:
-                basket = Basket.objects.create(site=integration.site, session_id=session.session_key, utm_source=account, secondary=True)
+                basket = Basket.objects.create(site=integration.site, session_id=session_key, utm_source=account, secondary=True)
 
                 for ozon_item in posting.get('products', []):
                     try:
@@ -130,11 +121,9 @@ def get_integration_unfulfilled_orders(self, account):
             order.save()
             num = num + 1
         return num
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
-        logger.error(error)
-        message = error.get('message', 'Неизвестная ошибка взаимодействия с Ozon!')
+    except ResponseError as e:
+        logger.error(e.content)
+        message = e.message('Неизвестная ошибка взаимодействия с Ozon!', 'message')
         raise TaskFailure(message) from e
 
 
@@ -147,25 +136,20 @@ def get_unfulfilled_orders():
     return total
 
 
-@shared_task(bind=True, autoretry_for=(OSError, django.db.Error, json.decoder.JSONDecodeError), rate_limit='1/s', retry_backoff=300, retry_jitter=False)
+@shared_task(bind=True, autoretry_for=(OSError, django.db.Error, json.decoder.JSONDecodeError), retry_backoff=300, retry_jitter=False)
 def notify_product_stocks(self, products, account):
     integration = Integration.objects.get(utm_source=account)
-    client_id = integration.settings.get('client_id', '')
-    api_key = integration.settings.get('api_key', '')
-
-    url = 'https://api-seller.ozon.ru/v2/products/stocks'
-    headers = {
-        'Client-Id': client_id,
-        'Api-Key': api_key,
-        'Content-Type': 'application/json'
-    }
-
-    stocks = []
+    client = get_client(integration, rate=OZON_STOCKS_RATE, period=60, limit_key='ozon-stocks-' + account)
 
     products = Product.objects.filter(pk__in=products)
+    products = ProductAvailability.objects.annotate_products(products, integration=integration)
+    products = ProductAvailability.objects.annotate_products(products, integration=integration, express=True, name='express_available')
+
+    chunks = [([], [])]  # list of (product ids, stocks) of one request
     for product in products:
-        stock = max(0, min(20, int(product.get_stock(integration=integration))))
-        express_stock = max(0, min(20, int(product.get_stock(integration=integration, express=True))))
+        stock = max(0, min(20, int(product.available)))
+        express_stock = max(0, min(20, int(product.express_available)))
+        stocks = []
         for warehouse in integration.settings.get('warehouses', []):
             if warehouse.get('is_express', False):
                 warehouse_stock = express_stock
@@ -176,26 +160,19 @@ def notify_product_stocks(self, products, account):
                 "stock": warehouse_stock,
                 "warehouse_id": warehouse.get('id', 0)
             })
-        if len(stocks) > 99:
-            break
-    products = list(products)[:len(stocks)]
-
-    data = {'stocks': stocks}
-    data_encoded = json.dumps(data).encode('utf-8')
-    request = Request(url, data_encoded, headers, method='POST')
-    logger.info('<<< ' + request.full_url)
-    logger.info(data_encoded)
-    try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
-
-        for product in products:
-            product_integration = ProductIntegration.objects.order_by().filter(product=product, integration=integration).first()
-            if product_integration is not None:
-                product_integration.notify_stock = False
-                product_integration.save()
-
-        logger.debug(result)
+        if chunks[-1][1] and len(chunks[-1][1]) + len(stocks) > OZON_STOCKS_BATCH_SIZE:
+            chunks.append(([], []))
+        chunks[-1][0].append(product.pk)
+        chunks[-1][1].extend(stocks)
+
+    def send(chunk):
+        product_ids, stocks = chunk
+        try:
+            response = client.post('/v2/products/stocks', {'stocks': stocks})
+        except ResponseError as e:
+            logger.error(e.content)
+            return [], e
+        logger.debug(response.json())
         """
         {'result': [
             {'warehouse_id': 22936068942000, 'product_id': 0, 'offer_id': 'в92086', 'updated': False, 'errors': [
@@ -203,13 +180,21 @@ def notify_product_stocks(self, products, account):
             ]},
             {'warehouse_id': 22933327211000, 'product_id': 297361812, 'offer_id': 'в92086', 'updated': True, 'errors': []}]}
         """
-        return None
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
-        logger.error(error)
-        message = error.get('message', 'Неизвестная ошибка взаимодействия с Ozon!')
-        raise TaskFailure(message) from e
+        return product_ids, None
+
+    notified = []
+    errors = []
+    for product_ids, error in fan_out(send, [chunk for chunk in chunks if chunk[1]]):
+        notified.extend(product_ids)
+        if error is not None:
+            errors.append(error)
+
+    ProductIntegration.objects.filter(product_id__in=notified, integration=integration).update(notify_stock=False)
+
+    if errors:
+        message = errors[0].message('Неизвестная ошибка взаимодействия с Ozon!', 'message')
+        raise TaskFailure(message) from errors[0]
+    return len(notified)
 
 
 @shared_task(bind=True, autoretry_for=(OSError, django.db.Error, json.decoder.JSONDecodeError), retry_backoff=300, retry_jitter=False)
@@ -0,0 +1,52 @@
+from unittest import mock
+
+from django.contrib.sites.models import Site
+from django.test import TestCase
+
+from sewingworld.tests.fake_api import FakeAPI
+from shop.models import Integration, Product, ProductAvailability, ProductIntegration
+
+from ozon.tasks import OZON_STOCKS_BATCH_SIZE, notify_product_stocks
+
+
+@mock.patch('sewingworld.integration_client.throttle')
+class NotifyProductStocksTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        site = Site.objects.create(domain='test.ozon.ru', name='test ozon')
+        cls.integration = Integration.objects.create(name='Ozon', utm_source='test-ozon', site=site, output_template='ozon', settings={
+            'client_id': '1', 'api_key': 'key',
+            'warehouses': [{'id': 1}, {'id': 2}, {'id': 3, 'is_express': True}]
+        })
+        cls.products = Product.objects.bulk_create([Product(code='ozon{}'.format(num), title='product {}'.format(num), article='a{}'.format(num))
+                                                    for num in range(70)])
+        ProductAvailability.objects.bulk_create([ProductAvailability(product=product, integration=cls.integration, quantity=num % 30,
+                                                                     express_quantity=num % 2) for num, product in enumerate(cls.products)])
+        ProductIntegration.objects.bulk_create([ProductIntegration(product=product, integration=cls.integration, notify_stock=True)
+                                                for product in cls.products])
+
+    def test_stocks_are_split(self, throttle):
+        with FakeAPI('ozon').load('ozon_stocks') as api:
+            result = notify_product_stocks([product.pk for product in self.products], self.integration.utm_source)
+
+        requests = api.sent('POST', '/v2/products/stocks')
+        self.assertEqual(result, 70)
+        self.assertTrue(all(len(data['stocks']) <= OZON_STOCKS_BATCH_SIZE for data in requests))
+        self.assertEqual([len(data['stocks']) for data in requests], [99, 99, 12])  # stocks of a product are not split
+        stocks = {(stock['offer_id'], stock['warehouse_id']): stock['stock'] for data in requests for stock in data['stocks']}
+        self.assertEqual(len(stocks), 210)
+        self.assertEqual(stocks[('a25', 1)], 20)  # stock is limited
+        self.assertEqual(stocks[('a25', 3)], 1)  # express stock
+        self.assertFalse(ProductIntegration.objects.filter(integration=self.integration, notify_stock=True).exists())
+
+    def test_failed_chunk_is_not_marked(self, throttle):
+        with FakeAPI('ozon') as api:
+            api.add('POST', '/v2/products/stocks', 200, {'result': []})
+            api.add('POST', '/v2/products/stocks', 400, {'code': 3, 'message': 'INVALID_ARGUMENT', 'details': []})
+            api.add('POST', '/v2/products/stocks', 200, {'result': []})
+            with mock.patch('ozon.tasks.fan_out', lambda func, items: [func(item) for item in items]):  # keeps order of responses
+                with self.assertRaisesMessage(Exception, 'INVALID_ARGUMENT'):
+                    notify_product_stocks([product.pk for product in self.products], self.integration.utm_source)
+
+        self.assertEqual(len(api.requests), 3)
+        self.assertEqual(ProductIntegration.objects.filter(integration=self.integration, notify_stock=True).count(), 33)
@@ -2,8 +2,6 @@ import json
 import logging
 
 from hashlib import sha1
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError
 
 import django.db
 from django.conf import settings
@@ -11,6 +9,8 @@ from django.utils import timezone
 
 from celery import shared_task
 
+from sewingworld.integration_client import IntegrationClient, ResponseError, get_token as get_cached_token, invalidate_token
+
 from shop.models import ShopUser, Bonus
 
 
@@ -24,43 +24,47 @@ class TaskFailure(Exception):
     pass
 
 
-def get_token():
+def get_client(headers=None):
+    return IntegrationClient('rarus', base_url=HOST, headers=dict({'Content-Type': 'application/json;charset=UTF-8'}, **(headers or {})))
+
+
+def sign_in():
     data = {
         'login': RARUS.get('login', ''),
         'password': sha1(RARUS.get('password', '').encode()).hexdigest(),
         'role': 'organization'
     }
-    data_encoded = json.dumps(data).encode('utf-8')
-    url = '{}/sign_in'.format(HOST)
-    headers = {
-        'Content-Type': 'application/json;charset=UTF-8'
-    }
-
-    request = Request(url, data_encoded, headers, method='POST')
-    logger.info('<<< ' + request.full_url)
-    response = urlopen(request)
-    result = json.loads(response.read().decode('utf-8'))
+    response = get_client().post('/sign_in', data, log_data=False)
+    result = response.json()
     logger.debug(result)
-    return result.get('token', '')
+    if not result.get('token'):
+        raise TaskFailure(result)
+    return result['token']
 
 
-def get_cards():
-    url = '{}/organization/card'.format(HOST)
-    headers = {
-        'Token': get_token(),
-        'Content-Type': 'application/json;charset=UTF-8'
-    }
+def get_token():
+    return get_cached_token('rarus-' + RARUS.get('login', ''), sign_in)
+
+
+def request_with_token(url, **kwargs):
+    """ Sends GET request with cached token, token is renewed once if it is rejected """
+    try:
+        return get_client({'Token': get_token()}).get(url, **kwargs)
+    except ResponseError as e:
+        if e.code != 401:
+            raise
+        invalidate_token('rarus-' + RARUS.get('login', ''))
+        return get_client({'Token': get_token()}).get(url, **kwargs)
 
-    request = Request(url, None, headers)
-    logger.info('<<< ' + request.full_url)
+
+def get_cards():
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = request_with_token('/organization/card')
+        result = response.json()
         print(result)
         logger.debug(result)
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
+    except ResponseError as e:
+        error = e.json()
         logger.error(error)
         raise TaskFailure(error) from e
 
@@ -72,19 +76,11 @@ def get_bonus_value(phone):
         user.bonus = Bonus()
     user.bonus.updated = timezone.now()
 
-    url = '{}/organization/card/by_phone?filter={}'.format(HOST, phone[1:])  # remove '+' from phone number
-    headers = {
-        'Token': get_token(),
-        'Content-Type': 'application/json;charset=UTF-8'
-    }
-
-    request = Request(url, None, headers)
-    logger.info('<<< ' + request.full_url)
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = request_with_token('/organization/card/by_phone', params={'filter': phone[1:]})  # remove '+' from phone number
+        result = response.json()
         logger.debug(result)
-    except HTTPError as e:
+    except ResponseError as e:
         if e.code == 404:
             user.bonus.value = 0
             user.bonus.status = Bonus.STATUS_OK
@@ -92,8 +88,7 @@ def get_bonus_value(phone):
             return
         user.bonus.status = Bonus.STATUS_UNDEFINED
         user.bonus.save()
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
+        error = e.json()
         logger.error(error)
         raise TaskFailure(error) from e
 
@@ -1,8 +1,6 @@
 import json
 import logging
 from datetime import datetime
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError
 
 import django.db
 
@@ -11,6 +9,8 @@ from django.utils import timezone
 
 from celery import shared_task
 
+from sewingworld.integration_client import IntegrationClient, ResponseError
+
 from shop.models import Order
 
 
@@ -23,6 +23,14 @@ class TaskFailure(Exception):
     pass
 
 
+def get_client():
+    headers = {
+        'Content-Type': 'application/json; charset=utf-8',
+        'User-Agent': 'Mozilla/5.0'  # грёбаный Сбер считает, что Python-urllib - это попытка взлома!
+    }
+    return IntegrationClient('sber', base_url=SBER_MARKET.get('api', ''), headers=headers)
+
+
 @shared_task(bind=True, autoretry_for=(OSError, django.db.Error, json.decoder.JSONDecodeError), retry_backoff=3, retry_jitter=False)
 def confirm_sber_order(self, order_id):
     order = Order.objects.get(id=order_id)
@@ -48,24 +56,13 @@ def confirm_sber_order(self, order_id):
         },
         'meta': {}
     }
-    data_encoded = json.dumps(data).encode('utf-8')
-    logger.info('>>> /order/confirm')
-    logger.info(data_encoded)
-
-    url = SBER_MARKET.get('api', '') + '/order/confirm'
-    headers = {
-        'Content-Type': 'application/json; charset=utf-8',
-        'User-Agent': 'Mozilla/5.0'  # грёбаный Сбер считает, что Python-urllib - это попытка взлома!
-    }
-    request = Request(url, data_encoded, headers, method='POST')
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client().post('/order/confirm', data)
+        result = response.json()
         status = result.get('data', {}).get('result', None)
         return '{}: {}'.format(order_id, status)
-    except HTTPError as e:
-        content = e.read()
-        error = content.decode('utf-8')
+    except ResponseError as e:
+        error = e.content.decode('utf-8')
         logger.error(error)
         order.status = Order.STATUS_PROBLEM
         if order.delivery_info:
@@ -104,24 +101,13 @@ def reject_sber_order(self, order_id):
         },
         'meta': {}
     }
-    data_encoded = json.dumps(data).encode('utf-8')
-    logger.info('>>> /order/reject')
-    logger.info(data_encoded)
-
-    url = SBER_MARKET.get('api', '') + '/order/reject'
-    headers = {
-        'Content-Type': 'application/json; charset=utf-8',
-        'User-Agent': 'Mozilla/5.0'  # грёбаный Сбер считает, что Python-urllib - это попытка взлома!
-    }
-    request = Request(url, data_encoded, headers, method='POST')
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client().post('/order/reject', data)
+        result = response.json()
         status = result.get('data', {}).get('result', None)
         return '{}: {}'.format(order_id, status)
-    except HTTPError as e:
-        content = e.read()
-        error = content.decode('utf-8')
+    except ResponseError as e:
+        error = e.content.decode('utf-8')
         logger.error(error)
         order.status = Order.STATUS_PROBLEM
         if order.delivery_info:
@@ -163,24 +149,13 @@ def notify_sber_order_packed(self, order_id):
         },
         'meta': {}
     }
-    data_encoded = json.dumps(data).encode('utf-8')
-    logger.info('>>> /order/packing')
-    logger.info(data_encoded)
-
-    url = SBER_MARKET.get('api', '') + '/order/packing'
-    headers = {
-        'Content-Type': 'application/json; charset=utf-8',
-        'User-Agent': 'Mozilla/5.0'  # грёбаный Сбер считает, что Python-urllib - это попытка взлома!
-    }
-    request = Request(url, data_encoded, headers, method='POST')
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client().post('/order/packing', data)
+        result = response.json()
         status = result.get('data', {}).get('result', None)
         return '{}: {}'.format(order_id, status)
-    except HTTPError as e:
-        content = e.read()
-        error = content.decode('utf-8')
+    except ResponseError as e:
+        error = e.content.decode('utf-8')
         logger.error(error)
         order.status = Order.STATUS_PROBLEM
         if order.delivery_info:
@@ -220,24 +195,13 @@ def notify_sber_order_shipped(self, order_id):
         },
         'meta': {}
     }
-    data_encoded = json.dumps(data).encode('utf-8')
-    logger.info('>>> /order/packing')
-    logger.info(data_encoded)
-
-    url = SBER_MARKET.get('api', '') + '/order/shipping'
-    headers = {
-        'Content-Type': 'application/json; charset=utf-8',
-        'User-Agent': 'Mozilla/5.0'  # грёбаный Сбер считает, что Python-urllib - это попытка взлома!
-    }
-    request = Request(url, data_encoded, headers, method='POST')
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client().post('/order/shipping', data)
+        result = response.json()
         status = result.get('data', {}).get('result', None)
         return '{}: {}'.format(order_id, status)
-    except HTTPError as e:
-        content = e.read()
-        error = content.decode('utf-8')
+    except ResponseError as e:
+        error = e.content.decode('utf-8')
         logger.error(error)
         order.status = Order.STATUS_PROBLEM
         if order.delivery_info:
@@ -262,19 +226,9 @@ def get_sber_order_details(self, order_id):
         },
         'meta': {}
     }
-    data_encoded = json.dumps(data).encode('utf-8')
-    logger.info('>>> /order/get')
-    logger.info(data_encoded)
-
-    url = SBER_MARKET.get('api', '') + '/order/get'
-    headers = {
-        'Content-Type': 'application/json; charset=utf-8',
-        'User-Agent': 'Mozilla/5.0'  # грёбаный Сбер считает, что Python-urllib - это попытка взлома!
-    }
-    request = Request(url, data_encoded, headers, method='POST')
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client().post('/order/get', data)
+        result = response.json()
         shipment = result.get('data', {}).get('shipments', [{}])[0]
         delivery_date = shipment.get('deliveryDate')
         delivery_method = shipment.get('deliveryMethodId')  # 'PICKUP', 'COURIER'
@@ -287,8 +241,7 @@ def get_sber_order_details(self, order_id):
         order.save()
         status = result.get('success', None)
         return '{}: {}'.format(order_id, status)
-    except HTTPError as e:
-        content = e.read()
-        error = content.decode('utf-8')
+    except ResponseError as e:
+        error = e.content.decode('utf-8')
         logger.error(error)
         raise self.retry(countdown=60 * 10, max_retries=12, exc=e)  # 10 minutes
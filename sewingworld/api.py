@@ -5,12 +5,14 @@ from django.conf import settings
 from django.contrib.auth import login, logout
 from django.contrib.postgres.search import SearchQuery, SearchRank
 from django.core.mail import mail_admins
-from django.db.models import Sum, F, Q, OuterRef, Subquery
-from django.http import HttpResponse, HttpResponseRedirect
+from django.db.models import F, Prefetch
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.utils.decorators import method_decorator
+from django.utils.http import http_date, quote_etag
 
 from rest_framework import views, viewsets, filters, status
 from rest_framework.authentication import SessionAuthentication, TokenAuthentication
@@ -19,6 +21,7 @@ from rest_framework.exceptions import MethodNotAllowed, NotAuthenticated, NotFou
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import BasePermission, IsAuthenticated, DjangoModelPermissions
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 from django.contrib.flatpages.models import FlatPage
 # from django_ipgeobase.models import IPGeoBase
@@ -31,9 +34,13 @@ from yandex_kassa.views import payment as yandex_payment
 # from rarus.tasks import get_bonus_value
 from shop.filters import get_product_filter
 from shop.models import Category, ProductKind, Product, ProductSet, Stock, Basket, BasketItem, Order, OrderItem, \
-    Favorites, ShopUser, Bonus, News, SalesAction, Advert, Store, ServiceCenter, Serial, Integration, ProductIntegration
+    Favorites, ShopUser, Bonus, News, SalesAction, Advert, Store, ServiceCenter, Serial, Integration, \
+    ProductAvailability
+from shop.models.basket import invalidate_user_discount
 from shop.tasks import send_password, notify_user_order_new_sms, notify_user_order_new_mail
 
+from .feeds import FEED_PAGE_SIZE, FEED_MAX_PAGE_SIZE, get_feed_version, get_feed_products, get_feed_snapshot, \
+    remember_feed_request, stream_feed
 from .models import SiteProfile
 from .serializers import CategoryTreeSerializer, CategorySerializer, ProductSerializer, ProductListSerializer, \
     ProductKindSerializer, ProductImagesSerializer, StockSerializer, \
@@ -42,6 +49,7 @@ from .serializers import CategoryTreeSerializer, CategorySerializer, ProductSeri
     UserListSerializer, UserSerializer, AnonymousUserSerializer, LoginSerializer, UserBonusSerializer, \
     FlatPageListSerializer, FlatPageSerializer, NewsSerializer, SalesActionSerializer, AdvertSerializer, \
     StoreSerializer, ServiceCenterSerializer, SiteProfileSerializer, IntegrationSerializer, IntegrationProductSerializer
+from .typeahead import get_typeahead_titles
 
 
 logger = logging.getLogger("django")
@@ -110,23 +118,10 @@ class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
 
         if not key.isdigit():
             root_category = self.request.site.profile.root_category
-            # instance select taken from mptt_urls
-            instance = None
-            path = key  # path = '{}/'.format(key)  # we add trailing slash to conform .get_path() from mptt_urls
-            try:
-                instance_slug = path.split('/')[-1]  # [-2]  # slug of the instance
-                candidates = Category.objects.filter(slug=instance_slug)  # candidates to be the instance
-                for candidate in candidates:
-                    # here we compare each candidate's path to the path passed to this view
-                    if candidate.get_api_path() == path:
-                        if root_category != candidate.get_root():
-                            continue
-                        instance = candidate
-                        break
-                if instance:
-                    self.kwargs[self.lookup_field] = instance.pk
-            except IndexError:
-                pass  # let DRF issue the error
+            instance = Category.objects.tree().get_by_path(key, root_category)
+            if instance:
+                self.kwargs[self.lookup_field] = instance.id
+            # otherwise let DRF issue the error
         return super().get_object()
 
 
@@ -171,11 +166,11 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
 
         for field, values in self.request.query_params.lists():
             if field == 'in_category':
+                tree = Category.objects.tree()
                 categories = []
                 for value in values:
-                    category = Category.objects.get(pk=value)
-                    categories.append(category)
-                    categories.extend(category.get_descendants().filter(active=True))
+                    categories.append(int(value))
+                    categories.extend(tree.get_descendant_ids(int(value), active=True))
                 queryset = queryset.filter(categories__in=categories)
                 continue
             base_field = field.split('__', 1)[0]
@@ -245,7 +240,7 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
                 key = '{}__exact'.format(field)
                 queryset = queryset.filter(**{key: values[0]})
 
-        return queryset.distinct()
+        return ProductAvailability.objects.annotate_products(queryset.distinct())
 
     def list(self, request, *args, **kwargs):
         response = super().list(request, *args, **kwargs)
@@ -261,6 +256,11 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
                     filters[field.name]['choices'] = field.field.choices
                 if field.field.widget.attrs:
                     filters[field.name]['attrs'] = field.field.widget.attrs
+                facet = self.product_filter.facets.get(field.name)
+                if isinstance(facet, list):
+                    filters[field.name]['counts'] = {pk: count for pk, _, count in facet}
+                elif facet is not None:
+                    filters[field.name]['facet'] = facet
             response.data['filters'] = filters
             # response.data['data'] = self.product_filter.data
         return response
@@ -269,6 +269,11 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
     def fields(self, request):
         return Response({f.name: f.verbose_name.capitalize() for f in Product._meta.get_fields() if hasattr(f, 'verbose_name')})
 
+    @action(detail=False)
+    def typeahead(self, request):
+        """ Lightweight replacement of ?text=...&ta= list, returns only product titles """
+        return Response(get_typeahead_titles(request.site, request.query_params.get('text', '')))
+
     @action(detail=True)
     def bycode(self, request, pk=None):
         product = self.get_queryset().filter(code=pk).first()
@@ -379,7 +384,7 @@ class BasketViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         queryset = Basket.objects.filter(site=self.request.site, session_id__isnull=False, session_id=self.request.session.session_key)
-        return queryset
+        return queryset.prefetch_related(Prefetch('items', queryset=BasketItem.objects.select_related('product')))
 
     def destroy(self, request):
         raise MethodNotAllowed(request.method)
@@ -476,7 +481,7 @@ class OrderViewSet(viewsets.ModelViewSet):
             filters['status'] = Order.STATUS_CANCELED
         elif order_filter == 'active':
             excludes['status__in'] = [Order.STATUS_DONE, Order.STATUS_FINISHED, Order.STATUS_CANCELED]
-        queryset = Order.objects.order_by('-id').filter(**filters).exclude(**excludes)
+        queryset = Order.objects.order_by('-id').filter(**filters).exclude(**excludes).with_totals()
         return queryset
 
     def create(self, request):
@@ -510,6 +515,7 @@ class OrderViewSet(viewsets.ModelViewSet):
             """ clear promo discount """
             try:
                 del request.session['discount']
+                invalidate_user_discount(request.session.session_key)
             except KeyError:
                 pass
 
@@ -974,44 +980,44 @@ class IntegrationViewSet(viewsets.ReadOnlyModelViewSet):
     def products(self, request, pk=None):
         integration = self.get_object()
 
-        filters = {
-            'enabled': True,
-            'price__gt': 0,
-            'variations__exact': ''
-        }
-
-        if not integration.output_skip_categories:
-            root_category = None
-            if hasattr(integration.site, 'profile'):
-                root_category = integration.site.profile.root_category
-            if root_category is None:
-                root_category = self.request.site.profile.root_category
-            filters['categories__in'] = root_category.get_descendants(include_self=True).filter(active=True, feed=True)
-
-        products = Product.objects.order_by().filter(**filters).distinct()
-
-        if not integration.output_all:
-            products = products.filter(
-                integration=integration
-            ).annotate(
-                integration_price=Subquery(
-                    ProductIntegration.objects.filter(
-                        product=OuterRef('id'),
-                        integration=integration
-                    ).values('price')
-                )
-            )
-
-        if integration.output_with_images:
-            products.exclude(image__isnull=True).exclude(image__exact='')
+        after = request.query_params.get('after')
+        limit = request.query_params.get('limit')
+        paged = integration.output_paged or after is not None
+        try:
+            after = int(after or 0)
+            limit = min(int(limit or FEED_PAGE_SIZE), FEED_MAX_PAGE_SIZE) if paged else None
+        except ValueError:
+            return Response({'detail': 'Неверные параметры страницы'}, status=status.HTTP_400_BAD_REQUEST)
+
+        version = get_feed_version()
+        etag = quote_etag('{}-{}-{}-{}'.format(integration.pk, version, after, limit or ''))
+        last_modified = version // 1000000000
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
 
-        if integration.output_available:
-            products = products.annotate(
-                quantity=Sum('stock_item__quantity', filter=Q(stock_item__supplier__integration=integration)),
-                correction=Sum('stock_item__correction', filter=Q(stock_item__supplier__integration=integration)),
-                available=F('quantity') + F('correction')
-            ).filter(available__gt=0)
+        if not paged:
+            snapshot = get_feed_snapshot(integration, 'json', request.build_absolute_uri('/'))
+            if snapshot is not None:
+                response = FileResponse(snapshot, content_type='application/json')
+                response['ETag'] = etag
+                response['Last-Modified'] = http_date(last_modified)
+                return response
+            remember_feed_request(integration, request)
+
+        products = get_feed_products(integration, request.site)
+        if paged:
+            # keyset pagination by product id
+            products = products.filter(id__gt=after).order_by('id')[:limit]
+
+            def next_url(last_id):
+                return replace_query_param(request.build_absolute_uri(), 'after', last_id)
+        else:
+            next_url = None
 
         context = self.get_serializer_context()
         context['integration'] = integration
-        return Response(IntegrationProductSerializer(products, many=True, context=context).data)
+        response = StreamingHttpResponse(stream_feed(integration, products, context, next_url, limit), content_type='application/json')
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
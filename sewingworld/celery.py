@@ -3,6 +3,7 @@ from __future__ import absolute_import
 import os
 import __main__ as main
 from celery import Celery
+from celery.signals import worker_process_init
 from django.conf import settings
 
 # set the default Django settings module for the 'celery' program.
@@ -28,3 +29,16 @@ app.conf.task_acks_late = True
 app.conf.task_default_queue = 'default'
 # app.conf.task_default_priority = 4
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+@worker_process_init.connect
+def setup_metrics_export(**kwargs):
+    """
+    Django exporter is disabled in workers as all processes of a node would fight for its ports, instead each
+    pool process exports its own metrics on the first free port of PROMETHEUS_WORKER_METRICS_EXPORT_PORT_RANGE
+    """
+    port_range = getattr(settings, 'PROMETHEUS_WORKER_METRICS_EXPORT_PORT_RANGE', None)
+    if not port_range:
+        return
+    from django_prometheus.exports import SetupPrometheusEndpointOnPortRange
+    SetupPrometheusEndpointOnPortRange(port_range, getattr(settings, 'PROMETHEUS_METRICS_EXPORT_ADDRESS', ''))
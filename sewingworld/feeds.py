@@ -0,0 +1,199 @@
+import logging
+import os
+import time
+
+from itertools import batched
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.db.models import OuterRef, Prefetch, Subquery, prefetch_related_objects
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from shop.models import Category, Product, ProductIntegration, ProductAvailability, PriceEngine
+
+from .serializers import IntegrationProductSerializer
+from .tasks import build_feed_snapshots, PRIORITY_IDLE
+
+logger = logging.getLogger(__name__)
+
+FEED_BATCH_SIZE = 500
+FEED_PAGE_SIZE = 1000
+FEED_MAX_PAGE_SIZE = 10000
+FEED_VERSION_KEY = 'integration_feed_version'
+FEED_SNAPSHOT_KEY = 'integration_feed_snapshot'
+FEED_REQUEST_KEY = 'integration_feed_request'
+FEED_SCHEDULED_KEY = 'integration_feed_snapshots_scheduled'
+FEED_SNAPSHOT_DELAY = 60  # seconds to collect changes before snapshots are rebuilt
+
+snapshot_storage = FileSystemStorage(location=settings.FEED_SNAPSHOT_ROOT)
+
+
+def get_feed_version():
+    """ Feed version is a timestamp in nanoseconds of the last change of any feed data """
+    return cache.get_or_set(FEED_VERSION_KEY, time.time_ns, None)
+
+
+def invalidate_feeds():
+    cache.set(FEED_VERSION_KEY, time.time_ns(), None)
+    if cache.add(FEED_SCHEDULED_KEY, True, FEED_SNAPSHOT_DELAY):
+        build_feed_snapshots.s().apply_async(countdown=FEED_SNAPSHOT_DELAY, priority=PRIORITY_IDLE)
+
+
+def get_feed_products(integration, site):
+    """ Returns queryset of integration feed products, site root category is used if integration site has none """
+    filters = {
+        'enabled': True,
+        'price__gt': 0,
+        'variations__exact': ''
+    }
+
+    if not integration.output_skip_categories:
+        root_category = None
+        if hasattr(integration.site, 'profile'):
+            root_category = integration.site.profile.root_category
+        if root_category is None:
+            root_category = site.profile.root_category
+        filters['categories__in'] = Category.objects.tree().get_descendant_ids(root_category.pk, include_self=True, active=True, feed=True)
+
+    products = Product.objects.order_by().filter(**filters).distinct()
+
+    if not integration.output_all:
+        products = products.filter(
+            integration=integration
+        ).annotate(
+            integration_price=Subquery(
+                ProductIntegration.objects.filter(
+                    product=OuterRef('id'),
+                    integration=integration
+                ).values('price')
+            )
+        )
+
+    if integration.output_with_images:
+        products = products.exclude(image__isnull=True).exclude(image__exact='')
+
+    products = ProductAvailability.objects.annotate_products(products)
+    products = ProductAvailability.objects.annotate_products(products, integration=integration, name='integration_available')
+
+    if integration.output_available:
+        products = products.filter(integration_available__gt=0)
+
+    return products
+
+
+def serialize_feed_products(integration, products, context, batch_size=FEED_BATCH_SIZE):
+    """
+    Yields lists of serialized products reading queryset with server-side cursor. Prices and
+    categories are fetched once per batch, availability is taken from queryset annotations.
+    """
+    categories = Prefetch('categories', queryset=Category.objects.filter(active=True).only('id'), to_attr='feed_categories')
+    for batch in batched(products.select_related('manufacturer').iterator(chunk_size=batch_size), batch_size):
+        prefetch_related_objects(batch, categories)
+        PriceEngine(integration.site).prefetch(batch)
+        yield IntegrationProductSerializer(batch, many=True, context=context).data
+
+
+def stream_feed(integration, products, context, next_url=None, limit=None):
+    """
+    Yields feed JSON by chunks. If next_url is given, feed is paged: it is an object with results
+    and url of the next page, which is built with the last product id.
+    """
+    encoder = JSONEncoder(ensure_ascii=False)
+    yield '{"results":[' if next_url else '['
+    last_id = None
+    count = 0
+    for data in serialize_feed_products(integration, products, context):
+        yield (',' if count else '') + ','.join([encoder.encode(item) for item in data])
+        count += len(data)
+        last_id = data[-1]['id']
+    if next_url:
+        yield '],"next":{}}}'.format(encoder.encode(next_url(last_id) if limit and count >= limit else None))
+    else:
+        yield ']'
+    logger.debug("Streamed {} products of {} feed".format(count, integration.utm_source))
+
+
+def get_stock_products(integration):
+    """ Products of Avito stock feed annotated with integration (or storefront) availability """
+    tree = Category.objects.tree()
+    root = tree.get_root(settings.MPTT_ROOT)
+    filters = {
+        'enabled': True,
+        'price__gt': 0,
+        'variations__exact': '',
+        'categories__in': tree.get_descendant_ids(root.id, include_self=True),
+        'avito': True
+    }
+    products = Product.objects.order_by().filter(**filters).distinct()
+    return ProductAvailability.objects.annotate_products(products, integration=integration)
+
+
+def stream_stock_csv(integration, batch_size=FEED_BATCH_SIZE):
+    """ Yields stock CSV by chunks, template ends with a newline after rows, it is output once after all chunks """
+    for batch in batched(get_stock_products(integration).iterator(chunk_size=batch_size), batch_size):
+        yield render_to_string('stock.csv', {'products': [(product, max(int(product.available), 0)) for product in batch]}).removesuffix('\n')
+    yield '\n'
+
+
+def remember_feed_request(integration, request):
+    """ Snapshot is built for the host and site of the last feed request as they affect urls and categories """
+    cache.set('{}_{}'.format(FEED_REQUEST_KEY, integration.pk), (request.build_absolute_uri('/'), request.site.id), None)
+
+
+def get_feed_snapshot(integration, kind, base_url=''):
+    """ Returns opened snapshot file if it is built for current feed version, None otherwise """
+    snapshot = cache.get('{}_{}_{}'.format(FEED_SNAPSHOT_KEY, integration.pk, kind))
+    if snapshot is None:
+        return None
+    version, name, snapshot_base_url = snapshot
+    if version != get_feed_version() or snapshot_base_url != base_url:
+        return None
+    try:
+        return snapshot_storage.open(name, 'rb')
+    except FileNotFoundError:
+        return None
+
+
+def save_feed_snapshot(integration, kind, version, chunks, base_url=''):
+    name = '{}-{}-{}.{}'.format(integration.pk, integration.output_template or 'feed', version, kind)
+    path = snapshot_storage.path(name)
+    os.makedirs(snapshot_storage.location, exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as snapshot:
+        for chunk in chunks:
+            snapshot.write(chunk)
+    os.replace(path + '.tmp', path)  # feed readers never see partial file
+
+    key = '{}_{}_{}'.format(FEED_SNAPSHOT_KEY, integration.pk, kind)
+    previous = cache.get(key)
+    cache.set(key, (version, name, base_url), None)
+    if previous is not None and previous[1] != name:
+        snapshot_storage.delete(previous[1])
+    return name
+
+
+def build_snapshots(integrations):
+    """ Builds feed snapshots for current feed version, returns number of built snapshots """
+    version = get_feed_version()
+    num = 0
+    for integration in integrations:
+        feed_request = cache.get('{}_{}'.format(FEED_REQUEST_KEY, integration.pk))
+        if feed_request is not None:
+            base_url, site_id = feed_request
+            url = urlparse(base_url)
+            request = RequestFactory().get('/', secure=url.scheme == 'https', HTTP_HOST=url.netloc)
+            request.site = Site.objects.get(pk=site_id)
+            context = {'request': request, 'integration': integration}
+            products = get_feed_products(integration, request.site)
+            save_feed_snapshot(integration, 'json', version, stream_feed(integration, products, context), base_url)
+            num += 1
+        if integration.utm_source == 'avito':
+            save_feed_snapshot(integration, 'csv', version, stream_stock_csv(integration))
+            num += 1
+    logger.info("Built {} feed snapshots for version {}".format(num, version))
+    return num
@@ -0,0 +1,225 @@
+import base64
+import json
+import logging
+import os
+import random
+import re
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+
+import httpx
+
+from django.conf import settings
+from django.contrib import auth
+from django.core.cache import cache
+
+from prometheus_client import Counter, Histogram
+
+from .tasks import throttle
+
+REQUEST_TIMEOUT = httpx.Timeout(30, connect=10)
+REQUEST_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1  # seconds, doubled with each retry
+RETRY_AFTER_MAX = 60
+RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+FAN_OUT_WORKERS = 8
+TOKEN_LIFETIME = 3600  # seconds, used if token does not tell its expiration
+TOKEN_EXPIRY_MARGIN = 60  # seconds to refresh token before it expires
+TOKEN_LOCK_TIMEOUT = 30
+
+request_latency = Histogram('integration_request_latency_seconds', 'Latency of integration API requests',
+                            ['service', 'endpoint', 'method'])
+request_errors = Counter('integration_request_errors_total', 'Failed integration API requests',
+                         ['service', 'endpoint', 'status'])
+
+_clients = {}
+os.register_at_fork(after_in_child=_clients.clear)  # forked workers should not share connections
+
+
+class ResponseError(OSError):
+    """
+    Error response of integration API. It is an OSError as urllib HTTPError is, so tasks retry
+    unhandled errors the same way.
+    """
+
+    def __init__(self, response):
+        super().__init__('{} {}: {}'.format(response.status_code, response.reason_phrase, response.text))
+        self.response = response
+        self.code = response.status_code
+        self.content = response.content
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def message(self, default, *path):
+        """ Returns error message found in JSON content by path of keys and indexes or default """
+        try:
+            message = self.json()
+            for key in path:
+                message = message[key]
+        except (ValueError, LookupError, TypeError):
+            return default
+        return message if message else default
+
+
+class IntegrationClient(object):
+    """
+    HTTP client of integration API. Keep-alive connections are pooled per service and process,
+    requests of an account are rate limited across all workers if rate is given, connection errors
+    and throttled or failed idempotent requests are retried with exponential backoff and jitter.
+    """
+
+    def __init__(self, service, account=None, base_url='', headers=None, rate=None, period=1, limit_key=None):
+        self.service = service
+        self.account = account
+        self.base_url = base_url
+        self.headers = headers or {}
+        self.rate = rate
+        self.period = period
+        self.limit_key = limit_key or '{}-{}'.format(service, account)  # APIs may have separate limits for groups of endpoints
+        self.logger = logging.getLogger(service)
+
+    @property
+    def client(self):
+        client = _clients.get(self.service)
+        if client is None:
+            client = _clients[self.service] = httpx.Client(timeout=REQUEST_TIMEOUT, limits=REQUEST_LIMITS)
+        return client
+
+    def backoff(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(int(retry_after), RETRY_AFTER_MAX)
+        return RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def request(self, method, url, data=None, endpoint=None, headers=None, retries=MAX_RETRIES, log_data=True, **kwargs):
+        """ Sends request with data encoded as JSON and returns successful response, raises ResponseError otherwise """
+        url = self.base_url + url
+        if endpoint is None:
+            endpoint = re.sub(r'/\d+', '/{id}', httpx.URL(url).path)
+        if headers is not None:
+            headers = dict(self.headers, **headers)
+        else:
+            headers = self.headers
+        if data is not None:
+            kwargs['content'] = json.dumps(data).encode('utf-8')
+
+        self.logger.info('<<< ' + url)
+        if data is not None and log_data:
+            self.logger.info(kwargs['content'])
+
+        attempt = 0
+        while True:
+            if self.rate:
+                throttle(self.limit_key, self.rate, self.period)
+            start = time.monotonic()
+            try:
+                response = self.client.request(method, url, headers=headers, **kwargs)
+            except httpx.TransportError as e:
+                request_errors.labels(self.service, endpoint, type(e).__name__).inc()
+                # request could be processed if connection is lost after it is sent
+                if attempt < retries and (method in IDEMPOTENT_METHODS or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))):
+                    time.sleep(self.backoff(attempt))
+                    attempt += 1
+                    continue
+                raise ConnectionError('{}: {}'.format(url, e)) from e
+            finally:
+                request_latency.labels(self.service, endpoint, method).observe(time.monotonic() - start)
+
+            if response.is_success:
+                return response
+
+            request_errors.labels(self.service, endpoint, response.status_code).inc()
+            if attempt < retries and (response.status_code == 429 or response.status_code in RETRY_STATUSES and method in IDEMPOTENT_METHODS):
+                time.sleep(self.backoff(attempt, response))
+                attempt += 1
+                continue
+            raise ResponseError(response)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data, **kwargs)
+
+
+def fan_out(func, items, workers=FAN_OUT_WORKERS):
+    """ Calls func for each item concurrently, returns results in order of items """
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def token_expires_in(token, default=TOKEN_LIFETIME):
+    """ Returns seconds until token expiration taken from JWT exp claim or default """
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return int(claims['exp'] - time.time())
+    except (IndexError, ValueError, KeyError, TypeError):
+        return default
+
+
+def get_token(key, sign_in, lifetime=TOKEN_LIFETIME):
+    """
+    Returns cached token of an account, calling sign_in() to get new one when it is about to expire.
+    Workers wait for the one which signs in, so account signs in once per token lifetime. Empty token
+    is returned as is but is not cached.
+    """
+    cache_key = 'integration-token-' + key
+    token = cache.get(cache_key)
+    if token is not None:
+        return token
+    lock_key = cache_key + '-lock'
+    deadline = time.monotonic() + TOKEN_LOCK_TIMEOUT
+    locked = cache.add(lock_key, True, TOKEN_LOCK_TIMEOUT)
+    while not locked:
+        time.sleep(0.1)
+        token = cache.get(cache_key)
+        if token is not None:
+            return token
+        if time.monotonic() > deadline:  # lock holder has failed
+            break
+        locked = cache.add(lock_key, True, TOKEN_LOCK_TIMEOUT)
+    try:
+        token = cache.get(cache_key)
+        if token is None:
+            token = sign_in()
+            timeout = token_expires_in(token, lifetime) - TOKEN_EXPIRY_MARGIN
+            if token and timeout > 0:
+                cache.set(cache_key, token, timeout)
+        return token
+    finally:
+        if locked:  # lock of another worker is left to expire
+            cache.delete(lock_key)
+
+
+def invalidate_token(key):
+    cache.delete('integration-token-' + key)
+
+
+def get_user_session(user):
+    """ Returns key of authenticated session of integration pseudo-user, the session is created once and reused """
+    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+    cache_key = 'integration-session-{}'.format(user.pk)
+    session_key = cache.get(cache_key)
+    if session_key is not None and SessionStore().exists(session_key):
+        return session_key
+    session = SessionStore()
+    session.cycle_key()
+    session[auth.SESSION_KEY] = user._meta.pk.value_to_string(user)
+    session[auth.BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[auth.HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    cache.set(cache_key, session.session_key, settings.SESSION_COOKIE_AGE)
+    return session.session_key
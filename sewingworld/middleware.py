@@ -1,6 +1,7 @@
 import logging
 import re
 import sys
+import time
 import traceback
 
 from importlib import import_module
@@ -9,13 +10,41 @@ from urllib.parse import urlparse
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.exceptions import MiddlewareNotUsed
-from django.db.models import Q
 from django.http import HttpResponseForbidden
 
 
 logger = logging.getLogger("django")
 
+SITES_VERSION_KEY = 'sites_version'
+
+_sites = None
+
+
+def invalidate_sites():
+    cache.set(SITES_VERSION_KEY, time.time_ns(), None)
+
+
+def get_sites():
+    """
+    Returns process-local map of site ids, domains and aliases to sites with preloaded profiles, the map
+    is rebuilt when sites version is changed. A domain belongs to the first site in domain order
+    which has it as domain or alias.
+    """
+    global _sites
+    version = cache.get_or_set(SITES_VERSION_KEY, time.time_ns, None)
+    if _sites is None or _sites[0] != version:
+        sites = {}
+        for site in Site.objects.select_related('profile').order_by('domain'):
+            sites[site.id] = site
+            sites.setdefault(site.domain, site)
+            if hasattr(site, 'profile'):
+                for alias in site.profile.aliases or []:
+                    sites.setdefault(alias, site)
+        _sites = (version, sites)
+    return _sites[1]
+
 
 class SiteDetectionMiddleware:
     """
@@ -27,6 +56,7 @@ class SiteDetectionMiddleware:
         self.get_response = get_response
 
     def __call__(self, request):
+        sites = get_sites()
         site = None
         # Prefer Origin header over Referer
         url = request.META.get('HTTP_ORIGIN', request.META.get('HTTP_REFERER', ''))
@@ -34,11 +64,11 @@ class SiteDetectionMiddleware:
             try:
                 domain = urlparse(url).hostname
                 if domain:
-                    site = Site.objects.filter(Q(domain=domain) | Q(profile__aliases__contains=[domain])).first()
+                    site = sites.get(domain)
             except ValueError:
                 pass
         if site is None:
-            site = Site.objects.get_current()
+            site = sites.get(settings.SITE_ID) or Site.objects.get_current()
         request.site = site
         response = self.get_response(request)
         return response
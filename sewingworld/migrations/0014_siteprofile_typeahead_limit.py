@@ -0,0 +1,18 @@
+# Generated by Django 4.2.18 on 2026-10-18 22:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sewingworld', '0013_siteprofile_yookassa_id_siteprofile_yookassa_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='siteprofile',
+            name='typeahead_limit',
+            field=models.PositiveSmallIntegerField(default=10, verbose_name='подсказок в поиске'),
+        ),
+    ]
@@ -20,6 +20,7 @@ class SiteProfile(models.Model):
     yookassa_id = models.CharField('ID аккаунта ЮKassa', max_length=20, blank=True)
     yookassa_key = models.CharField('секретный ключ ЮKassa', max_length=255, blank=True)
     aliases = ArrayField(models.CharField(max_length=100), verbose_name='домены-ссылки', blank=True, null=True)
+    typeahead_limit = models.PositiveSmallIntegerField('подсказок в поиске', default=10)
 
     class Meta:
         verbose_name = 'профиль сайта'
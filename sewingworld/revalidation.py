@@ -0,0 +1,119 @@
+import logging
+import time
+
+from collections import defaultdict
+from itertools import batched
+
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from shop.models import Product
+
+from .integration_client import IntegrationClient, fan_out
+from .tasks import flush_revalidation, PRIORITY_IDLE
+
+logger = logging.getLogger(__name__)
+
+REVALIDATION_WINDOW = 5  # seconds to collect events before they are sent
+REVALIDATION_GRACE = 2  # seconds to let events of the window be stored before it is flushed
+REVALIDATION_BATCH_SIZE = 1000
+REVALIDATION_BUFFER_KEY = 'nextjs_revalidation'
+REVALIDATION_BUFFER_TIMEOUT = 3600
+
+buffered_events = Counter('nextjs_revalidation_events_total', 'Buffered Next.js revalidation events', ['model'])
+queue_depth = Gauge('nextjs_revalidation_queue_depth', 'Events in the last flushed revalidation window')
+batch_sizes = Histogram('nextjs_revalidation_batch_size', 'Items in sent revalidation payloads',
+                        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+client = IntegrationClient('nextjs')
+
+
+def revalidate(site_ids, model, items):
+    """
+    Buffers revalidation of model items (dicts with pk and other fields of payload) on sites, events are
+    collected in windows of REVALIDATION_WINDOW seconds and the window is flushed by one task
+    """
+    events = [(site_id, model, item) for site_id in site_ids for item in items]
+    if not events:
+        return
+    window = int(time.time() / REVALIDATION_WINDOW)
+    key = '{}_{}'.format(REVALIDATION_BUFFER_KEY, window)
+    while True:
+        cache.add(key + '_count', 0, REVALIDATION_BUFFER_TIMEOUT)
+        try:
+            last = cache.incr(key + '_count', len(events))  # reserves slots for events
+            break
+        except ValueError:  # counter has expired
+            continue
+    first = last - len(events) + 1
+    cache.set_many({'{}_{}'.format(key, first + num): event for num, event in enumerate(events)}, REVALIDATION_BUFFER_TIMEOUT)
+    buffered_events.labels(model).inc(len(events))
+    if cache.add(key + '_scheduled', True, REVALIDATION_BUFFER_TIMEOUT):
+        countdown = REVALIDATION_WINDOW - time.time() % REVALIDATION_WINDOW + REVALIDATION_GRACE
+        flush_revalidation.s(window).apply_async(countdown=countdown, priority=PRIORITY_IDLE)
+
+
+def revalidate_products(product_ids, batch_size=REVALIDATION_BATCH_SIZE):
+    """
+    Buffers revalidation of products on their sites with revalidation token, site membership and product
+    codes are read by one query per chunk of products. Returns number of buffered product revalidations.
+    """
+    num = 0
+    for chunk in batched(sorted(product_ids), batch_size):
+        sites = defaultdict(list)
+        for site_id, product_id, code in Product.sites.through.objects.filter(product_id__in=chunk).exclude(
+                site__profile__revalidation_token__exact='').values_list('site_id', 'product_id', 'product__code'):
+            sites[site_id].append({'pk': product_id, 'code': code})
+        for site_id, items in sites.items():
+            revalidate([site_id], 'product', items)
+            num += len(items)
+    return num
+
+
+def revalidation_payloads(events):
+    """
+    Coalesces events to payloads per site and model, the last event of an item wins. Single item is sent
+    as flat payload, multiple items are sent as items list in batches of REVALIDATION_BATCH_SIZE.
+    """
+    pending = defaultdict(dict)
+    for site_id, model, item in events:
+        pending[(site_id, model)][item['pk']] = item
+    for (site_id, model), items in pending.items():
+        if len(items) == 1:
+            yield site_id, {'model': model, **next(iter(items.values()))}
+        else:
+            for batch in batched(items.values(), REVALIDATION_BATCH_SIZE):
+                yield site_id, {'model': model, 'items': list(batch)}
+
+
+def send_revalidation(domain, token, payload):
+    batch_sizes.observe(len(payload.get('items', [payload])))
+    try:
+        return client.post('https://{}/api/revalidate'.format(domain), {'secret': token, **payload}, log_data=False).json()
+    except (OSError, ValueError) as e:
+        logger.warning('Failed to revalidate {}: {}'.format(domain, e))
+        return False
+
+
+def flush(window):
+    """ Sends coalesced revalidation events of a window, returns number of sent payloads """
+    key = '{}_{}'.format(REVALIDATION_BUFFER_KEY, window)
+    count = cache.get(key + '_count') or 0
+    keys = ['{}_{}'.format(key, num) for num in range(1, count + 1)]
+    events = []
+    for chunk in batched(keys, REVALIDATION_BATCH_SIZE):
+        events.extend(cache.get_many(chunk).values())
+    cache.delete_many(keys + [key + '_count'])
+    queue_depth.set(count)
+    if len(events) < count:
+        logger.warning('Lost {} of {} revalidation events'.format(count - len(events), count))
+
+    payloads = list(revalidation_payloads(events))
+    sites = Site.objects.filter(id__in={site_id for site_id, _ in payloads}).exclude(
+        profile__revalidation_token__exact='').select_related('profile').in_bulk()
+    requests = [(sites[site_id], payload) for site_id, payload in payloads if site_id in sites]
+    fan_out(lambda request: send_revalidation(request[0].domain, request[0].profile.revalidation_token, request[1]), requests)
+    logger.info('Sent {} revalidation payloads for {} events'.format(len(requests), count))
+    return len(requests)
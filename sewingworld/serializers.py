@@ -6,6 +6,8 @@ from urllib.parse import urlparse
 from django.conf import settings
 from django.contrib.auth import authenticate
 from django.core.files.storage import default_storage
+from django.db.models.manager import BaseManager
+from django.utils.functional import cached_property
 
 from rest_framework import serializers
 
@@ -18,7 +20,7 @@ from shop.filters import get_product_filter
 from shop.models import Basket, BasketItem, Order, OrderItem, Favorites, Serial, \
     Category, Product, ProductRelation, ProductKind, Stock, ShopUser, ShopUserManager, Bonus, \
     Country, City, Store, ServiceCenter, News, Advert, SalesAction, Manufacturer, \
-    Integration
+    Integration, PriceEngine
 
 
 logger = logging.getLogger("django")
@@ -107,7 +109,7 @@ class CategoryBriefSerializer(NonNullModelSerializer):
         fields = ('id', 'name', 'subname', 'slug', 'path')
 
     def get_path(self, obj):
-        ancestors = obj.get_ancestors(include_self=True)[1:]  # exclude root category
+        ancestors = Category.objects.tree().get_ancestors(obj.pk, include_root=False)
         uri = '/'.join([item.slug for item in ancestors])
         breadcrumbs = [{
             'id': item.id,
@@ -130,7 +132,7 @@ class CategorySerializer(NonNullModelSerializer):
         exclude = ('active', 'hidden', 'feed', 'tree_id', 'lft', 'rght')
 
     def get_path(self, obj):
-        ancestors = obj.get_ancestors(include_self=True)[1:]  # exclude root category
+        ancestors = Category.objects.tree().get_ancestors(obj.pk, include_root=False)
         uri = '/'.join([item.slug for item in ancestors])
         breadcrumbs = [{
             'id': item.id,
@@ -197,6 +199,13 @@ class ProductImagesSerializer(serializers.BaseSerializer):  # BaseSerializer is
         return images
 
 
+class PricedProductListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        products = list(data.all() if isinstance(data, BaseManager) else data)
+        self.child.pricing.prefetch(products)  # fetch site prices of all products with one query
+        return super().to_representation(products)
+
+
 class ProductListSerializer(DynamicFieldsModelSerializer):
     price = serializers.SerializerMethodField()
     cost = serializers.SerializerMethodField()
@@ -210,6 +219,12 @@ class ProductListSerializer(DynamicFieldsModelSerializer):
                   'price', 'cost', 'discount', 'instock', 'image', 'enabled', 'isnew', 'recomended',
                   'ws_pack_only', 'pack_factor', 'sales', 'sales_notes', 'shortdescr', 'rank',
                   'wb_link', 'ozon_link')
+        list_serializer_class = PricedProductListSerializer
+
+    @cached_property
+    def pricing(self):
+        request = self.context.get('request')
+        return PriceEngine(request.site)
 
     def to_representation(self, instance):
         request = self.context.get('request')
@@ -220,15 +235,16 @@ class ProductListSerializer(DynamicFieldsModelSerializer):
         return super().to_representation(instance)
 
     def get_price(self, obj):
-        request = self.context.get('request')
-        return obj.site_price(request.site)
+        return self.pricing.get(obj).price
 
     def get_cost(self, obj):
-        request = self.context.get('request')
-        return obj.site_cost(request.site)
+        return self.pricing.get(obj).cost
 
     def get_instock(self, obj):
-        return max(min(obj.instock, 10), 0)
+        instock = getattr(obj, 'available', None)  # annotated by ProductAvailability.objects.annotate_products()
+        if instock is None:
+            instock = obj.instock
+        return max(min(instock, 10), 0)
 
     def get_sales(self, obj):
         request = self.context.get('request')
@@ -683,6 +699,9 @@ class IntegrationProductSerializer(serializers.ModelSerializer):
             self.fields.pop('stock')
 
     def get_categories(self, obj):
+        categories = getattr(obj, 'feed_categories', None)  # prefetched by feed export
+        if categories is not None:
+            return [category.pk for category in categories]
         return list(obj.categories.filter(active=True).values_list('pk', flat=True))
 
     def get_price(self, obj):
@@ -692,7 +711,13 @@ class IntegrationProductSerializer(serializers.ModelSerializer):
         return obj.site_cost(self.site)
 
     def get_instock(self, obj):
-        return max(min(obj.instock, 10), 0)
+        instock = getattr(obj, 'available', None)  # annotated by ProductAvailability.objects.annotate_products()
+        if instock is None:
+            instock = obj.instock
+        return max(min(instock, 10), 0)
 
     def get_stock(self, obj):
-        return obj.get_stock(integration=self.context.get('integration'))
+        stock = getattr(obj, 'integration_available', None)
+        if stock is None:
+            stock = obj.get_stock(integration=self.context.get('integration'))
+        return stock
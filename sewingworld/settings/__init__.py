@@ -82,6 +82,7 @@ STATICFILES_DIRS = (
 )
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+FEED_SNAPSHOT_ROOT = os.path.join(BASE_DIR, 'feeds')  # not public, feeds are served by views
 
 STAFF_REQUIRED_URLS = (
     r'/wiki/(.*)$',
@@ -3,5 +3,6 @@ from django_prometheus.utils import PowersOf
 PROMETHEUS_EXPORT_MIGRATIONS = False
 PROMETHEUS_METRICS_EXPORT_ADDRESS = '127.0.0.1'
 PROMETHEUS_METRICS_EXPORT_PORT_RANGE = range(9110, 9119)
+PROMETHEUS_WORKER_METRICS_EXPORT_PORT_RANGE = range(9120, 9160)  # celery pool processes
 PROMETHEUS_LATENCY_BUCKETS = (.01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0, 25.0, float("inf"))
 PROMETHEUS_BYTES_BUCKETS = PowersOf(2, 26)
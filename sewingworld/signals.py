@@ -3,8 +3,20 @@ import logging
 from celery import states
 from celery.signals import before_task_publish, task_received
 
+from django.contrib.sites.models import Site
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
 from django_celery_results.models import TaskResult
 
+from shop.models import Category, Product, ProductPrice, ProductIntegration, Integration
+from shop.models.availability import availability_changed
+from shop.models.product import prices_changed
+
+from .feeds import invalidate_feeds
+from .middleware import invalidate_sites
+from .models import SiteProfile
+
 
 logger = logging.getLogger("django")
 
@@ -38,3 +50,25 @@ def create_task_on_received(request, **kwargs):
         task_args=request.argsrepr,
         task_kwargs=request.kwargsrepr,
     )
+
+
+@receiver(post_save, sender=Product, dispatch_uid='product_saved_feeds_receiver')
+@receiver(post_delete, sender=Product, dispatch_uid='product_deleted_feeds_receiver')
+@receiver(post_save, sender=ProductPrice, dispatch_uid='product_price_saved_feeds_receiver')
+@receiver(post_delete, sender=ProductPrice, dispatch_uid='product_price_deleted_feeds_receiver')
+@receiver(post_save, sender=ProductIntegration, dispatch_uid='product_integration_saved_feeds_receiver')
+@receiver(post_delete, sender=ProductIntegration, dispatch_uid='product_integration_deleted_feeds_receiver')
+@receiver(post_save, sender=Integration, dispatch_uid='integration_saved_feeds_receiver')
+@receiver(post_save, sender=Category, dispatch_uid='category_saved_feeds_receiver')
+@receiver(availability_changed, dispatch_uid='availability_changed_feeds_receiver')
+@receiver(prices_changed, dispatch_uid='prices_changed_feeds_receiver')
+def feeds_changed(sender, **kwargs):
+    invalidate_feeds()
+
+
+@receiver(post_save, sender=Site, dispatch_uid='site_saved_sites_receiver')
+@receiver(post_delete, sender=Site, dispatch_uid='site_deleted_sites_receiver')
+@receiver(post_save, sender=SiteProfile, dispatch_uid='site_profile_saved_sites_receiver')
+@receiver(post_delete, sender=SiteProfile, dispatch_uid='site_profile_deleted_sites_receiver')
+def sites_changed(sender, **kwargs):
+    invalidate_sites()
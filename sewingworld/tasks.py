@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import functools
+import time
 
 from django.core import management
 from django.core.cache import cache
@@ -22,6 +23,37 @@ def single_instance_task(timeout):
     return task_exc
 
 
+def throttle(key, rate, period=1):
+    """
+    Blocks until the call fits into the limit of rate calls per period seconds. Limit is shared
+    by all workers through cache counters of fixed time windows.
+    """
+    while True:
+        window = int(time.time() / period)
+        counter = "throttle-{}-{}".format(key, window)
+        cache.add(counter, 0, period * 2)
+        try:
+            if cache.incr(counter) <= rate:
+                return
+        except ValueError:  # counter has expired
+            continue
+        time.sleep(period - time.time() % period)
+
+
+@shared_task(time_limit=3600)
+@single_instance_task(3600)
+def build_feed_snapshots():
+    from shop.models import Integration  # circular import
+    from .feeds import build_snapshots
+    return build_snapshots(Integration.objects.filter(enabled=True).select_related('site'))
+
+
+@shared_task(queue="revalidation")
+def flush_revalidation(window):
+    from .revalidation import flush  # circular import
+    return flush(window)
+
+
 @shared_task
 def django_clearsessions():
     """Cleanup expired sessions by using Django management command."""
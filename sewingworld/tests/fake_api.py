@@ -0,0 +1,61 @@
+import json
+import os
+
+from collections import defaultdict
+
+import httpx
+
+from sewingworld import integration_client
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class FakeAPI(object):
+    """
+    Local fake server of integration API: pooled client of the service is replaced with a client
+    which transport replays recorded responses of routes instead of sending requests. Responses of
+    a route are replayed in order, the last one is repeated. Sent requests are kept for assertions.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.routes = defaultdict(list)
+        self.requests = []
+        self.previous = None
+
+    def add(self, method, path, status=200, body=None, headers=None):
+        """ Adds response of route, body is encoded as JSON unless it is a string """
+        self.routes[(method, path)].append((status, body, headers or {}))
+        return self
+
+    def load(self, name):
+        """ Adds responses recorded in fixtures/<name>.json: list of {method, path, status, headers, body} """
+        with open(os.path.join(FIXTURES_DIR, name + '.json'), encoding='utf-8') as fixture:
+            for response in json.load(fixture):
+                self.add(response['method'], response['path'], response.get('status', 200), response.get('body'), response.get('headers'))
+        return self
+
+    def handle(self, request):
+        self.requests.append(request)
+        responses = self.routes.get((request.method, request.url.path))
+        if not responses:
+            return httpx.Response(404, json={'message': 'Not found'})
+        status, body, headers = responses.pop(0) if len(responses) > 1 else responses[0]
+        if isinstance(body, str):
+            return httpx.Response(status, text=body, headers=headers)
+        return httpx.Response(status, json=body, headers=headers)
+
+    def sent(self, method=None, path=None):
+        """ Returns sent requests of route, data of JSON requests is decoded """
+        return [json.loads(request.content) if request.content else None for request in self.requests
+                if (method is None or request.method == method) and (path is None or request.url.path == path)]
+
+    def __enter__(self):
+        self.previous = integration_client._clients.get(self.service)
+        integration_client._clients[self.service] = httpx.Client(transport=httpx.MockTransport(self.handle))
+        return self
+
+    def __exit__(self, *exc_info):
+        integration_client._clients.pop(self.service).close()
+        if self.previous is not None:
+            integration_client._clients[self.service] = self.previous
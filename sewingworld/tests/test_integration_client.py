@@ -0,0 +1,75 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from sewingworld.integration_client import IntegrationClient, ResponseError, RETRY_AFTER_MAX
+
+from .fake_api import FakeAPI
+
+
+@mock.patch('sewingworld.integration_client.time.sleep')
+class IntegrationClientTest(SimpleTestCase):
+    def test_retry_after(self, sleep):
+        client = IntegrationClient('ozon', base_url='https://api-seller.ozon.ru')
+        with FakeAPI('ozon').load('ozon_errors') as api:
+            response = client.post('/v2/products/stocks', {'stocks': []})
+        self.assertEqual(response.json(), {'result': []})
+        self.assertEqual(len(api.sent('POST', '/v2/products/stocks')), 2)
+        sleep.assert_called_once_with(2)
+
+    def test_retry_after_limit(self, sleep):
+        client = IntegrationClient('ozon', base_url='https://api-seller.ozon.ru')
+        with FakeAPI('ozon') as api:
+            api.add('GET', '/v1/warehouse/list', 429, {}, {'Retry-After': '3600'}).add('GET', '/v1/warehouse/list', 200, {})
+            client.get('/v1/warehouse/list')
+        sleep.assert_called_once_with(RETRY_AFTER_MAX)
+
+    def test_throttled_until_retries_exhausted(self, sleep):
+        client = IntegrationClient('ozon', base_url='https://api-seller.ozon.ru')
+        with FakeAPI('ozon') as api:
+            api.add('POST', '/v2/products/stocks', 429, {'message': 'rate limit'}, {'Retry-After': '1'})
+            with self.assertRaises(ResponseError) as context:
+                client.post('/v2/products/stocks', {'stocks': []}, retries=2)
+        self.assertEqual(context.exception.code, 429)
+        self.assertEqual(len(api.requests), 3)
+
+    def test_no_retry_of_non_idempotent_request(self, sleep):
+        client = IntegrationClient('ozon', base_url='https://api-seller.ozon.ru')
+        with FakeAPI('ozon').load('ozon_errors') as api:
+            with self.assertRaises(ResponseError) as context:
+                client.post('/v3/posting/fbs/ship', {'posting_number': '1234-5678-1'})
+        self.assertEqual(context.exception.code, 502)
+        self.assertEqual(len(api.requests), 1)
+        sleep.assert_not_called()
+
+    def test_retry_of_idempotent_request(self, sleep):
+        client = IntegrationClient('wb', base_url='https://marketplace-api.wildberries.ru')
+        with FakeAPI('wb').load('wb_errors') as api:
+            response = client.get('/api/v3/orders/new')
+        self.assertEqual(response.json(), {'orders': []})
+        self.assertEqual(len(api.requests), 2)
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_error_message(self, sleep):
+        client = IntegrationClient('ozon', base_url='https://api-seller.ozon.ru')
+        with FakeAPI('ozon').load('ozon_errors'):
+            with self.assertRaises(ResponseError) as context:
+                client.post('/v2/posting/fbs/act/create', {})
+            self.assertEqual(context.exception.message('default', 'message'), 'POSTINGS_NOT_FOUND')
+            self.assertEqual(context.exception.message('default', 'details', 0), 'default')
+            self.assertEqual(context.exception.message('default', 'missing'), 'default')
+
+            with self.assertRaises(ResponseError) as context:
+                client.post('/v3/posting/fbs/ship', {})
+            self.assertEqual(context.exception.message('default', 'message'), 'default')  # HTML error page
+            with self.assertRaises(ValueError):
+                context.exception.json()
+
+    def test_error_message_path(self, sleep):
+        client = IntegrationClient('wb', base_url='https://marketplace-api.wildberries.ru')
+        with FakeAPI('wb').load('wb_errors'):
+            with self.assertRaises(ResponseError) as context:
+                client.put('/api/v3/stocks/1', {'stocks': [{'sku': '374318830018', 'amount': 4}]})
+        self.assertEqual(context.exception.code, 409)
+        self.assertEqual(context.exception.message('default', 0, 'data', 0, 'sku'), '374318830018')
+        self.assertEqual(context.exception.message('default', 'detail'), 'default')
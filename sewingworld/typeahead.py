@@ -0,0 +1,87 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db.models import Case, Q, Value, When
+
+from shop.filters import FACETS_VERSION_KEY
+from shop.models import Product
+
+TYPEAHEAD_MIN_LENGTH = 3  # trigram index can not serve substring search of shorter text
+TYPEAHEAD_MAX_LENGTH = 100
+TYPEAHEAD_LIMIT = 10
+TYPEAHEAD_CACHE_SIZE = 2048
+TYPEAHEAD_CACHE_TTL = 60  # seconds, product changes invalidate cached suggestions earlier
+
+
+class LRUCache(object):
+    """ Small thread safe in-process cache which evicts least recently used and expired entries """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+suggestions = LRUCache(TYPEAHEAD_CACHE_SIZE, TYPEAHEAD_CACHE_TTL)
+
+
+def get_typeahead_limit(site):
+    if hasattr(site, 'profile'):
+        return site.profile.typeahead_limit
+    return TYPEAHEAD_LIMIT
+
+
+def get_typeahead_products(site, text, limit):
+    """
+    Returns queryset of site products with title containing text or code, article or partnumber starting
+    with it or barcode equal to it, all lookups are served by trigram and array indexes
+    """
+    return Product.objects.filter(
+        Q(title__icontains=text) | Q(code__istartswith=text) | Q(article__istartswith=text) |
+        Q(partnumber__istartswith=text) | Q(gtin=text) | Q(gtins__contains=[text]),
+        sites=site
+    ).annotate(
+        title_match=Case(When(title__istartswith=text, then=Value(0)), default=Value(1))
+    ).order_by(
+        '-enabled',
+        'title_match',
+        'title'
+    )[:limit]
+
+
+def get_typeahead_titles(site, text):
+    """ Returns list of product titles suggested for text typed in search field """
+    text = ' '.join(text.split())[:TYPEAHEAD_MAX_LENGTH]
+    if len(text) < TYPEAHEAD_MIN_LENGTH:
+        return []
+    limit = get_typeahead_limit(site)
+    # facets version is changed when products are saved
+    key = (site.id, text.upper(), limit, cache.get_or_set(FACETS_VERSION_KEY, time.time_ns, None))
+    titles = suggestions.get(key)
+    if titles is None:
+        titles = list(get_typeahead_products(site, text, limit).values_list('title', flat=True))
+        suggestions.set(key, titles)
+    return titles
@@ -2,18 +2,15 @@ import logging
 import re
 import datetime
 from collections import defaultdict
-from decimal import Decimal, ROUND_UP
 from urllib.parse import quote
 
 from django import forms
-from django.db import connection
 from django.db.models import TextField, PositiveSmallIntegerField, PositiveIntegerField, \
     DateTimeField, DecimalField
 from django.core.exceptions import PermissionDenied
 from django.contrib import admin, messages
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect
 from django.template.loader import get_template
-from django.template.defaultfilters import floatformat
 from django.template.response import TemplateResponse
 from django.conf import settings
 from django.shortcuts import render
@@ -33,6 +30,8 @@ from yandex_delivery.tasks import create_delivery_draft_order, get_delivery_opti
 
 from shop.models import ShopUserManager, ShopUser, Supplier, Order, OrderItem, Box, \
     Act, ActOrder, Contractor
+from shop.reports import XLSX_CONTENT_TYPE, get_order_products, get_product_demand, get_stock_allocation, \
+    write_product_demand, write_stock_allocation
 from shop.tasks import send_message
 
 from .forms import WarrantyCardPrintForm, OrderAdminForm, OrderCombineForm, \
@@ -393,7 +392,7 @@ class OrderAdmin(admin.ModelAdmin):
     def status1c(self, obj):
         if obj.status <= Order.STATUS_COLLECTED:
             return ''
-        if not obj.seller or not obj.buyer or not obj.wirehouse or not obj.wiring_date:
+        if not obj.seller_id or not obj.buyer_id or not obj.wirehouse_id or not obj.wiring_date:
             return '<span style="color: orange" title="Нет данных для проводки"><i class="far fa-calendar-times fa-sm"></i></span>'
         if obj.wiring_date == timezone.now().date():
             return '<span style="color: #2121ba" title="Проводка сегодня"><i class="far fa-calendar-plus fa-sm"></i></span>'
@@ -435,10 +434,7 @@ class OrderAdmin(admin.ModelAdmin):
 
     @mark_safe
     def credit_notice(self, obj):
-        credit_allowed = False
-        for item in obj.items.all():
-            credit_allowed = credit_allowed or item.product.credit_allowed
-        if credit_allowed:
+        if obj.items.filter(product__credit_allowed=True).exists():
             return '''
                    <div id="yandex-credit"></div>
                    <script src="https://static.yandex.net/kassa/pay-in-parts/ui/v1"></script>
@@ -540,7 +536,10 @@ class OrderAdmin(admin.ModelAdmin):
         return super().lookup_allowed(lookup, value)
 
     def get_queryset(self, request):
-        qs = super().get_queryset(request)
+        # related objects and totals used by list columns are fetched with the page query
+        qs = super().get_queryset(request).select_related(
+            'site__profile', 'integration', 'user', 'manager', 'courier', 'owner'
+        ).with_totals()
         if not request.user.is_superuser and request.user.has_perm('shop.change_order_spb'):
             qs = qs.filter(site__in=[6, 14])
         return qs
@@ -637,7 +636,7 @@ class OrderAdmin(admin.ModelAdmin):
     def document(self, request, id, template):
         if not request.user.is_staff:
             raise PermissionDenied
-        order = Order.objects.get(pk=id)
+        order = Order.objects.with_totals().get(pk=id)
         return render(request, 'shop/order/' + template + '.html', {
             'owner_info': getattr(settings, 'SHOP_OWNER_INFO', {}),
             'default_seller': config.sw_default_seller,
@@ -655,47 +654,17 @@ class OrderAdmin(admin.ModelAdmin):
     def order_product_list(self, request):
         if not request.user.is_staff:
             raise PermissionDenied
-        suppliers = Supplier.objects.filter(show_in_order=True)
-        list_of_ids = suppliers.values_list('id', flat=True)
-        format_strings = ','.join(['%s'] * len(list_of_ids))
         ids = request.GET.get('orders', '0')
-        where = ''
+        sort = request.GET.get('o', None)
+        order_ids = None
         if ids != '0':
-            where = ' WHERE shop_order.id IN (' + ids + ')'
-        sort = request.GET.get('o', 'shop_product.title')
-        cursor = connection.cursor()
-        inner_cursor = connection.cursor()
-        cursor.execute("""SELECT shop_product.id AS product_id, shop_product.article, shop_product.partnumber, shop_product.title,
-                          shop_product.comment_packer, shop_order.id AS order_id, shop_order.status AS order_status,
-                          SUM(shop_orderitem.quantity) AS quantity
-                          FROM shop_product
-                          INNER JOIN shop_orderitem ON (shop_product.id = shop_orderitem.product_id)
-                          INNER JOIN shop_order ON (shop_orderitem.order_id = shop_order.id)""" + where +
-                       """ GROUP BY shop_order.id, shop_product.id ORDER BY """ + sort)
+            order_ids = [int(order_id) for order_id in ids.split(',')]
+        statuses = dict(Order.STATUS_CHOICES)
         products = []
-        for row in cursor.fetchall():
-            columns = (x[0] for x in cursor.description)
-            product = dict(zip(columns, row))
-            product['order_status_value'] = dict(Order.STATUS_CHOICES)[product['order_status']]
-            product['order_status_color'] = dict(Order.STATUS_COLORS)[product['order_status']]
-            stock = ''
-            inner_cursor.execute("""SELECT supplier_id, quantity FROM shop_stock LEFT JOIN shop_supplier ON (shop_supplier.id = supplier_id)
-                                    WHERE product_id = %s AND supplier_id IN (%s) ORDER BY shop_supplier.order""" % (product['product_id'], format_strings), list_of_ids)
-            if inner_cursor.rowcount:
-                for row in inner_cursor.fetchall():
-                    stock = stock + ('%s:&nbsp;' % suppliers.get(pk=row[0]).code)
-                    if row[1] == 0:
-                        stock = stock + '<span style="color: #c00">'
-                    stock = stock + ('%s' % floatformat(row[1]))
-                    if row[1] == 0:
-                        stock = stock + '</span>'
-                    stock = stock + '<br/>'
-            else:
-                stock = '<span style="color: #ff0000">отсутствует</span>'
-            product['stock'] = stock
-            products.append(product)
-        cursor.close()
-        inner_cursor.close()
+        for product in get_order_products(order_ids, Supplier.objects.filter(show_in_order=True), sort):
+            products.append(dict(product._asdict(),
+                                 order_status_value=statuses[product.order_status],
+                                 order_status_color=Order.STATUS_COLORS[product.order_status]))
         return render(request, 'admin/shop/order/products.html', {
             'title': 'Товары для заказов',
             'products': products,
@@ -1147,106 +1116,16 @@ class OrderAdmin(admin.ModelAdmin):
                 aux_supplier = Supplier.objects.get(pk=request.POST.get('aux_supplier'))
             else:
                 aux_supplier = None
-            selected = request.POST.getlist(admin.helpers.ACTION_CHECKBOX_NAME)
-            cursor = connection.cursor()
-            inner_cursor = connection.cursor()
-            cursor.execute("""SELECT shop_product.id AS product_id, shop_product.article,
-                              SUM(shop_orderitem.quantity) AS quantity
-                              FROM shop_product
-                              INNER JOIN shop_orderitem ON (shop_product.id = shop_orderitem.product_id)
-                              INNER JOIN shop_order ON (shop_orderitem.order_id = shop_order.id)
-                              WHERE shop_order.id IN (""" + ','.join(selected) + """)
-                              GROUP BY shop_product.id ORDER BY shop_product.article""")
-            products = []
-            suppliers = [supplier_ur.id, supplier.id]
+            suppliers = [supplier_ur, supplier]
             if aux_supplier:
-                suppliers.append(aux_supplier.id)
-            supplier_ids = ','.join(map(str, suppliers))
-            has_missing = False
-            for row in cursor.fetchall():
-                columns = (x[0] for x in cursor.description)
-                product = dict(zip(columns, row))
-                stock = ''
-                inner_cursor.execute("""SELECT supplier_id, quantity, correction FROM shop_stock
-                                        LEFT JOIN shop_supplier ON (shop_supplier.id = supplier_id)
-                                        WHERE product_id = %s AND supplier_id IN (""" + supplier_ids + """)
-                                        ORDER BY shop_supplier.order""", (product['product_id'],))
-                quantity = float(product['quantity'])
-                available = 0
-                stock = 0
-                aux_stock = 0
-                if inner_cursor.rowcount:
-                    for row in inner_cursor.fetchall():
-                        if row[0] == supplier_ur.id:
-                            available = row[1] + row[2]
-                        if row[0] == supplier.id:
-                            stock = row[1] + row[2]
-                        if aux_supplier and row[0] == aux_supplier.id:
-                            aux_stock = row[1] + row[2]
-                if available < quantity:
-                    product['own'] = Decimal(available).quantize(Decimal('1'), rounding=ROUND_UP)
-                    if stock > 0:
-                        taken = min(stock, quantity - available)
-                        available += taken
-                        product['stock'] = Decimal(taken).quantize(Decimal('1'), rounding=ROUND_UP)
-                    if aux_stock > 0 and available < quantity:
-                        taken = min(aux_stock, quantity - available)
-                        available += taken
-                        product['aux_stock'] = Decimal(taken).quantize(Decimal('1'), rounding=ROUND_UP)
-                    if available < quantity:
-                        has_missing = True
-                        product['missing'] = quantity - available
-                else:
-                    product['own'] = product['quantity']
-                products.append(product)
-            cursor.close()
-            inner_cursor.close()
-            if not products:
+                suppliers.append(aux_supplier)
+            selected = request.POST.getlist(admin.helpers.ACTION_CHECKBOX_NAME)
+            allocation = get_stock_allocation(map(int, selected), suppliers)
+            if not allocation:
                 self.message_user(request, "Нет товаров для отгрузки у этого поставщика", level=messages.WARNING)
                 return
             else:
-                import io
-                import xlsxwriter
-
-                output = io.BytesIO()
-                workbook = xlsxwriter.Workbook(output)
-                sheet = workbook.add_worksheet(supplier.name)
-                idx = 0
-                for product in products:
-                    stock = product.get('stock', None)
-                    if stock:
-                        sheet.write(idx, 0, product['article'])
-                        sheet.write(idx, 1, product['stock'])
-                        idx += 1
-                if aux_supplier:
-                    sheet = workbook.add_worksheet(aux_supplier.name)
-                    idx = 0
-                    for product in products:
-                        aux_stock = product.get('aux_stock', None)
-                        if aux_stock:
-                            sheet.write(idx, 0, product['article'])
-                            sheet.write(idx, 1, aux_stock)
-                            idx += 1
-                sheet = workbook.add_worksheet(supplier_ur.name)
-                idx = 0
-                for product in products:
-                    own = product.get('own', None)
-                    if own and own > 0:
-                        sheet.write(idx, 0, product['article'])
-                        sheet.write(idx, 1, product['own'])
-                        idx += 1
-                if has_missing:
-                    sheet = workbook.add_worksheet('Нет на складах')
-                    idx = 0
-                    for product in products:
-                        missing = product.get('missing', None)
-                        if missing:
-                            sheet.write(idx, 0, product['article'])
-                            sheet.write(idx, 1, missing)
-                            idx += 1
-                workbook.close()
-
-                response = HttpResponse(output.getvalue(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+                response = FileResponse(write_stock_allocation(allocation, suppliers), content_type=XLSX_CONTENT_TYPE)
                 response['Content-Disposition'] = 'attachment; filename={0}-{2}.xlsx; filename*=UTF-8\'\'{1}-{2}.xlsx'.format(
                     'stock',
                     quote(supplier.code),
@@ -1272,30 +1151,8 @@ class OrderAdmin(admin.ModelAdmin):
         if not request.user.is_staff:
             raise PermissionDenied
         selected = request.POST.getlist(admin.helpers.ACTION_CHECKBOX_NAME)
-        cursor = connection.cursor()
-        cursor.execute("""SELECT shop_orderitem.product_id, shop_product.article, SUM(shop_orderitem.quantity) AS quantity
-                          FROM shop_orderitem INNER JOIN shop_product ON (shop_product.id = shop_orderitem.product_id)
-                          INNER JOIN shop_order ON (shop_orderitem.order_id = shop_order.id)
-                          WHERE shop_orderitem.order_id IN (""" + ','.join(selected) + """)
-                          GROUP BY shop_orderitem.product_id, shop_product.article""")
-        products = []
-        for row in cursor.fetchall():
-            columns = (x[0] for x in cursor.description)
-            product = dict(zip(columns, row))
-            products.append(product)
-        cursor.close()
-        import io
-        import xlsxwriter
-
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-        sheet = workbook.add_worksheet('Products')
-        for idx, product in enumerate(products):
-            sheet.write(idx, 0, product['article'])
-            sheet.write(idx, 1, product['quantity'])
-        workbook.close()
-
-        response = HttpResponse(output.getvalue(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        products = get_product_demand(map(int, selected))
+        response = FileResponse(write_product_demand(products), content_type=XLSX_CONTENT_TYPE)
         response['Content-Disposition'] = 'attachment; filename=products-{}.xlsx'.format(datetime.date.today().isoformat())
         return response
     order_products_action.short_description = "Выгрузка товаров"
@@ -467,7 +467,7 @@ class ProductAdmin(ImportExportMixin, SortableAdminBase, admin.ModelAdmin, Dynam
         obj.num = -1
         super().save_model(request, obj, form, change)
         # чистим кеши и обновляем мета-данные фоновой задачей
-        post_update_product.delay(obj.pk, 'admin')
+        post_update_product.delay(obj.pk)
 
     def save_related(self, request, form, formsets, change):
         # this is a hack to avoid stock saving for duplicated products (gives error if stock correction is not zero)
@@ -1,9 +1,15 @@
+import hashlib
 import math
+import time
+from bisect import bisect_right
 from collections import OrderedDict
+from operator import itemgetter
 
 from django import forms
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db.models import Count, Max, Min, OuterRef, Q, Subquery
 
 import django_filters
 from django_filters.widgets import SuffixedMultiWidget
@@ -84,18 +90,90 @@ class ShopRangeWidget(SuffixedMultiWidget):
         })
 
 
+FACETS_CACHE_TIMEOUT = 3600
+FACETS_VERSION_KEY = 'product-facets-version'
+BOOLEAN_FIELDS = frozenset(field.name for field in Product._meta.get_fields() if isinstance(field, models.BooleanField))
+
+
+def invalidate_product_facets():
+    cache.set(FACETS_VERSION_KEY, time.time_ns(), None)
+
+
+def get_product_facets(queryset, fields):
+    """ Provides product facets of queryset, facets are cached until any product or category changes """
+    if queryset.query.is_empty():
+        return {}
+    version = cache.get_or_set(FACETS_VERSION_KEY, time.time_ns, None)
+    signature = hashlib.md5('{}:{}'.format(','.join(sorted(fields)), queryset.query).encode('utf-8')).hexdigest()
+    key = 'product-facets:{}:{}'.format(version, signature)
+    facets = cache.get(key)
+    if facets is None:
+        facets = calculate_product_facets(queryset, fields)
+        cache.set(key, facets, FACETS_CACHE_TIMEOUT)
+    return facets
+
+
+def calculate_product_facets(queryset, fields):
+    """
+    Calculates price range, category and manufacturer product counts and boolean field counts
+    with grouped aggregates, choices are lists of (pk, name, count) sorted by name
+    """
+    queryset = queryset.order_by()
+    facets = {}
+
+    aggregates = {}
+    if 'price' in fields:
+        aggregates['price_min'] = Min('price')
+        aggregates['price_max'] = Max('price')
+    for name in fields:
+        if name in BOOLEAN_FIELDS:
+            aggregates[name] = Count('pk', filter=Q(**{name: True}), distinct=True)
+    if aggregates:
+        values = queryset.aggregate(**aggregates)
+        if 'price' in fields:
+            price_min = values.pop('price_min')
+            price_max = values.pop('price_max')
+            facets['price'] = {
+                'min': int(price_min) if price_min is not None else None,
+                'max': int(price_max) if price_max is not None else None
+            }
+        facets.update(values)
+
+    if 'manufacturer' in fields:
+        counts = dict(queryset.values('manufacturer').annotate(count=Count('pk', distinct=True)).values_list('manufacturer', 'count'))
+        facets['manufacturer'] = sorted([(pk, name, counts[pk]) for pk, name in
+                                         Manufacturer.objects.filter(pk__in=counts.keys()).values_list('pk', 'name')], key=itemgetter(1))
+
+    if 'categories' in fields:
+        root = Category.objects.get(slug=settings.MPTT_ROOT)
+        # product belongs to the top level category of its (optionally) not hidden category, the deepest or first sibling
+        category = Category.objects.filter(product=OuterRef('pk'), tree_id=root.tree_id, active=True).order_by('hidden', '-level', 'lft')
+        counts = queryset.annotate(category_lft=Subquery(category.values('lft')[:1])).values('category_lft') \
+            .annotate(count=Count('pk', distinct=True)).values_list('category_lft', 'count')
+        top_categories = list(root.get_children().values_list('lft', 'rght', 'pk', 'name'))
+        lfts = [category[0] for category in top_categories]
+        categories = {}
+        for lft, count in counts:
+            if lft is None:
+                continue
+            idx = bisect_right(lfts, lft) - 1
+            if idx < 0 or top_categories[idx][1] < lft:
+                continue
+            _, _, pk, name = top_categories[idx]
+            categories[pk] = (pk, name, categories.get(pk, (pk, name, 0))[2] + count)
+        facets['categories'] = sorted(categories.values(), key=itemgetter(1))
+
+    return facets
+
+
 def categories(request):
     categories = {}
-    root = Category.objects.get(slug=settings.MPTT_ROOT)
     if request is None:
+        root = Category.objects.get(slug=settings.MPTT_ROOT)
         for category in root.get_children():
             categories[category.pk] = str(category)
     else:
-        for product in request.qs.iterator():
-            category = product.categories.filter(tree_id=root.tree_id, active=True).order_by('hidden', '-level', 'lft').first()
-            if category:
-                ancestors = category.get_ancestors(include_self=True)
-                categories[ancestors[1].pk] = str(ancestors[1])
+        return [(pk, name) for pk, name, _ in request.facets.get('categories', [])]
 
     categories = [(k, categories[k]) for k in sorted(categories, key=categories.get)]
     return categories
@@ -107,8 +185,7 @@ def manufacturers(request):
         for manufacturer in Manufacturer.objects.all().iterator():
             manufacturers[manufacturer.pk] = str(manufacturer)
     else:
-        for product in request.qs.iterator():
-            manufacturers[product.manufacturer.pk] = str(product.manufacturer)
+        return [(pk, name) for pk, name, _ in request.facets.get('manufacturer', [])]
 
     manufacturers = [(k, manufacturers[k]) for k in sorted(manufacturers, key=manufacturers.get)]
     return manufacturers
@@ -212,42 +289,33 @@ def get_product_filter(data=None, *args, **kwargs):
     #     kwargs['fields'] = tuple(x for x in kwargs['fields'] if x != '_div_')
     # get a mutable copy of the QueryDict
     data = data.copy()
-    price_min = 1000000000
-    price_max = 0
+    facets = get_product_facets(kwargs['queryset'], kwargs['fields'])
     if 'price' in kwargs['fields']:
         if not data.get('price_max'):
             data['_initial'] = True
-        for product in kwargs['queryset'].iterator():
-            if product.price < price_min:
-                price_min = int(product.price)
-            if product.price > price_max:
-                price_max = int(product.price)
 
     if kwargs['request']:
         request = kwargs['request']
         request.qs = kwargs['queryset']
+        request.facets = facets
 
     meta = type('Meta', (BaseProductMetaclass,), {'fields': kwargs['fields']})
     filter_class = type('ProductFilterSet', (BaseProductFilter,), {'Meta': meta})
     product_filter = filter_class(data, *args, **kwargs)
+    product_filter.facets = facets
 
     if 'price' in kwargs['fields']:
-        if price_min <= price_max:
-            product_filter.form.fields['price'].widget.setRange(price_min, price_max)
+        price = facets.get('price', {})
+        if price.get('min') is not None:
+            product_filter.form.fields['price'].widget.setRange(price['min'], price['max'])
             # product_filter.filters['price'].field.widget.setRange(price_min, price_max)
         else:
             product_filter.form.fields['price'].widget.setRange(0, 1000000)  # todo: find proper max price
 
         if not data.get('price_max'):
-            price_min = 1000000000
-            price_max = 0
-            for product in product_filter.qs.iterator():
-                if product.price < price_min:
-                    price_min = int(product.price)
-                if product.price > price_max:
-                    price_max = int(product.price)
-            if price_min <= price_max:
-                data['price_min'] = price_min
-                data['price_max'] = price_max
+            price = get_product_facets(product_filter.qs, ['price']).get('price', {})
+            if price.get('min') is not None:
+                data['price_min'] = price['min']
+                data['price_max'] = price['max']
 
     return product_filter
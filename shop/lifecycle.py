@@ -0,0 +1,111 @@
+import logging
+import time
+
+from importlib import import_module
+from itertools import batched
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from shop.models import ShopUser, Basket, BasketItem
+
+EXPIRY_BATCH_SIZE = 1000
+DB_SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
+expired_rows = Counter('shop_expired_rows_total', 'Rows deleted by expiry jobs', ['table'])
+batch_duration = Histogram('shop_expiry_batch_duration_seconds', 'Duration of expiry job batches', ['job'])
+job_duration = Gauge('shop_expiry_job_duration_seconds', 'Duration of the last run of expiry job', ['job'])
+job_rows = Gauge('shop_expiry_job_rows', 'Rows processed by the last run of expiry job', ['job'])
+job_completed = Gauge('shop_expiry_job_last_completed_timestamp_seconds', 'Completion time of the last run of expiry job', ['job'])
+
+log = logging.getLogger('shop')
+
+
+def delete_in_batches(job, select, deletes, params, batch_size=EXPIRY_BATCH_SIZE):
+    """
+    Deletes rows in chunks of batch_size, each chunk in its own transaction: select query returns keys of the
+    chunk, deletes are (table, query) pairs executed with the keys as the only parameter. Returns total number
+    of rows deleted from each table.
+    """
+    start = time.monotonic()
+    totals = dict.fromkeys([table for table, query in deletes], 0)
+    while True:
+        with batch_duration.labels(job).time(), transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(select + ' LIMIT %s FOR UPDATE SKIP LOCKED', params + [batch_size])
+            keys = [row[0] for row in cursor.fetchall()]
+            for table, query in deletes if keys else ():
+                cursor.execute(query, [keys])
+                totals[table] += cursor.rowcount
+                expired_rows.labels(table).inc(cursor.rowcount)
+        if keys:
+            log.debug('{}: processed {} rows, {}'.format(job, len(keys), totals))
+        if len(keys) < batch_size:
+            break
+    job_duration.labels(job).set(time.monotonic() - start)
+    job_rows.labels(job).set(sum(totals.values()))
+    job_completed.labels(job).set_to_current_time()
+    return totals
+
+
+def delete_outdated_baskets(threshold, batch_size=EXPIRY_BATCH_SIZE):
+    """ Deletes baskets created before threshold with their items, returns number of deleted baskets and items """
+    totals = delete_in_batches(
+        'baskets',
+        'SELECT id FROM shop_basket WHERE created < %s ORDER BY id',
+        [('shop_basketitem', 'DELETE FROM shop_basketitem WHERE basket_id = ANY(%s)'),
+         ('shop_basket', 'DELETE FROM shop_basket WHERE id = ANY(%s)')],
+        [threshold],
+        batch_size
+    )
+    return totals['shop_basket'], totals['shop_basketitem']
+
+
+def clear_expired_sessions(batch_size=EXPIRY_BATCH_SIZE):
+    """ Deletes expired database sessions detaching baskets from them, other engines clear sessions themselves """
+    if settings.SESSION_ENGINE != DB_SESSION_ENGINE:
+        import_module(settings.SESSION_ENGINE).SessionStore.clear_expired()
+        return None
+    totals = delete_in_batches(
+        'sessions',
+        'SELECT session_key FROM django_session WHERE expire_date < %s ORDER BY expire_date',
+        [('shop_basket', 'UPDATE shop_basket SET session_id = NULL WHERE session_id = ANY(%s)'),
+         ('django_session', 'DELETE FROM django_session WHERE session_key = ANY(%s)')],
+        [timezone.now()],
+        batch_size
+    )
+    return totals['django_session']
+
+
+def get_abandoned_baskets(created_gte, created_lt, batch_size=EXPIRY_BATCH_SIZE):
+    """
+    Yields (basket id, user email, user phone) of non-empty primary baskets created in given period. Baskets
+    are read together with their sessions by one query, session users are fetched once per batch. Session
+    data is encoded, so user id is taken from it after decoding.
+    """
+    now = timezone.now()
+    baskets = Basket.objects.filter(
+        secondary=False,
+        created__lt=created_lt,
+        created__gte=created_gte
+    ).filter(
+        Exists(BasketItem.objects.filter(basket=OuterRef('pk')))
+    ).select_related('session').only('id', 'phone', 'session__session_data', 'session__expire_date').order_by('id')
+    for batch in batched(baskets.iterator(chunk_size=batch_size), batch_size):
+        uids = {}
+        for basket in batch:
+            if basket.session is not None and basket.session.expire_date > now:
+                uid = basket.session.get_decoded().get('_auth_user_id')
+                if uid:
+                    uids[basket.id] = int(uid)
+        users = ShopUser.objects.only('id', 'email', 'phone').in_bulk(set(uids.values()))
+        for basket in batch:
+            user = users.get(uids.get(basket.id))
+            email = user.email if user is not None and user.email else None
+            phone = user.phone if user is not None and user.phone else None
+            if phone is None and basket.phone:
+                phone = basket.phone
+            yield basket.id, email, phone
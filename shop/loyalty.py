@@ -0,0 +1,111 @@
+import csv
+import io
+import logging
+import re
+
+from datetime import datetime
+from itertools import batched
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from shop.models import ShopUserManager
+
+LOYALTY_BATCH_SIZE = 5000
+
+log = logging.getLogger('shop')
+
+
+def parse_number(value):
+    return float(value.replace('\xA0', '').replace(' ', '').replace(',', '.'))
+
+
+def parse_bonus_records(records):
+    """
+    Yields (phone, name, bonuses, expiring bonuses, expiration date) of loyalty file records, expiring
+    bonuses and expiration date are None if they are not given, name is empty if it is not a real name
+    """
+    for line in records:
+        try:
+            if line['ШтрихКод'] and line['КоличествоБаллов']:
+                bonuses = parse_number(line['КоличествоБаллов'])
+                if bonuses < 0:
+                    continue
+                expiring_bonuses = None
+                expiration_date = None
+                if line['КСписанию']:
+                    expiring_bonuses = int(parse_number(line['КСписанию']))
+                    if line['ДатаСписания']:
+                        expiration_date = timezone.make_aware(datetime.strptime(line['ДатаСписания'], '%d.%m.%Y %H:%M:%S'))
+                name = line['ФИО']
+                if name and not name.startswith('Держатель карты'):
+                    name = re.sub(r'[:,]?\s?(?:Штрихкод)?:?\s?\d+', '', name).title()
+                else:
+                    name = ''
+                yield ShopUserManager.normalize_phone(line['ШтрихКод']), name, int(bonuses), expiring_bonuses, expiration_date
+        except ValueError:
+            log.error("Wrong bonus number '%s' for '%s'" % (line['КоличествоБаллов'], line['ШтрихКод']))
+
+
+def copy_bonus_records(cursor, records, batch_size):
+    """ Copies records to temporary table in chunks, line number is kept to let the last record of a phone win """
+    num = 0
+    for chunk in batched(records, batch_size):
+        data = io.StringIO()
+        writer = csv.writer(data)
+        for record in chunk:
+            num += 1
+            writer.writerow((num,) + record)
+        data.seek(0)
+        cursor.copy_expert("""COPY loyalty_bonuses (line, phone, name, bonuses, expiring_bonuses, expiration_date)
+                              FROM STDIN WITH (FORMAT csv)""", data)
+    return num
+
+
+def load_user_bonuses(records, batch_size=LOYALTY_BATCH_SIZE):
+    """
+    Loads parsed loyalty records: users are created or updated in batches by upserts from temporary table,
+    expiring bonuses and expiration date are kept if they are not given, name is set only if user has none.
+    Bonuses of users missing in the records are zeroed. Returns numbers of created, updated and zeroed users.
+    """
+    result = {'created': 0, 'updated': 0, 'zeroed': 0}
+    with connection.cursor() as cursor:
+        cursor.execute("""DROP TABLE IF EXISTS loyalty_bonuses""")
+        cursor.execute("""CREATE TEMPORARY TABLE loyalty_bonuses (
+                              line integer PRIMARY KEY, phone varchar(30) NOT NULL, name varchar(100),
+                              bonuses integer NOT NULL, expiring_bonuses integer, expiration_date timestamp with time zone
+                          )""")
+        try:
+            num = copy_bonus_records(cursor, records, batch_size)
+            cursor.execute("""DELETE FROM loyalty_bonuses a USING loyalty_bonuses b WHERE a.phone = b.phone AND a.line < b.line""")
+            cursor.execute("""CREATE UNIQUE INDEX ON loyalty_bonuses (phone)""")
+            cursor.execute("""ANALYZE loyalty_bonuses""")
+            log.info('Loaded %d loyalty records' % num)
+
+            for start in range(0, num, batch_size):
+                with transaction.atomic():
+                    # expiring bonuses and expiration date of existing users are kept if they are not given,
+                    # xmax of a row is zero if it is inserted and not updated
+                    cursor.execute("""INSERT INTO shop_shopuser (password, is_superuser, phone, name, email, postcode, city, address,
+                                                                 discount, bonuses, expiring_bonuses, expiration_date, is_active,
+                                                                 is_staff, permanent_password, date_joined, tags)
+                                      SELECT '', FALSE, phone, COALESCE(name, ''), '', '', '', '', 0, bonuses,
+                                             COALESCE(expiring_bonuses, 0), expiration_date, TRUE, FALSE, FALSE, %s, ''
+                                      FROM loyalty_bonuses WHERE line > %s AND line <= %s
+                                      ON CONFLICT (phone) DO UPDATE SET
+                                          bonuses = EXCLUDED.bonuses,
+                                          expiring_bonuses = COALESCE((SELECT expiring_bonuses FROM loyalty_bonuses
+                                                                       WHERE phone = EXCLUDED.phone), shop_shopuser.expiring_bonuses),
+                                          expiration_date = COALESCE(EXCLUDED.expiration_date, shop_shopuser.expiration_date),
+                                          name = CASE WHEN shop_shopuser.name = '' THEN EXCLUDED.name ELSE shop_shopuser.name END
+                                      RETURNING xmax = 0""", [timezone.now(), start, start + batch_size])
+                    for created, in cursor.fetchall():
+                        result['created' if created else 'updated'] += 1
+                log.debug('Loaded bonuses of %d users' % (result['created'] + result['updated']))
+
+            cursor.execute("""UPDATE shop_shopuser SET bonuses = 0
+                              WHERE bonuses > 0 AND NOT EXISTS (SELECT 1 FROM loyalty_bonuses WHERE loyalty_bonuses.phone = shop_shopuser.phone)""")
+            result['zeroed'] = cursor.rowcount
+        finally:
+            cursor.execute("""DROP TABLE IF EXISTS loyalty_bonuses""")
+    return result
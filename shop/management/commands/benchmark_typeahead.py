@@ -0,0 +1,51 @@
+import time
+
+from urllib.parse import quote
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from sewingworld.typeahead import TYPEAHEAD_MIN_LENGTH, get_typeahead_limit, get_typeahead_products, suggestions
+
+
+class Command(BaseCommand):
+    help = 'Compare latency of typeahead API with full text search product list'
+
+    def add_arguments(self, parser):
+        parser.add_argument('terms', nargs='+', help='search terms')
+        parser.add_argument('--site', default='www.sewing-world.ru', help='site domain')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--cold', action='store_true', help='clear in-process typeahead cache before each request')
+        parser.add_argument('--explain', action='store_true', help='print query plans of typeahead lookups instead of timing requests')
+
+    def explain(self, domain, terms):
+        site = Site.objects.select_related('profile').get(domain=domain)
+        for term in terms:
+            if len(term) < TYPEAHEAD_MIN_LENGTH:
+                self.stdout.write('{}: shorter than {} characters, no query'.format(term, TYPEAHEAD_MIN_LENGTH))
+                continue
+            self.stdout.write('{}:\n{}'.format(term, get_typeahead_products(site, term, get_typeahead_limit(site)).explain(analyze=True)))
+
+    def handle(self, *args, **options):
+        if options['explain']:
+            return self.explain(options['site'], options['terms'])
+        client = Client(HTTP_HOST=options['site'])
+        paths = (
+            ('text', '/api/v0/products/?text={}&ta=1'),
+            ('typeahead', '/api/v0/products/typeahead/?text={}')
+        )
+        for name, path in paths:
+            timings = []
+            for _ in range(options['repeat']):
+                for term in options['terms']:
+                    if options['cold']:
+                        suggestions.entries.clear()
+                    start = time.perf_counter()
+                    response = client.get(path.format(quote(term)))
+                    timings.append((time.perf_counter() - start) * 1000)
+                    if response.status_code != 200:
+                        self.stderr.write('{} {}: {}'.format(name, term, response.status_code))
+            timings.sort()
+            self.stdout.write('{}: {} requests, p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+                name, len(timings), timings[len(timings) // 2], timings[int(len(timings) * 0.99)], timings[-1]))
@@ -0,0 +1,19 @@
+from itertools import batched
+
+from django.core.management.base import BaseCommand
+from shop.models import Product, ProductAvailability
+
+
+class Command(BaseCommand):
+    help = 'Rebuild materialized product availability'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        num = 0
+        products = Product.objects.order_by('pk').values_list('pk', flat=True)
+        for chunk in batched(products.iterator(), options['batch_size']):
+            num = num + len(ProductAvailability.objects.update_products(chunk))
+
+        self.stdout.write('Successfully updated availability of %d products' % num)
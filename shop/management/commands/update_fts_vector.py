@@ -1,14 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import batched
+
 from django.core.management.base import BaseCommand
+from django.db import connection
 from shop.models import Product
 
 
+def update_range(bounds):
+    try:
+        return Product.objects.filter(pk__range=bounds).update(fts_vector=Product.fts_vector_expression())
+    finally:
+        connection.close()  # each worker thread has its own connection
+
+
 class Command(BaseCommand):
     help = 'Update product search vectors'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=int, default=0, help='first product id, e.g. to resume interrupted indexing')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--jobs', type=int, default=1, help='number of batches updated in parallel')
+
     def handle(self, *args, **options):
-        num = 0
-        for product in Product.objects.all():
-            product.update_fts_vector()
-            num = num + 1
+        products = Product.objects.filter(pk__gte=options['since']).order_by('pk').values_list('pk', flat=True)
+        ranges = [(chunk[0], chunk[-1]) for chunk in batched(products.iterator(), options['batch_size'])]
+        with ThreadPoolExecutor(max_workers=options['jobs']) as executor:
+            num = sum(executor.map(update_range, ranges))
 
         self.stdout.write('Successfully indexed %d products' % num)
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.18 on 2026-10-18 18:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0002_alter_domain_unique'),
+        ('shop', '0258_favorites_site'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductAvailability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.FloatField(default=0, verbose_name='наличие')),
+                ('express_quantity', models.FloatField(default=0, verbose_name='наличие Экспресс')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='обновлено')),
+                ('integration', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='availability', to='shop.integration', verbose_name='интеграция')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='availability', to='shop.product')),
+                ('site', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='sites.site', verbose_name='сайт')),
+            ],
+            options={
+                'verbose_name': 'наличие товара',
+                'verbose_name_plural': 'наличие товаров',
+                'indexes': [models.Index(fields=['product', 'integration'], name='shop_produc_product_bb2511_idx'), models.Index(fields=['integration', 'product'], name='shop_produc_integra_3d35d9_idx')],
+            },
+        ),
+    ]
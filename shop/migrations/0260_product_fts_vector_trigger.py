@@ -0,0 +1,49 @@
+# Generated by Django 4.2.18 on 2026-10-18 21:05
+
+from django.db import migrations
+
+# search vector is maintained by database for any insert or update of indexed fields, including bulk updates
+# of 1C import and import-export, vector weights and config are the same as in Product.fts_vector_expression()
+CREATE_TRIGGER = """
+CREATE OR REPLACE FUNCTION shop_product_fts_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.fts_vector :=
+        setweight(to_tsvector('russian'::regconfig, COALESCE(NEW.title, '') || ' ' || COALESCE(NEW.code, '') || ' ' ||
+                              COALESCE(NEW.article, '') || ' ' || COALESCE(NEW.partnumber, '')), 'A') ||
+        setweight(to_tsvector('russian'::regconfig, COALESCE(NEW.whatis, '') || ' ' || COALESCE(NEW.shortdescr, '')), 'B') ||
+        setweight(to_tsvector('russian'::regconfig, COALESCE(NEW.descr, '') || ' ' || COALESCE(NEW.spec, '')), 'D');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER shop_product_fts_vector_insert
+    BEFORE INSERT ON shop_product
+    FOR EACH ROW EXECUTE FUNCTION shop_product_fts_vector();
+
+CREATE TRIGGER shop_product_fts_vector_update
+    BEFORE UPDATE OF title, code, article, partnumber, whatis, shortdescr, descr, spec, fts_vector ON shop_product
+    FOR EACH ROW
+    WHEN (OLD.title IS DISTINCT FROM NEW.title OR OLD.code IS DISTINCT FROM NEW.code OR
+          OLD.article IS DISTINCT FROM NEW.article OR OLD.partnumber IS DISTINCT FROM NEW.partnumber OR
+          OLD.whatis IS DISTINCT FROM NEW.whatis OR OLD.shortdescr IS DISTINCT FROM NEW.shortdescr OR
+          OLD.descr IS DISTINCT FROM NEW.descr OR OLD.spec IS DISTINCT FROM NEW.spec OR
+          OLD.fts_vector IS DISTINCT FROM NEW.fts_vector)
+    EXECUTE FUNCTION shop_product_fts_vector();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS shop_product_fts_vector_update ON shop_product;
+DROP TRIGGER IF EXISTS shop_product_fts_vector_insert ON shop_product;
+DROP FUNCTION IF EXISTS shop_product_fts_vector();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0259_productavailability'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+    ]
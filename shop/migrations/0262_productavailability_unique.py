@@ -0,0 +1,31 @@
+# Generated by Django 4.2.18 on 2026-10-18 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0261_product_typeahead_indexes'),
+    ]
+
+    operations = [
+        # duplicates left by concurrent recalculations, the latest row wins
+        migrations.RunSQL(
+            """DELETE FROM shop_productavailability a USING shop_productavailability b
+               WHERE a.product_id = b.product_id AND a.integration_id IS NOT DISTINCT FROM b.integration_id AND a.id < b.id""",
+            migrations.RunSQL.noop
+        ),
+        migrations.RemoveIndex(
+            model_name='productavailability',
+            name='shop_produc_product_bb2511_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='productavailability',
+            constraint=models.UniqueConstraint(fields=('product', 'integration'), name='shop_productavailability_product_integration_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='productavailability',
+            constraint=models.UniqueConstraint(condition=models.Q(('integration__isnull', True)), fields=('product',), name='shop_productavailability_product_storefront_uniq'),
+        ),
+    ]
@@ -6,12 +6,18 @@ from .other import *  # NOQA
 from .other import __all__ as other_all
 from .product import *  # NOQA
 from .product import __all__ as product_all
+from .kit import *  # NOQA
+from .kit import __all__ as kit_all
 from .integration import *  # NOQA
 from .integration import __all__ as integration_all
 from .basket import *  # NOQA
 from .basket import __all__ as basket_all
+from .pricing import *  # NOQA
+from .pricing import __all__ as pricing_all
 from .order import *  # NOQA
 from .order import __all__ as order_all
+from .availability import *  # NOQA
+from .availability import __all__ as availability_all
 from .act import *  # NOQA
 from .act import __all__ as act_all
 from .serial import *  # NOQA
@@ -22,9 +28,12 @@ __all__ = [
     *bonus_all,
     *other_all,
     *product_all,
+    *kit_all,
     *integration_all,
     *basket_all,
+    *pricing_all,
     *order_all,
+    *availability_all,
     *act_all,
     *serial_all
 ]
@@ -0,0 +1,171 @@
+import logging
+
+from collections import defaultdict
+
+from django.contrib.sites.models import Site
+from django.db import models, transaction
+from django.db.models import FloatField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.dispatch import Signal
+
+from . import Product, Stock, Supplier, Integration, Order, OrderItem, KitGraph
+from .kit import kit_quantity
+
+__all__ = [
+    'ProductAvailability'
+]
+
+logger = logging.getLogger(__name__)
+
+
+""" sent with list of product ids which availability has changed """
+availability_changed = Signal()
+
+
+class ProductAvailabilityManager(models.Manager):
+    def annotate_products(self, queryset, integration=None, express=False, name='available'):
+        """ Annotates product queryset with materialized availability, storefront one if integration is not given """
+        availability = self.filter(product=OuterRef('pk'), integration=integration)
+        field = 'express_quantity' if express else 'quantity'
+        return queryset.annotate(**{name: Coalesce(Subquery(availability.values(field)[:1]), 0.0, output_field=FloatField())})
+
+    def compute(self, product_ids, graph=None):
+        """
+        Computes availability the same way as Product.get_stock() does but with fixed number of queries.
+        Kits containing given products are included in the result. Returns dict of product id to dict of
+        integration id (None for storefront) to (site id, quantity, express quantity).
+        """
+        if graph is None:
+            graph = KitGraph(product_ids)
+        ids = graph.ids
+        kits = graph.kits
+
+        stock = defaultdict(dict)
+        for product_id, supplier_id, quantity, correction in Stock.objects.filter(product_id__in=ids - kits.keys()) \
+                .values_list('product_id', 'supplier_id', 'quantity', 'correction'):
+            stock[product_id][supplier_id] = quantity + correction
+
+        reserved = defaultdict(dict)
+        for product_id, site_id, quantity in OrderItem.objects.filter(product_id__in=stock.keys(), order__status__in=Order.RESERVING_STATUSES) \
+                .values('product_id', 'order__site_id').annotate(reserved=Sum('quantity')).order_by() \
+                .values_list('product_id', 'order__site_id', 'reserved'):
+            reserved[product_id][site_id] = float(quantity)
+
+        suppliers = {pk: (count, express) for pk, count, express in Supplier.objects.values_list('id', 'count_in_stock', 'express_count_in_stock')}
+        integrations = {pk: (site_id, set()) for pk, site_id in Integration.objects.values_list('id', 'site_id')}
+        for integration_id, supplier_id in Integration.suppliers.through.objects.values_list('integration_id', 'supplier_id'):
+            integrations[integration_id][1].add(supplier_id)
+        default_sites = {Site.objects.get(domain='www.sewing-world.ru').id}
+        storefront_sites = set(Site.objects.filter(integration__isnull=True).values_list('id', flat=True))
+
+        def available(product_id, supplier_ids):
+            quantities = stock[product_id]
+            supplier_ids = supplier_ids & quantities.keys()
+            num = sum(quantities[supplier_id] for supplier_id in supplier_ids)
+            if num > 0:
+                sites = set(default_sites)
+                for site_id, integration_suppliers in integrations.values():
+                    if integration_suppliers & supplier_ids:
+                        sites.add(site_id)
+                if any(suppliers[supplier_id][0] == Supplier.COUNT_STOCK for supplier_id in supplier_ids):
+                    sites |= storefront_sites
+                num -= sum(reserved[product_id].get(site_id, 0) for site_id in sites)
+                if num < 0:
+                    num = 0
+            return num
+
+        counted = {pk for pk, (count, _) in suppliers.items() if count == Supplier.COUNT_STOCK}
+        express = {pk for pk, (_, count) in suppliers.items() if count == Supplier.COUNT_STOCK}
+
+        result = {}
+        for product_id in ids - kits.keys():
+            values = {None: (None, available(product_id, counted), available(product_id, counted & express))}
+            if product_id in stock:
+                for integration_id, (site_id, integration_suppliers) in integrations.items():
+                    values[integration_id] = (site_id, available(product_id, integration_suppliers),
+                                              available(product_id, integration_suppliers & express))
+            result[product_id] = values
+
+        for product_id, num in graph.evaluate(lambda product_id: int(result[product_id][None][1]), kit_quantity).items():
+            values = {None: (None, num, num)}
+            if num:
+                for integration_id, (site_id, _) in integrations.items():
+                    values[integration_id] = (site_id, num, num)
+            result[product_id] = values
+
+        return result
+
+    def update_products(self, product_ids):
+        """
+        Recalculates availability of given products and kits containing them, mirrors storefront availability
+        to Product.num and returns list of product ids which availability has changed. Rows of all products
+        of the kit graph are locked before availability is computed, so concurrent calls for the same products
+        are serialized and the last one writes availability computed from the latest stock.
+        """
+        with transaction.atomic():
+            graph = KitGraph(product_ids)
+            nums = dict(Product.objects.select_for_update().filter(pk__in=graph.ids).order_by('pk').values_list('id', 'num'))
+            values = self.compute(product_ids, graph)
+            if not values:
+                return []
+
+            current = defaultdict(dict)
+            for product_id, integration_id, quantity, express_quantity in self.filter(product_id__in=values.keys()) \
+                    .values_list('product_id', 'integration_id', 'quantity', 'express_quantity'):
+                current[product_id][integration_id] = (quantity, express_quantity)
+
+            changed = []
+            for product_id, product_values in values.items():
+                availability = {integration_id: (quantity, express_quantity)
+                                for integration_id, (_, quantity, express_quantity) in product_values.items()
+                                if quantity or express_quantity}
+                if availability != current[product_id]:
+                    changed.append(product_id)
+
+            if changed:
+                self.filter(product_id__in=changed).delete()
+                self.bulk_create([
+                    self.model(product_id=product_id, integration_id=integration_id, site_id=site_id,
+                               quantity=quantity, express_quantity=express_quantity)
+                    for product_id in changed
+                    for integration_id, (site_id, quantity, express_quantity) in values[product_id].items()
+                    if quantity or express_quantity
+                ], batch_size=1000)
+
+            products = []
+            for product_id, num in nums.items():
+                available = max(int(values[product_id][None][1]), 0)
+                if num != available:
+                    products.append(Product(pk=product_id, num=available))
+            Product.objects.bulk_update(products, ['num'], batch_size=1000)
+
+        if changed:
+            logger.info("Availability changed for {} products".format(len(changed)))
+            availability_changed.send(sender=self.model, product_ids=changed)
+        return changed
+
+
+class ProductAvailability(models.Model):
+    product = models.ForeignKey(Product, related_name='availability', on_delete=models.CASCADE)
+    integration = models.ForeignKey(Integration, verbose_name='интеграция', related_name='availability', blank=True, null=True, on_delete=models.CASCADE)
+    site = models.ForeignKey(Site, verbose_name='сайт', related_name='+', blank=True, null=True, on_delete=models.CASCADE)
+    quantity = models.FloatField('наличие', default=0)
+    express_quantity = models.FloatField('наличие Экспресс', default=0)
+    updated = models.DateTimeField('обновлено', auto_now=True)
+
+    objects = ProductAvailabilityManager()
+
+    class Meta:
+        verbose_name = 'наличие товара'
+        verbose_name_plural = 'наличие товаров'
+        indexes = [
+            models.Index(fields=['integration', 'product'])
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'integration'], name='shop_productavailability_product_integration_uniq'),
+            models.UniqueConstraint(fields=['product'], condition=models.Q(integration__isnull=True),
+                                    name='shop_productavailability_product_storefront_uniq')
+        ]
+
+    def __str__(self):
+        return str(self.product_id)
@@ -1,10 +1,12 @@
 import datetime
+import time
 
 from decimal import Decimal, ROUND_UP, ROUND_HALF_EVEN
 
 from django.contrib.humanize.templatetags.humanize import intcomma
 from django.contrib.sessions.models import Session
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.db import models
 from django.utils import timezone
 from django.utils.functional import cached_property
@@ -15,6 +17,61 @@ __all__ = [
     'Basket', 'BasketItem', 'Favorites'
 ]
 
+USER_DISCOUNTS_VERSION_KEY = 'user_discounts_version'
+USER_DISCOUNT_TIMEOUT = 3600
+
+
+def resolve_user_discount(session_key, phone):
+    """ Returns maximum of session (promo) discount and discounts of session user and user with basket phone """
+    session_data = {}
+    if session_key is not None:
+        try:
+            session_data = Session.objects.get(session_key=session_key).get_decoded()
+        except Session.DoesNotExist:
+            pass
+    discount = session_data.get('discount', 0)
+    # if session contains valid user, get his discount
+    uid = session_data.get('_auth_user_id')
+    if uid is not None:
+        user_discount = ShopUser.objects.filter(id=uid).values_list('discount', flat=True).first()
+        if user_discount is not None and user_discount > discount:
+            return user_discount
+    # if no user data available return session discount
+    if not phone:
+        return discount
+    # if there is a user with such phone get his discount
+    user_discount = ShopUser.objects.filter(phone=ShopUserManager.normalize_phone(phone)).values_list('discount', flat=True).first()
+    if user_discount is not None and user_discount > discount:
+        return user_discount
+    return discount
+
+
+def get_user_discount(session_key, phone):
+    """
+    Returns effective user discount of a basket cached per session. Version and cached discount are fetched
+    by one cache request, version is changed when user discounts change, session entry is deleted when
+    session discount is changed.
+    """
+    key = 'user_discount_{}'.format(session_key)
+    cached = cache.get_many([USER_DISCOUNTS_VERSION_KEY, key])
+    version = cached.get(USER_DISCOUNTS_VERSION_KEY)
+    if version is None:
+        version = time.time_ns()
+        cache.add(USER_DISCOUNTS_VERSION_KEY, version, None)
+    elif cached.get(key, (None,))[:2] == (version, phone):
+        return cached[key][2]
+    discount = resolve_user_discount(session_key, phone)
+    cache.set(key, (version, phone, discount), USER_DISCOUNT_TIMEOUT)
+    return discount
+
+
+def invalidate_user_discount(session_key):
+    cache.delete('user_discount_{}'.format(session_key))
+
+
+def invalidate_user_discounts():
+    cache.set(USER_DISCOUNTS_VERSION_KEY, time.time_ns(), None)
+
 
 class Basket(models.Model):
     session = models.ForeignKey(Session, null=True, on_delete=models.SET_NULL)
@@ -31,7 +88,7 @@ class Basket(models.Model):
     @classmethod
     def product_pct_discount(cls, site, product, user_discount):
         """ Calculates maximum percent discount based on product, user discount and maximum allowed discount """
-        site_price = product.site_prices.filter(site=site).first()
+        site_price = product.get_site_price(site)
         if site_price is not None:
             pd = site_price.pct_discount
         elif site.profile.wholesale:
@@ -65,7 +122,7 @@ class Basket(models.Model):
                 qnt = Decimal('1')
             pd = (price.quantize(qnt, rounding=ROUND_UP) * Decimal(pct / 100)).quantize(qnt, rounding=ROUND_HALF_EVEN)
         if not site.profile.wholesale:
-            site_price = product.site_prices.filter(site=site).first()
+            site_price = product.get_site_price(site)
             if site_price is not None:
                 pvd = site_price.val_discount
             else:
@@ -80,12 +137,17 @@ class Basket(models.Model):
 
     def product_discount_text(self, product):
         """ Provides human readable discount string. """
+        return self.product_discount_text_with_user_discount(self.site, product, self.user_discount)
+
+    @classmethod
+    def product_discount_text_with_user_discount(cls, site, product, user_discount):
+        """ Provides human readable discount string considering user discount """
         pd = Decimal(0)
         pdv = Decimal(0)
         pdt = False
-        pct = self.product_pct_discount(self.site, product, self.user_discount)
+        pct = cls.product_pct_discount(site, product, user_discount)
         if pct > 0:
-            if self.site.profile.wholesale:
+            if site.profile.wholesale:
                 price = product.ws_price
                 qnt = Decimal('0.01')
             else:
@@ -94,7 +156,7 @@ class Basket(models.Model):
             pd = (price * Decimal(pct / 100)).quantize(qnt, rounding=ROUND_HALF_EVEN)
             pdv = Decimal(pct)
             pdt = True
-        if not self.site.profile.wholesale and product.val_discount > pd:
+        if not site.profile.wholesale and product.val_discount > pd:
             pd = product.val_discount
             pdv = product.val_discount
             pdt = False
@@ -119,30 +181,16 @@ class Basket(models.Model):
             quantity += item.quantity
         return quantity
 
+    @cached_property
+    def pricing(self):
+        from .pricing import PriceEngine  # circular import
+        pricing = PriceEngine(self.site, self.user_discount)
+        pricing.prefetch([item.product for item in self.items.all()])
+        return pricing
+
     @cached_property
     def user_discount(self):
-        # if session contains valid user, get his discount
-        session_data = self.session.get_decoded()
-        discount = session_data.get('discount', 0)
-        uid = session_data.get('_auth_user_id')
-        try:
-            user = ShopUser.objects.get(id=uid)
-            if user.discount > discount:
-                return user.discount
-        except ShopUser.DoesNotExist:
-            pass
-        # if no user data available return session discount
-        if not self.phone:
-            return discount
-        norm_phone = ShopUserManager.normalize_phone(self.phone)
-        # if there is a user with such phone get his discount
-        try:
-            user = ShopUser.objects.get(phone=norm_phone)
-            if user.discount > discount:
-                return user.discount
-        except ShopUser.DoesNotExist:
-            pass
-        return discount
+        return get_user_discount(self.session_id, self.phone)
 
     def update_session(self, session_key):
         if self.session_id != session_key:
@@ -176,20 +224,16 @@ class BasketItem(models.Model):
 
     @property
     def cost(self):
-        cost = self.product.site_price(self.basket.site) - self.discount
-        if self.basket.site.profile.wholesale:
-            return cost
-        else:
-            return cost.quantize(Decimal('1'), rounding=ROUND_UP)
+        return self.basket.pricing.get(self.product).cost
 
     @property
     def discount(self):
-        return self.basket.product_discount(self.product)
+        return self.basket.pricing.get(self.product).discount
 
     @property
     def discount_text(self):
         """ Provides human readable discount string. """
-        return self.basket.product_discount_text(self.product)
+        return self.basket.pricing.get(self.product).discount_text
 
 
 class Favorites(models.Model):
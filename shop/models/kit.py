@@ -0,0 +1,120 @@
+import logging
+
+from collections import defaultdict
+
+from . import ProductSet
+
+__all__ = [
+    'KitGraph'
+]
+
+logger = logging.getLogger(__name__)
+
+KIT_MAX_QUANTITY = 32767
+
+
+def kit_quantity(kit_id, items):
+    """ KitGraph.evaluate() combiner of kit availability: number of complete kits, constituents of broken kits count as missing """
+    num = KIT_MAX_QUANTITY
+    for n, quantity, _ in items:
+        if n is None:
+            n = 0
+        if quantity > 1:
+            n = int(n / quantity)
+        if n < num:
+            num = n
+    return num
+
+
+class KitGraph(object):
+    """
+    Dependency graph of kits (product sets) around a set of changed products. Kits containing changed
+    products (if declarations is set) and constituents of all loaded kits (depth levels down, all the way
+    down by default) are loaded with one query per level. Kit values are computed in dependency order,
+    each kit once.
+    """
+
+    def __init__(self, product_ids, declarations=True, depth=None):
+        self.changed = set(product_ids)
+        self.ids = set(self.changed)
+        self.declarations = set()
+        pending = set(self.changed) if declarations else set()
+        while pending:
+            pending = set(ProductSet.objects.filter(constituent_id__in=pending).values_list('declaration_id', flat=True)) - self.ids
+            self.declarations |= pending
+            self.ids |= pending
+
+        self.kits = defaultdict(list)
+        pending = set(self.ids)
+        level = 0
+        while pending and (depth is None or level < depth):
+            level += 1
+            items = ProductSet.objects.filter(declaration_id__in=pending).values_list('declaration_id', 'constituent_id', 'quantity', 'discount')
+            pending = set()
+            for declaration_id, constituent_id, quantity, discount in items:
+                self.kits[declaration_id].append((constituent_id, quantity, discount))
+                if constituent_id not in self.ids:
+                    pending.add(constituent_id)
+            self.ids |= pending
+        self.kits = dict(self.kits)
+
+    @property
+    def affected(self):
+        """ Kits which values may change: kits containing changed products and changed kits themselves """
+        return self.declarations | (self.changed & self.kits.keys())
+
+    def order(self, kit_ids=None):
+        """ Returns kits (all or given) sorted so that constituent kits precede kits containing them """
+        result = []
+        visited = set()
+
+        def visit(product_id, path):
+            if product_id in visited or product_id not in self.kits:
+                return
+            if product_id in path:
+                logger.error("Broken kit declaration: {}".format(path))
+                return
+            for constituent_id, _, _ in self.kits[product_id]:
+                visit(constituent_id, path + (product_id,))
+            visited.add(product_id)
+            result.append(product_id)
+
+        for product_id in sorted(self.kits.keys() if kit_ids is None else kit_ids):
+            visit(product_id, ())
+        if kit_ids is not None:
+            kit_ids = set(kit_ids)
+            result = [product_id for product_id in result if product_id in kit_ids]
+        return result
+
+    def levels(self, kit_ids=None):
+        """
+        Returns list of kit id lists: kits of a level contain only products and kits of lower levels,
+        so levels can be recalculated by set-based updates in their order
+        """
+        height = {}
+        for product_id in self.order():
+            height[product_id] = 1 + max((height.get(constituent_id, 0) for constituent_id, _, _ in self.kits[product_id]))
+        levels = defaultdict(list)
+        for product_id in self.order(kit_ids):
+            levels[height[product_id]].append(product_id)
+        return [levels[level] for level in sorted(levels)]
+
+    def evaluate(self, value, combine):
+        """
+        Computes value of each kit once: value(product id) is called for constituents which are not kits,
+        combine(kit id, [(constituent value, quantity, discount)]) for kits. Constituents of broken (cyclic)
+        kit declarations get value None. Returns dict of kit id to its value.
+        """
+        values = {}
+
+        def get(product_id):
+            if product_id in values:
+                return values[product_id]
+            if product_id in self.kits:
+                return None  # not yet computed kit means a cycle
+            return value(product_id)
+
+        for product_id in self.order():
+            values[product_id] = combine(product_id, [(get(constituent_id), quantity, discount)
+                                                      for constituent_id, quantity, discount in self.kits[product_id]])
+        return values
@@ -4,8 +4,9 @@ from decimal import Decimal, ROUND_UP, ROUND_DOWN, ROUND_HALF_EVEN
 
 from django.contrib.sites.models import Site
 from django.db import models
-from django.db.models import Index
-from django.db.models.functions import Upper
+from django.db.models import Case, Exists, ExpressionWrapper, F, Index, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce, Floor, Greatest, Mod, Upper
+from django.db.models.lookups import GreaterThan, LessThan
 from django.db.models.signals import pre_save
 from django.utils import timezone
 from django.utils.formats import date_format
@@ -15,7 +16,7 @@ from model_utils import FieldTracker
 from colorfield.fields import ColorField
 # from tagging.utils import parse_tag_input
 
-from . import Product, ProductSet, Store, ShopUser, Integration, Contractor, PosTerminal, Supplier
+from . import Product, ProductSet, Store, ShopUser, Integration, Contractor, PosTerminal, Supplier, PriceEngine
 
 __all__ = [
     'Manager', 'Courier', 'Order', 'OrderItem', 'Box'
@@ -50,6 +51,65 @@ class Courier(models.Model):
 
 
 # may be switch to https://github.com/5monkeys/django-enumfield/
+# discounts are calculated as amount * Decimal(pct_discount / 100), percent passes through float and a tie is
+# rounded up or down by its representation error, only exactly representable percents are rounded half to even
+PCT_ROUND_UP = tuple(pct for pct in range(1, 101) if Decimal(pct / 100) > Decimal(pct) / 100)
+PCT_ROUND_EVEN = tuple(pct for pct in range(1, 101) if Decimal(pct / 100) == Decimal(pct) / 100)
+
+
+def discount_expression(amount):
+    """ SQL counterpart of OrderItem.discount for amount expression, is evaluated on OrderItem queryset """
+    wholesale = Q(order__site__profile__wholesale=True)
+    # amount * percent / 100 in units of rounding quantum
+    scaled = ExpressionWrapper(amount * F('pct_discount') / Case(When(wholesale, then=Value(1)), default=Value(100)),
+                               output_field=models.DecimalField())
+    fraction = scaled - Floor(scaled)
+    rounded = Floor(scaled) + Case(
+        When(GreaterThan(fraction, Value(Decimal('0.5'))), then=Value(1)),
+        When(LessThan(fraction, Value(Decimal('0.5'))), then=Value(0)),
+        When(pct_discount__in=PCT_ROUND_UP, then=Value(1)),
+        When(pct_discount__in=PCT_ROUND_EVEN, then=Mod(Floor(scaled), Value(2))),
+        default=Value(0),
+        output_field=models.DecimalField()
+    )
+    quantum = Case(When(wholesale, then=Value(Decimal('0.01'))), default=Value(Decimal('1')))
+    return Greatest(ExpressionWrapper(rounded * quantum, output_field=models.DecimalField()), F('val_discount'))
+
+
+def item_price_expression():
+    """ SQL counterpart of OrderItem.price """
+    return Case(
+        When(total__gt=0, then=F('total') - discount_expression(F('total'))),
+        default=(F('product_price') - discount_expression(F('product_price'))) * F('quantity'),
+        output_field=models.DecimalField()
+    )
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        """
+        Annotates orders with products price, quantity and weight calculated in SQL with the same rules as
+        Order properties use, the properties return annotated values if they are present
+        """
+        items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+        boxes = Box.objects.filter(order=OuterRef('pk')).order_by().values('order')
+        boxes_weight = Subquery(boxes.annotate(weight_sum=Sum('weight')).values('weight_sum'))
+        items_weight = Subquery(items.annotate(weight_sum=Sum('product__prom_weight')).values('weight_sum'))
+        return self.annotate(
+            items_price=Subquery(items.annotate(
+                price_sum=Cast(Sum(item_price_expression()), models.DecimalField(max_digits=12, decimal_places=2))
+            ).values('price_sum')),
+            items_quantity=Subquery(items.annotate(quantity_sum=Sum('quantity')).values('quantity_sum')),
+            items_weight=Case(
+                When(Exists(boxes.filter(weight=0)), then=Value(None)),
+                When(GreaterThan(boxes_weight, Value(0.0)), then=boxes_weight),
+                When(Exists(items.filter(product__prom_weight=0)), then=Value(None)),
+                default=Coalesce(items_weight, Value(0.0)),
+                output_field=models.FloatField()
+            )
+        )
+
+
 class Order(models.Model):
     PAYMENT_CASH = 1
     PAYMENT_CARD = 2
@@ -156,6 +216,7 @@ class Order(models.Model):
         STATUS_DONE: 'gray',
         STATUS_FINISHED: 'gray',
     }
+    RESERVING_STATUSES = (STATUS_NEW, STATUS_ACCEPTED, STATUS_COLLECTING, STATUS_COLLECTED, STATUS_DELIVERED_SHOP, STATUS_SENT)
     PICKPOINT_SERVICE_STD = 'STD'
     PICKPOINT_SERVICE_STDCOD = 'STDCOD'
     PICKPOINT_SERVICES = (
@@ -223,6 +284,8 @@ class Order(models.Model):
 
     tracker = FieldTracker(fields=['status'])
 
+    objects = OrderQuerySet.as_manager()
+
     @property
     def title(self):
         shop_code = self.site.profile.order_prefix
@@ -239,6 +302,8 @@ class Order(models.Model):
 
     @property
     def products_price(self):
+        if hasattr(self, 'items_price'):  # annotated with OrderQuerySet.with_totals()
+            return self.items_price if self.items_price is not None else 0
         total = 0
         for item in self.items.all():
             total += item.price
@@ -246,6 +311,8 @@ class Order(models.Model):
 
     @property
     def products_quantity(self):
+        if hasattr(self, 'items_quantity'):
+            return self.items_quantity if self.items_quantity is not None else 0
         quantity = 0
         for item in self.items.all():
             quantity += item.quantity
@@ -253,6 +320,8 @@ class Order(models.Model):
 
     @property
     def weight(self):
+        if hasattr(self, 'items_weight'):
+            return self.items_weight if self.items_weight != 0 else 0
         weight = 0
         for box in self.boxes.all():
             if box.weight == 0:
@@ -308,9 +377,17 @@ class Order(models.Model):
         else:
             qnt = Decimal('1')
 
+        items = list(basket.items.select_related('product'))
+        pricing = PriceEngine(order.site, user_discount)
+        pricing.prefetch([item.product for item in items])
+        kits = {}
+        for product_set in ProductSet.objects.filter(declaration__in=[item.product_id for item in items]).select_related('constituent').order_by('id'):
+            kits.setdefault(product_set.declaration_id, []).append(product_set)
+        order_items = []
+
         # добавляем в заказ все элементы корзины
-        for item in basket.items.all():
-            price = item.product.site_price(order.site)
+        for item in items:
+            price = pricing.get(item.product).price
             # если это интеграция, то указываем только предоставленную рублёвую скидку
             if integration is not None and integration.uses_api:
                 pct_discount = 0
@@ -321,16 +398,19 @@ class Order(models.Model):
                 val_discount = item.discount
             # иначе считаем отдельно скидку в процентах и копируем текущую рублёвую скидку товара
             else:
-                pct_discount = basket.product_pct_discount(order.site, item.product, user_discount)
-                val_discount = item.product.site_val_discount(order.site)
+                pct_discount = pricing.get(item.product).pct_discount
+                val_discount = pricing.get(item.product).val_discount
             # если это обычный товар, добавляем его в заказ
-            if item.product.constituents.count() == 0:
-                order.items.create(product=item.product,
-                                   product_price=price.quantize(qnt, rounding=ROUND_UP),
-                                   pct_discount=pct_discount,
-                                   val_discount=val_discount,
-                                   quantity=item.quantity,
-                                   meta=item.meta)
+            if item.product_id not in kits:
+                product_price = price.quantize(qnt, rounding=ROUND_UP)
+                # позиции создаются без сигналов, поэтому нулевая цена заменяется ценой товара здесь, как в set_order_item_price
+                order_items.append(OrderItem(order=order,
+                                             product=item.product,
+                                             product_price=product_price or item.product.price,
+                                             pct_discount=pct_discount,
+                                             val_discount=val_discount,
+                                             quantity=item.quantity,
+                                             meta=item.meta))
             # если это комплект, то добавляем элементы комплекта отдельно
             else:
                 full_discount = val_discount
@@ -338,7 +418,7 @@ class Order(models.Model):
                 if not item.product.recalculate_price:
                     full_price = price.quantize(qnt, rounding=ROUND_UP)
                     price_remainder = full_price
-                constituents = ProductSet.objects.filter(declaration=item.product)
+                constituents = kits[item.product_id]
                 last = len(constituents) - 1
                 for idx, itm in enumerate(constituents):
                     if wholesale:
@@ -373,18 +453,21 @@ class Order(models.Model):
                             discount_remainder = discount_remainder - val_discount
                     else:
                         val_discount = discount_remainder
-                    i = order.items.create(product=itm.constituent,
-                                           product_price=item_price,
-                                           pct_discount=pct_discount,
-                                           val_discount=val_discount,
-                                           quantity=item.quantity * itm.quantity,
-                                           total=item_total,
-                                           meta=item.meta)
-                    # в данный момент, если цена позиции равна нулю, то она принудительно устанавливается в цену товара
-                    # todo: можно перенести эту логику в admin, и тогда можно будет избавиться от двойного сохранения
-                    if not item_price:
-                        i.product_price = item_price
-                        i.save()
+                    # нулевая цена элемента комплекта сохраняется как есть, без замены ценой товара
+                    order_items.append(OrderItem(order=order,
+                                                 product=itm.constituent,
+                                                 product_price=item_price,
+                                                 pct_discount=pct_discount,
+                                                 val_discount=val_discount,
+                                                 quantity=item.quantity * itm.quantity,
+                                                 total=item_total,
+                                                 meta=item.meta))
+        OrderItem.objects.bulk_create(order_items)
+
+        # резерв обновляется один раз для всех товаров заказа вместо сигнала на каждую позицию
+        if order.status in Order.RESERVING_STATUSES:
+            from . import ProductAvailability  # circular import
+            ProductAvailability.objects.update_products({order_item.product_id for order_item in order_items})
         return order
 
     def append_user_tags(self, tags):
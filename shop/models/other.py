@@ -1,10 +1,16 @@
 import logging
+import time
 
+from collections import namedtuple
+
+from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.db import models
 from django.utils import timezone
 from django.urls import reverse
 
+from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey, TreeManyToManyField
 
 __all__ = [
@@ -15,6 +21,101 @@ __all__ = [
 
 logger = logging.getLogger(__name__)
 
+CATEGORY_TREE_VERSION_KEY = 'category_tree_version'
+
+CategoryNode = namedtuple('CategoryNode', ('id', 'parent_id', 'tree_id', 'level', 'lft', 'rght', 'slug', 'name', 'active', 'hidden', 'feed'))
+
+_category_tree = None
+
+
+class CategoryTree(object):
+    """
+    In-process snapshot of the whole category forest built with one query. Resolves api paths,
+    ancestors and descendants without touching database.
+    """
+
+    def __init__(self, queryset, version):
+        self.version = version
+        self.nodes = {}
+        self.roots = {}
+        self.paths = {}
+        self.ancestors = {}
+        self.descendants = {}
+
+        stack = []
+        for row in queryset.order_by('tree_id', 'lft').values_list(*CategoryNode._fields):
+            node = CategoryNode(*row)
+            while stack and (stack[-1].tree_id != node.tree_id or stack[-1].rght < node.lft):
+                stack.pop()
+            if not stack:
+                self.roots.setdefault(node.slug, node)
+            ancestors = tuple(stack) + (node,)
+            self.nodes[node.id] = node
+            self.ancestors[node.id] = ancestors
+            self.descendants[node.id] = []
+            for ancestor in stack:
+                self.descendants[ancestor.id].append(node)
+            # api path excludes root category, first sibling wins as in slug candidates lookup
+            self.paths.setdefault((node.tree_id, '/'.join([item.slug for item in ancestors[1:]])), node)
+            stack.append(node)
+
+    def get(self, pk):
+        return self.nodes.get(pk)
+
+    def get_root(self, slug):
+        return self.roots.get(slug)
+
+    def get_by_path(self, path, root):
+        """ Returns node for api path (without root category slug) in the tree of given root category """
+        root = self.nodes.get(getattr(root, 'pk', root))
+        if root is None:
+            return None
+        return self.paths.get((root.tree_id, path.strip('/')))
+
+    def get_ancestors(self, pk, include_self=True, include_root=True):
+        ancestors = self.ancestors.get(pk, ())
+        if not include_self:
+            ancestors = ancestors[:-1]
+        if not include_root:
+            ancestors = ancestors[1:]
+        return ancestors
+
+    def get_api_path(self, pk):
+        return '/'.join([item.slug for item in self.get_ancestors(pk, include_root=False)])
+
+    def get_descendants(self, pk, include_self=False, **flags):
+        """ Returns descendant nodes in tree order optionally filtered by active, hidden and feed flags """
+        nodes = self.descendants.get(pk, [])
+        if include_self and pk in self.nodes:
+            nodes = [self.nodes[pk]] + nodes
+        if flags:
+            nodes = [node for node in nodes if all(getattr(node, flag) == value for flag, value in flags.items())]
+        return nodes
+
+    def get_descendant_ids(self, pk, include_self=False, **flags):
+        return [node.id for node in self.get_descendants(pk, include_self, **flags)]
+
+
+class CategoryManager(TreeManager):
+    def tree(self):
+        """ Returns category tree snapshot, it is rebuilt only when tree version changes """
+        global _category_tree
+        version = cache.get_or_set(CATEGORY_TREE_VERSION_KEY, time.time_ns, None)
+        tree = _category_tree
+        if tree is None or tree.version != version:
+            tree = _category_tree = CategoryTree(self.get_queryset(), version)
+        return tree
+
+    def get_by_path(self, path, root=None):
+        """ Path resolver for mptt_urls.view, path is relative to root category """
+        tree = self.tree()
+        root = tree.get_root(root or settings.MPTT_ROOT)
+        node = tree.get_by_path(path, root.id) if root else None
+        return self.filter(pk=node.id).first() if node else None
+
+    def invalidate_tree(self):
+        cache.set(CATEGORY_TREE_VERSION_KEY, time.time_ns(), None)
+
 
 class Category(MPTTModel):
     name = models.CharField('заголовок', max_length=100)
@@ -38,9 +139,11 @@ class Category(MPTTModel):
     promo_image_height = models.IntegerField(null=True, blank=True)
     product_order = models.CharField('поле сортировки товаров', max_length=50, default='-price')
 
+    objects = CategoryManager()
+
     def get_api_path(self):
         # TODO: refactor: remove mptt_urls get_path injection, use this instead
-        return '/'.join([item.slug for item in self.get_ancestors(include_self=True)[1:]])  # exclude root category
+        return Category.objects.tree().get_api_path(self.pk)  # exclude root category
 
     def get_active_children(self):
         return self.get_children().filter(active=True, hidden=False)
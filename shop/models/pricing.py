@@ -0,0 +1,68 @@
+from collections import namedtuple
+from decimal import Decimal, ROUND_UP
+
+from . import Basket, ProductPrice
+
+__all__ = [
+    'PriceEngine', 'PriceRecord'
+]
+
+PriceRecord = namedtuple('PriceRecord', ('price', 'cost', 'discount', 'discount_text', 'pct_discount', 'val_discount'))
+
+
+class PriceEngine(object):
+    """
+    Resolves site prices and discounts for a list of products. Site price records are fetched for all
+    products with one query and calculated prices are memoized. If user discount is not given product
+    catalogue cost is calculated, otherwise cost considers user discount as in basket.
+    """
+
+    def __init__(self, site, user_discount=None):
+        self.site = site
+        self.user_discount = user_discount
+        self.records = {}
+
+    def prefetch(self, products):
+        products = [product for product in products if self.site.id not in getattr(product, 'prefetched_site_prices', {})]
+        if not products:
+            return
+        site_prices = {site_price.product_id: site_price for site_price in
+                       ProductPrice.objects.filter(site=self.site, product_id__in=[product.id for product in products])}
+        for product in products:
+            if not hasattr(product, 'prefetched_site_prices'):
+                product.prefetched_site_prices = {}
+            product.prefetched_site_prices[self.site.id] = site_prices.get(product.id)
+
+    def get(self, product):
+        record = self.records.get(product.id)
+        if record is None:
+            self.prefetch([product])
+            record = self.records[product.id] = self.calculate(product)
+        return record
+
+    def calculate(self, product):
+        site = self.site
+        price = product.site_price(site)
+        user_discount = self.user_discount or 0
+        if self.user_discount is None:
+            cost = product.site_cost(site)
+            discount = price - cost
+        else:
+            discount = Basket.product_discount_with_user_discount(site, product, user_discount)
+            cost = price - discount
+            if not site.profile.wholesale:
+                cost = cost.quantize(Decimal('1'), rounding=ROUND_UP)
+        if hasattr(site, 'profile'):
+            pct_discount = Basket.product_pct_discount(site, product, user_discount)
+            discount_text = Basket.product_discount_text_with_user_discount(site, product, user_discount)
+        else:
+            pct_discount = 0
+            discount_text = ''
+        return PriceRecord(
+            price=price,
+            cost=cost,
+            discount=discount,
+            discount_text=discount_text,
+            pct_discount=pct_discount,
+            val_discount=product.site_val_discount(site)
+        )
@@ -5,11 +5,13 @@ from decimal import Decimal, ROUND_UP, ROUND_HALF_EVEN
 
 from django.conf import settings
 from django.contrib.postgres.search import SearchVector, SearchVectorField
-from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.contrib.sites.models import Site
-from django.db import connection, models
+from django.db import connection, models, transaction
+from django.db.models.functions import Upper
 from django.db.models.signals import post_save
 from django.db.utils import OperationalError
+from django.dispatch import Signal
 from django.utils.functional import cached_property
 from django.urls import reverse
 
@@ -30,6 +32,12 @@ __all__ = [
 
 logger = logging.getLogger(__name__)
 
+""" sent with list of product ids which prices have changed by set-based updates skipping Product.save() """
+prices_changed = Signal()
+
+""" sent with list of product ids changed by imports and other bulk updates, receivers refresh product caches """
+products_changed = Signal()
+
 
 def product_image_path(instance, filename):
     _, extension = os.path.splitext(filename)
@@ -225,14 +233,20 @@ class Product(models.Model):
     prom_stitch_type = models.CharField('Тип стежка', max_length=255, blank=True)
     prom_autothread = models.CharField('Автоматический нитеотводчик', max_length=255, blank=True)
 
-    fts_vector = SearchVectorField(null=True)
+    fts_vector = SearchVectorField(null=True)  # maintained by shop_product_fts_vector trigger
 
     class Meta:
         verbose_name = 'товар'
         verbose_name_plural = 'товары'
         ordering = ['title']
         indexes = [
-            GinIndex(fields=['fts_vector'])
+            GinIndex(fields=['fts_vector']),
+            # typeahead search
+            GinIndex(OpClass(Upper('title'), name='gin_trgm_ops'), name='shop_product_title_trgm_idx'),
+            GinIndex(OpClass(Upper('code'), name='gin_trgm_ops'), name='shop_product_code_trgm_idx'),
+            GinIndex(OpClass(Upper('article'), name='gin_trgm_ops'), name='shop_product_article_trgm_idx'),
+            GinIndex(OpClass(Upper('partnumber'), name='gin_trgm_ops'), name='shop_product_partnumber_trgm_idx'),
+            GinIndex(fields=['gtins'], name='shop_product_gtins_gin_idx')
         ]
 
     def get_absolute_url(self):
@@ -254,23 +268,22 @@ class Product(models.Model):
             self.update_sets()
 
     def update_sets(self):
-        product_sets = ProductSet.objects.filter(constituent=self)
-        for product_set in product_sets:
-            updated = False
-            if self.num < 0:
-                product_set.declaration.num = -1
-                updated = True
-            if product_set.declaration.recalculate_price:
-                product_set.declaration.update_set_price()
-                updated = True
-            if updated:
-                product_set.declaration.save()
+        """ Marks stock of kits containing the product as outdated if product stock is, recalculates kit prices """
+        from .kit import KitGraph  # circular import
+        graph = KitGraph([self.pk], depth=1)
+        if not graph.declarations:
+            return
+        if self.num < 0:
+            Product.objects.filter(pk__in=graph.declarations, num__gte=0).update(num=-1)
+        changed = update_kit_prices(graph)
+        if changed:
+            prices_changed.send(sender=Product, product_ids=changed)
 
     def update_set_price(self):
         price = Decimal('0')
         ws_price = Decimal('0')
         sp_price = Decimal('0')
-        constituents = ProductSet.objects.filter(declaration=self)
+        constituents = ProductSet.objects.filter(declaration=self).select_related('constituent')
         for item in constituents:
             item_price = item.constituent.price
             item_ws_price = item.constituent.ws_price
@@ -288,12 +301,16 @@ class Product(models.Model):
         self.ws_price = ws_price
         self.sp_price = sp_price
 
-    def update_fts_vector(self):
+    @staticmethod
+    def fts_vector_expression():
         language = 'russian'
         vector = SearchVector('title', 'code', 'article', 'partnumber', weight='A', config=language)
         vector = vector + SearchVector('whatis', 'shortdescr', weight='B', config=language)
         vector = vector + SearchVector('descr', 'spec', weight='D', config=language)
-        Product.objects.filter(id=self.id).update(fts_vector=vector)  # use direct DB update to skip heavy save() logic
+        return vector
+
+    def update_fts_vector(self):
+        Product.objects.filter(id=self.id).update(fts_vector=self.fts_vector_expression())  # use direct DB update to skip heavy save() logic
 
     # TODO: depricated
     def get_sales_actions(self):
@@ -301,11 +318,14 @@ class Product(models.Model):
 
     @cached_property
     def breadcrumbs(self):
-        root = Category.objects.get(slug=settings.MPTT_ROOT)
+        tree = Category.objects.tree()
+        root = tree.get_root(settings.MPTT_ROOT)
         # select (optionally) not hidden category, the deepest or first sibling
-        category = self.categories.filter(tree_id=root.tree_id, active=True).order_by('hidden', '-level', 'lft').first()
-        if category:
-            return category.get_ancestors(include_self=True)
+        categories = [tree.get(category.pk) for category in self.categories.all()]
+        categories = [category for category in categories if category and category.tree_id == root.tree_id and category.active]
+        if categories:
+            category = min(categories, key=lambda c: (c.hidden, -c.level, c.lft))
+            return tree.get_ancestors(category.id)
         return None
 
     @property
@@ -340,8 +360,15 @@ class Product(models.Model):
         else:
             return Decimal(0)
 
+    def get_site_price(self, site):
+        """ Returns site specific price record, uses records prefetched by PriceEngine if available """
+        prefetched = getattr(self, 'prefetched_site_prices', {})
+        if site.id in prefetched:
+            return prefetched[site.id]
+        return self.site_prices.filter(site=site).first()
+
     def site_price(self, site):
-        site_price = self.site_prices.filter(site=site).first()
+        site_price = self.get_site_price(site)
         if site_price is None or site_price.price == 0:
             if hasattr(site, 'profile') and site.profile.wholesale:
                 return self.ws_price
@@ -350,7 +377,7 @@ class Product(models.Model):
         return site_price.price
 
     def site_cost(self, site):
-        site_price = self.site_prices.filter(site=site).first()
+        site_price = self.get_site_price(site)
         if self.pk == 2382:
             logger.error(self.code)
             logger.error(site_price)
@@ -373,7 +400,7 @@ class Product(models.Model):
         return price - discount
 
     def site_val_discount(self, site):
-        site_price = self.site_prices.filter(site=site).first()
+        site_price = self.get_site_price(site)
         if site_price is not None:
             return site_price.val_discount
         else:
@@ -383,11 +410,12 @@ class Product(models.Model):
     def instock(self):
         if self.num >= 0:
             return self.num
-        self.num = self.get_stock()
+        from .availability import ProductAvailability  # circular import
         try:
-            super(Product, self).save()
+            ProductAvailability.objects.update_products([self.pk])
         except OperationalError:
-            pass  # ignore lock timeout, TODO: refactor 1C import?
+            return self.get_stock()  # ignore lock timeout, availability will be updated by next change
+        self.refresh_from_db(fields=['num'])
         return self.num
 
     def get_stock(self, integration=None, express=False):
@@ -424,13 +452,18 @@ class Product(models.Model):
                 if num < 0:
                     num = 0
         else:
-            num = 32767
-            for item in ProductSet.objects.filter(declaration=self):
-                n = item.constituent.instock
-                if item.quantity > 1:
-                    n = int(n / item.quantity)
-                if n < num:
-                    num = n
+            from .availability import ProductAvailability  # circular import
+            from .kit import KitGraph, kit_quantity  # circular import
+            graph = KitGraph([self.pk], declarations=False)
+            stock = dict(Product.objects.filter(pk__in=graph.ids - graph.kits.keys()).values_list('id', 'num'))
+            outdated = [product_id for product_id, num in stock.items() if num < 0]
+            if outdated:
+                try:
+                    ProductAvailability.objects.update_products(outdated)
+                except OperationalError:
+                    pass  # ignore lock timeout, outdated constituents are counted as missing
+                stock.update(Product.objects.filter(pk__in=outdated).values_list('id', 'num'))
+            num = graph.evaluate(lambda product_id: max(stock.get(product_id, 0), 0), kit_quantity)[self.pk]
         return num
 
     @staticmethod
@@ -538,10 +571,92 @@ class Stock(models.Model):
         unique_together = ('product', 'supplier')
 
 
+def kit_item_price_sql(price, quantum):
+    """
+    SQL counterpart of constituent price in Product.update_set_price: price * Decimal((100 - discount) / 100)
+    quantized half to even, float representation of the factor decides how ties are rounded
+    """
+    from .order import PCT_ROUND_UP, PCT_ROUND_EVEN  # circular import
+    scaled = '({} * (100 - ps.discount) / {})'.format(price, 100 * quantum)
+    return """CASE WHEN ps.discount > 0 THEN (FLOOR({scaled}) + CASE
+                  WHEN {scaled} - FLOOR({scaled}) > 0.5 THEN 1
+                  WHEN {scaled} - FLOOR({scaled}) < 0.5 THEN 0
+                  WHEN 100 - ps.discount IN ({up}) THEN 1
+                  WHEN 100 - ps.discount IN ({even}) THEN MOD(FLOOR({scaled}), 2)
+                  ELSE 0 END) * {quantum} ELSE {price} END""".format(
+        scaled=scaled, price=price, quantum=quantum,
+        up=','.join(map(str, PCT_ROUND_UP)), even=','.join(map(str, PCT_ROUND_EVEN)))
+
+
+def update_kit_prices(graph):
+    """
+    Recalculates prices of kits affected by changes of graph products with set-based update per kit level,
+    so each kit is updated once after its constituent kits, returns ids of kits which prices have changed
+    """
+    changed = set()
+    with connection.cursor() as cursor:
+        for kit_ids in graph.levels(graph.affected):
+            cursor.execute("""UPDATE shop_product SET price = kit.price, ws_price = kit.ws_price, sp_price = kit.sp_price
+                              FROM (SELECT ps.declaration_id AS id,
+                                           SUM({} * ps.quantity) AS price,
+                                           SUM({} * ps.quantity) AS ws_price,
+                                           SUM({} * ps.quantity) AS sp_price
+                                    FROM shop_productset ps INNER JOIN shop_product c ON (c.id = ps.constituent_id)
+                                    WHERE ps.declaration_id = ANY(%s)
+                                    GROUP BY ps.declaration_id) kit
+                              WHERE shop_product.id = kit.id AND shop_product.recalculate_price
+                                    AND (shop_product.price, shop_product.ws_price, shop_product.sp_price)
+                                        IS DISTINCT FROM (kit.price, kit.ws_price, kit.sp_price)
+                              RETURNING shop_product.id""".format(
+                kit_item_price_sql('c.price', 1), kit_item_price_sql('c.ws_price', 0.01), kit_item_price_sql('c.sp_price', 0.01)
+            ), [kit_ids])
+            changed.update(row[0] for row in cursor.fetchall())
+    return changed
+
+
+def reprice_kits(product_ids):
+    """ Recalculates prices of given kits and kits containing given products, returns ids of changed kits """
+    from .kit import KitGraph  # circular import
+    return update_kit_prices(KitGraph(product_ids, depth=1))
+
+
+def reprice_currency(currency_code):
+    """
+    Recalculates prices of products and site prices in given currency from currency rates with set-based
+    updates, then prices of kits containing them in dependency order. Recalculated kits themselves are
+    skipped as their prices do not depend on currency. Returns ids of products which prices have changed.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("""UPDATE shop_product SET price = new.price, ws_price = new.ws_price, sp_price = new.sp_price
+                          FROM (SELECT p.id, ROUND(p.cur_price * c.rate, 2) AS price, ROUND(p.ws_cur_price * w.rate, 2) AS ws_price,
+                                       ROUND(p.sp_cur_price * s.rate, 2) AS sp_price
+                                FROM shop_product p
+                                INNER JOIN shop_currency c ON (c.code = p.cur_code_id)
+                                INNER JOIN shop_currency w ON (w.code = p.ws_cur_code_id)
+                                INNER JOIN shop_currency s ON (s.code = p.sp_cur_code_id)
+                                WHERE %(code)s IN (p.cur_code_id, p.ws_cur_code_id, p.sp_cur_code_id)
+                                      AND NOT (p.recalculate_price AND EXISTS (SELECT 1 FROM shop_productset WHERE declaration_id = p.id))) new
+                          WHERE shop_product.id = new.id
+                                AND (shop_product.price, shop_product.ws_price, shop_product.sp_price)
+                                    IS DISTINCT FROM (new.price, new.ws_price, new.sp_price)
+                          RETURNING shop_product.id""", {'code': currency_code})
+        changed = {row[0] for row in cursor.fetchall()}
+        cursor.execute("""UPDATE shop_productprice SET price = ROUND(shop_productprice.cur_price * c.rate, 2)
+                          FROM shop_product p INNER JOIN shop_currency c ON (c.code = p.cur_code_id)
+                          WHERE shop_productprice.product_id = p.id AND p.cur_code_id = %(code)s
+                                AND shop_productprice.price IS DISTINCT FROM ROUND(shop_productprice.cur_price * c.rate, 2)
+                          RETURNING shop_productprice.product_id""", {'code': currency_code})
+        site_prices_changed = {row[0] for row in cursor.fetchall()}
+        changed.update(reprice_kits(changed))
+    changed.update(site_prices_changed)
+    if changed:
+        logger.info("Prices changed for {} products".format(len(changed)))
+        prices_changed.send(sender=Product, product_ids=changed)
+    return changed
+
+
 def update_product_prices(sender, instance, **kwargs):
-    products = Product.objects.filter(models.Q(cur_code=instance) | models.Q(ws_cur_code=instance))
-    for product in products:
-        product.save()
+    reprice_currency(instance.code)
 
 
 post_save.connect(update_product_prices, sender=Currency, dispatch_uid='update_product_prices')
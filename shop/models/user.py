@@ -5,6 +5,8 @@ from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, Permis
 from django.db import models
 from django.utils import timezone
 
+from model_utils import FieldTracker
+
 # from tagging.fields import TagField
 
 __all__ = [
@@ -105,6 +107,7 @@ class ShopUser(AbstractBaseUser, PermissionsMixin):
     last_name = AliasField(db_column='name', blank=True)
 
     objects = ShopUserManager()
+    tracker = FieldTracker(fields=['phone', 'discount'])
 
     USERNAME_FIELD = 'phone'
     REQUIRED_FIELDS = []
@@ -0,0 +1,153 @@
+import tempfile
+
+from collections import namedtuple
+from decimal import Decimal, ROUND_UP
+
+from django.db import connection
+
+import xlsxwriter
+
+""" product demand of selected orders and its allocation to stocks of suppliers (first supplier is own stock) """
+StockAllocation = namedtuple('StockAllocation', ('product_id', 'article', 'quantity', 'taken', 'missing'))
+
+""" product of an order with stock of suppliers shown in order as list of (supplier code, quantity) """
+OrderProduct = namedtuple('OrderProduct', ('product_id', 'article', 'partnumber', 'title', 'comment_packer',
+                                           'order_id', 'order_status', 'quantity', 'stocks'))
+
+ORDER_PRODUCTS_SORTING = {
+    '1': 'product_id',
+    '2': 'article',
+    '3': 'partnumber',
+    '4': 'title',
+    '5': 'order_id',
+    '6': 'order_status',
+    '7': 'quantity'
+}
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def get_product_demand(order_ids):
+    """ Returns list of (product id, article, quantity) of products ordered in given orders sorted by article """
+    with connection.cursor() as cursor:
+        cursor.execute("""SELECT shop_orderitem.product_id, shop_product.article, SUM(shop_orderitem.quantity) AS quantity
+                          FROM shop_orderitem INNER JOIN shop_product ON (shop_product.id = shop_orderitem.product_id)
+                          WHERE shop_orderitem.order_id = ANY(%s)
+                          GROUP BY shop_orderitem.product_id, shop_product.article
+                          ORDER BY shop_product.article""", (list(order_ids),))
+        return cursor.fetchall()
+
+
+def get_stock_allocation(order_ids, suppliers):
+    """
+    Allocates product demand of given orders to stocks of suppliers in their order: own stock (first supplier)
+    is taken as is, even if it is negative, then positive stocks of other suppliers are taken until demand is
+    satisfied. Allocation is calculated by one query with running totals of stocks, taken is a list of
+    quantities taken from each supplier, missing is quantity not found on stocks.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""WITH demand AS (
+                              SELECT shop_orderitem.product_id, SUM(shop_orderitem.quantity) AS quantity
+                              FROM shop_orderitem WHERE shop_orderitem.order_id = ANY(%s)
+                              GROUP BY shop_orderitem.product_id
+                          ), sources AS (
+                              SELECT supplier_id, priority FROM unnest(%s::integer[]) WITH ORDINALITY AS source(supplier_id, priority)
+                          ), contribution AS (
+                              SELECT demand.product_id, demand.quantity, sources.priority,
+                                     CASE WHEN sources.priority = 1 THEN COALESCE(shop_stock.quantity + shop_stock.correction, 0)
+                                          ELSE GREATEST(COALESCE(shop_stock.quantity + shop_stock.correction, 0), 0) END AS stock
+                              FROM demand CROSS JOIN sources
+                              LEFT JOIN shop_stock ON (shop_stock.product_id = demand.product_id AND shop_stock.supplier_id = sources.supplier_id)
+                          ), allocation AS (
+                              SELECT product_id, quantity, priority,
+                                     LEAST(quantity, SUM(stock) OVER (w ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)) -
+                                     LEAST(quantity, COALESCE(SUM(stock) OVER (w ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0)) AS taken
+                              FROM contribution
+                              WINDOW w AS (PARTITION BY product_id ORDER BY priority)
+                          )
+                          SELECT allocation.product_id, shop_product.article, allocation.quantity,
+                                 ARRAY_AGG(allocation.taken ORDER BY allocation.priority) AS taken,
+                                 allocation.quantity - SUM(allocation.taken) AS missing
+                          FROM allocation INNER JOIN shop_product ON (shop_product.id = allocation.product_id)
+                          GROUP BY allocation.product_id, shop_product.article, allocation.quantity
+                          ORDER BY shop_product.article""", (list(order_ids), [supplier.id for supplier in suppliers]))
+        return [StockAllocation(*row) for row in cursor.fetchall()]
+
+
+def get_order_products(order_ids=None, suppliers=(), sort=None):
+    """
+    Returns products of given (or all) orders with stock of given suppliers fetched by the same query,
+    sort is a key of ORDER_PRODUCTS_SORTING, products are sorted by title by default
+    """
+    codes = {supplier.id: supplier.code for supplier in suppliers}
+    where = 'WHERE shop_order.id = ANY(%(orders)s)' if order_ids is not None else ''
+    with connection.cursor() as cursor:
+        cursor.execute("""WITH demand AS (
+                              SELECT shop_orderitem.product_id, shop_order.id AS order_id, shop_order.status AS order_status,
+                                     SUM(shop_orderitem.quantity) AS quantity
+                              FROM shop_orderitem INNER JOIN shop_order ON (shop_orderitem.order_id = shop_order.id)
+                              {}
+                              GROUP BY shop_order.id, shop_orderitem.product_id
+                          ), stock AS (
+                              SELECT shop_stock.product_id,
+                                     ARRAY_AGG(shop_stock.supplier_id ORDER BY shop_supplier.order) AS suppliers,
+                                     ARRAY_AGG(shop_stock.quantity ORDER BY shop_supplier.order) AS quantities
+                              FROM shop_stock INNER JOIN shop_supplier ON (shop_supplier.id = shop_stock.supplier_id)
+                              WHERE shop_stock.supplier_id = ANY(%(suppliers)s)
+                                    AND shop_stock.product_id IN (SELECT product_id FROM demand)
+                              GROUP BY shop_stock.product_id
+                          )
+                          SELECT shop_product.id AS product_id, shop_product.article, shop_product.partnumber, shop_product.title,
+                                 shop_product.comment_packer, demand.order_id, demand.order_status, demand.quantity,
+                                 stock.suppliers, stock.quantities
+                          FROM demand INNER JOIN shop_product ON (shop_product.id = demand.product_id)
+                          LEFT JOIN stock ON (stock.product_id = demand.product_id)
+                          ORDER BY {}""".format(where, ORDER_PRODUCTS_SORTING.get(sort, 'title')),
+                       {'orders': list(order_ids or []), 'suppliers': list(codes.keys())})
+        return [OrderProduct(*row[:8], list(zip(map(codes.get, row[8] or []), row[9] or []))) for row in cursor.fetchall()]
+
+
+def quantity_cell(quantity):
+    """ Partial quantities are rounded up as packer takes whole items """
+    return Decimal(quantity).quantize(Decimal('1'), rounding=ROUND_UP)
+
+
+def write_stock_allocation(allocation, suppliers):
+    """
+    Writes XLSX workbook with sheet of articles and quantities for each supplier and sheet of missing products
+    if there are any, returns temporary file with the workbook. Rows are flushed to disk as they are written.
+    """
+    output = tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    # own stock is the last sheet as in picking order
+    for index in list(range(1, len(suppliers))) + [0]:
+        sheet = workbook.add_worksheet(suppliers[index].name)
+        row = 0
+        for product in allocation:
+            taken = product.taken[index]
+            if taken > 0:
+                sheet.write(row, 0, product.article)
+                sheet.write(row, 1, quantity_cell(taken))
+                row += 1
+    missing = [product for product in allocation if product.missing > 0]
+    if missing:
+        sheet = workbook.add_worksheet('Нет на складах')
+        for row, product in enumerate(missing):
+            sheet.write(row, 0, product.article)
+            sheet.write(row, 1, product.missing)
+    workbook.close()
+    output.seek(0)
+    return output
+
+
+def write_product_demand(products):
+    """ Writes XLSX workbook with articles and quantities, returns temporary file with the workbook """
+    output = tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    sheet = workbook.add_worksheet('Products')
+    for row, (product_id, article, quantity) in enumerate(products):
+        sheet.write(row, 0, article)
+        sheet.write(row, 1, quantity)
+    workbook.close()
+    output.seek(0)
+    return output
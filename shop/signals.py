@@ -1,7 +1,7 @@
 from datetime import timedelta
 
 from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.sites.models import Site
 from django.utils import timezone
@@ -10,16 +10,20 @@ from django.utils import timezone
 
 from django.contrib.flatpages.models import FlatPage
 
+from sewingworld.revalidation import revalidate
 from sewingworld.tasks import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW, PRIORITY_IDLE
 
 from reviews import get_review_model
 from reviews.signals import review_was_posted
 
-from shop.models import Product, Order, OrderItem, News
+from shop.filters import invalidate_product_facets
+from shop.models import Category, Product, ProductAvailability, Order, OrderItem, Stock, News, ShopUser
+from shop.models.basket import invalidate_user_discounts
+from shop.models.product import prices_changed, products_changed
 from shop.tasks import notify_user_order_collected, notify_user_order_delivered_shop, \
     notify_user_order_delivered, notify_user_review_products, notify_review_posted, \
     create_modulpos_order, delete_modulpos_order, notify_manager, notify_manager_sms, \
-    revalidate_nextjs, ym_upload_user, ym_upload_order
+    ym_upload_user, ym_upload_order, post_update_products
 
 import logging
 
@@ -32,10 +36,54 @@ SITE_YANDEX = Site.objects.get(domain='market.yandex.ru')
 @receiver(post_save, sender=OrderItem, dispatch_uid='order_item_saved_receiver')
 def order_item_saved(sender, **kwargs):
     order_item = kwargs['instance']
-    if order_item.tracker.has_changed('quantity'):
-        logger.error("### " + order_item.product.code + " saved in order_item_saved signal")
-        order_item.product.num = -1
-        order_item.product.save()
+    if order_item.tracker.has_changed('quantity') and order_item.order.status in Order.RESERVING_STATUSES:
+        ProductAvailability.objects.update_products([order_item.product_id])
+
+
+@receiver(post_delete, sender=OrderItem, dispatch_uid='order_item_deleted_receiver')
+def order_item_deleted(sender, **kwargs):
+    order_item = kwargs['instance']
+    if order_item.order.status in Order.RESERVING_STATUSES:
+        ProductAvailability.objects.update_products([order_item.product_id])
+
+
+@receiver(post_save, sender=Stock, dispatch_uid='stock_saved_receiver')
+def stock_saved(sender, **kwargs):
+    ProductAvailability.objects.update_products([kwargs['instance'].product_id])
+
+
+@receiver(post_save, sender=ShopUser, dispatch_uid='user_saved_discounts_receiver')
+def user_saved(sender, **kwargs):
+    user = kwargs['instance']
+    # only users with discount (now or before) affect basket discounts
+    if user.tracker.has_changed('discount') or user.tracker.has_changed('phone'):
+        if user.discount or user.tracker.previous('discount'):
+            invalidate_user_discounts()
+
+
+@receiver(post_delete, sender=ShopUser, dispatch_uid='user_deleted_discounts_receiver')
+def user_deleted(sender, **kwargs):
+    if kwargs['instance'].discount > 0:
+        invalidate_user_discounts()
+
+
+@receiver(post_save, sender=Product, dispatch_uid='product_saved_facets_receiver')
+@receiver(prices_changed, dispatch_uid='prices_changed_facets_receiver')
+@receiver(post_save, sender=Category, dispatch_uid='category_saved_facets_receiver')
+def product_facets_changed(sender, **kwargs):
+    invalidate_product_facets()
+
+
+@receiver(prices_changed, dispatch_uid='prices_changed_receiver')
+@receiver(products_changed, dispatch_uid='products_changed_receiver')
+def products_changed_revalidate(sender, product_ids, **kwargs):
+    post_update_products.s(sorted(product_ids)).delay()
+
+
+@receiver(post_save, sender=Category, dispatch_uid='category_saved_tree_receiver')
+@receiver(post_delete, sender=Category, dispatch_uid='category_deleted_tree_receiver')
+def category_tree_changed(sender, **kwargs):
+    Category.objects.invalidate_tree()
 
 
 @receiver(post_save, sender=Order, dispatch_uid='order_saved_receiver')
@@ -43,6 +91,9 @@ def order_saved(sender, **kwargs):
     order = kwargs['instance']
 
     if order.tracker.has_changed('status'):
+        if (order.status in Order.RESERVING_STATUSES) != (order.tracker.previous('status') in Order.RESERVING_STATUSES):
+            ProductAvailability.objects.update_products(order.items.values_list('product_id', flat=True))
+
         if not order.status:  # new order
             if order.delivery == Order.DELIVERY_EXPRESS and hasattr(order.site, 'profile') and order.site.profile.manager_phones:
                 for phone in order.site.profile.manager_phones.split(','):
@@ -115,21 +166,12 @@ def review_posted(sender, review, request, **kwargs):
 @receiver(post_save, sender=FlatPage, dispatch_uid='flatpage_saved_receiver')
 def page_saved(sender, **kwargs):
     page = kwargs['instance']
-    payload = {
-        'model': 'page',
-        'pk': page.pk,
-        'uri': page.url
-    }
-    for site in page.sites.exclude(profile__revalidation_token__exact=''):
-        revalidate_nextjs.s(site.domain, site.profile.revalidation_token, payload).apply_async(priority=PRIORITY_IDLE)
+    site_ids = page.sites.exclude(profile__revalidation_token__exact='').values_list('id', flat=True)
+    revalidate(site_ids, 'page', [{'pk': page.pk, 'uri': page.url}])
 
 
 @receiver(post_save, sender=News, dispatch_uid='news_saved_receiver')
 def news_saved(sender, **kwargs):
     news = kwargs['instance']
-    payload = {
-        'model': 'news',
-        'pk': news.pk
-    }
-    for site in news.sites.exclude(profile__revalidation_token__exact=''):
-        revalidate_nextjs.s(site.domain, site.profile.revalidation_token, payload).apply_async(priority=PRIORITY_IDLE)
+    site_ids = news.sites.exclude(profile__revalidation_token__exact='').values_list('id', flat=True)
+    revalidate(site_ids, 'news', [{'pk': news.pk}])
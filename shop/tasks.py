@@ -10,11 +10,9 @@ import os
 import re
 import tempfile
 
-import requests
-
 from collections import defaultdict
 from datetime import datetime, timedelta
-from importlib import import_module
+from itertools import batched
 from decimal import Decimal, ROUND_HALF_EVEN
 from urllib.parse import quote
 from urllib.request import Request, urlopen
@@ -23,12 +21,11 @@ from urllib.error import HTTPError
 from django.contrib.admin.models import LogEntry, CHANGE
 from django.contrib.contenttypes.models import ContentType
 from django.core import signing
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, ValidationError
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.core.mail import send_mail
 from django.core.validators import EmailValidator
 from django.conf import settings
-from django.db import connection, Error as DatabaseError
-from django.db.models import Q
+from django.db import connection, transaction, Error as DatabaseError
 from django.db.models.fields.json import JSONField
 from django.db.models.fields.related import RelatedField
 from django.db.models.fields.reverse_related import ForeignObjectRel
@@ -48,13 +45,21 @@ import reviews
 
 from unisender import Unisender
 
+from sewingworld.feeds import invalidate_feeds
 from sewingworld.models import SiteProfile
+from sewingworld.revalidation import revalidate_products, send_revalidation
 from sewingworld.sms import send_sms
-from sewingworld.tasks import single_instance_task, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW, PRIORITY_IDLE
+from sewingworld.tasks import single_instance_task, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 from sewingworld.templatetags.rupluralize import rupluralize
 
-from shop.models import ShopUser, ShopUserManager, Supplier, Currency, Product, Stock, Basket, Order
+from shop.filters import invalidate_product_facets
+from shop.lifecycle import delete_outdated_baskets, clear_expired_sessions, get_abandoned_baskets
+from shop.loyalty import load_user_bonuses, parse_bonus_records
+from shop.models import ShopUser, ShopUserManager, Supplier, Currency, Product, ProductAvailability, Stock, Basket, Order
+from shop.models.product import products_changed, reprice_kits
+
 
+AVAILABILITY_BATCH_SIZE = 5000
 
 SINGLE_DATE_FORMAT = 'j E'
 SINGLE_DATE_FORMAT_WITH_YEAR = 'j E Y'
@@ -89,17 +94,8 @@ class DecimalEncoder(json.JSONEncoder):
 
 @shared_task(queue="revalidation")  # , rate_limit='2/s')
 def revalidate_nextjs(domain, token, payload):
-    url = 'https://{}/api/revalidate'.format(domain)
-    request_data = {
-        'secret': token,
-        **payload
-    }
-    response = requests.post(url, json=request_data)
-    try:
-        response_data = response.json()
-        return response_data
-    except:
-        return False
+    """ Left for already queued revalidations, new ones are buffered by sewingworld.revalidation """
+    return send_revalidation(domain, token, payload)
 
 
 @shared_task(bind=True, queue="priority", autoretry_for=(DatabaseError,), max_retries=12, retry_backoff=300, retry_jitter=False)
@@ -351,43 +347,15 @@ def notify_review_posted(review_id):
 
 
 @shared_task(queue="revalidation")
-def post_update_product(product_id, origin):
-    product = Product.objects.get(pk=product_id)
-
-    if origin == 'admin':
-        product.update_fts_vector()
-
-    payload = {
-        'model': 'product',
-        'pk': product.pk,
-        'code': product.code
-    }
-    for site in product.sites.exclude(profile__revalidation_token__exact=''):
-        revalidate_nextjs.s(site.domain, site.profile.revalidation_token, payload).apply_async(priority=PRIORITY_IDLE)
-
+def post_update_product(product_id, origin=None):
+    """ Origin is not used anymore, it is left for already queued tasks """
+    revalidate_products([product_id])
     return None
 
 
 @shared_task(queue="priority")
 def post_update_products(product_ids):
-    nextjs_sites = defaultdict(list)
-
-    for product_id in product_ids:
-        product = Product.objects.get(pk=product_id)
-        for site in product.sites.exclude(profile__revalidation_token__exact=''):
-            nextjs_sites[site].append({'pk': product.pk, 'code': product.code})
-
-    num = 0
-    for site in nextjs_sites:
-        num += len(nextjs_sites[site])
-        for i in range(0, len(nextjs_sites[site]), 1000):
-            payload = {
-                'model': 'product',
-                'items': nextjs_sites[site][i:i + 1000]
-            }
-            revalidate_nextjs.s(site.domain, site.profile.revalidation_token, payload).apply_async(priority=PRIORITY_IDLE)
-
-    return num
+    return revalidate_products(product_ids)
 
 
 @shared_task(bind=True, queue="import", autoretry_for=(OSError, DatabaseError), retry_backoff=300, retry_jitter=False)
@@ -447,6 +415,12 @@ def update_1c_stocks(self):
     return 0
 
 
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
 class fragile(object):
     class Break(Exception):
         """Break out of the with statement"""
@@ -470,12 +444,6 @@ def import1c(file):
     log.error('Import1C')
     enable_flag('1C_IMPORT_RUNNING')
 
-    currencies = {}
-    def get_currency(code):
-        if code not in currencies:
-            currencies[code] = Currency.objects.get(pk=code)
-        return currencies[code]
-
     frozen_orders = Order.objects.filter(status=Order.STATUS_FROZEN)
     frozen_products = defaultdict(list)
     if frozen_orders.exists():
@@ -491,11 +459,6 @@ def import1c(file):
 
     log.info('Frozen products %s' % str(frozen_products.keys()))
 
-    stocks = list(Stock.objects.filter(~Q(correction=0)).values_list('product', 'supplier', 'correction', 'reason'))
-    corrected_stocks = defaultdict(dict)
-    for s in stocks:
-        corrected_stocks[s[0]][s[1]] = (s[2], s[3])
-
     import_dir = getattr(settings, 'SHOP_IMPORT_DIRECTORY', 'import')
     filepath = os.path.join(import_dir, file)
 
@@ -511,13 +474,17 @@ def import1c(file):
         os.rename(lastpath, penultpath)
     os.rename(filepath, lastpath)
 
-    table_copy = tempfile.TemporaryFile(mode='r+t')
+    """ parsed rows are loaded into staging tables and applied to products and stocks with set-based queries """
+    product_copy = tempfile.TemporaryFile(mode='r+t')
+    stock_copy = tempfile.TemporaryFile(mode='r+t')
 
     imported = 0
     updated = 0
     errors = []
-    products = set()
+    line_errors = {}
     updated_products = []
+    parse_errors = defaultdict(list)
+    changed_products = set()
     orders = set()
     suppliers = []
     date_reg = re.compile(r"\d{1,2}\.\d{2}\.\d{4} \d{1,2}:\d{2}:\d{2}")
@@ -551,103 +518,170 @@ def import1c(file):
         records = csv.DictReader(csvfile, delimiter=';', fieldnames=csv_fields, restkey='suppliers')
         for line in records:
             imported = imported + 1
-            try:
-                product = Product.objects.only(
-                    'forbid_ws_price_import',
-                    'forbid_price_import',
-                    'cur_code',
-                    'cur_price'
-                ).get(article=line['article'])
-                if line['sp_cur_code'] != '0':
-                    try:
-                        sp_cur_price = float(line['sp_cur_price'].replace('\xA0', ''))
-                        product.sp_cur_price = int(round(sp_cur_price))
-                        product.sp_cur_code = get_currency(line['sp_cur_code'])
-                    except ValueError:
-                        errors.append("%s: цена СП" % line['article'])
-                if line['ws_cur_code'] != '0' and not product.forbid_ws_price_import:
-                    try:
-                        ws_cur_price = float(line['ws_cur_price'].replace('\xA0', ''))
-                        if ws_cur_price > 0:
-                            product.ws_cur_price = Decimal(ws_cur_price).quantize(Decimal('0.01'), rounding=ROUND_HALF_EVEN)
-                        product.ws_cur_code = get_currency(line['ws_cur_code'])
-                    except ValueError:
-                        errors.append("%s: оптовая цена" % line['article'])
-                if line['cur_code'] != '0' and not product.forbid_price_import:
-                    try:
-                        cur_price = float(line['cur_price'].replace('\xA0', ''))
-                        if cur_price > 0 and product.cur_code.code == 643:
-                            cur_price = Decimal(cur_price).quantize(Decimal('1'), rounding=ROUND_HALF_EVEN)
-                            if product.cur_price != cur_price:
-                                updated_products.append(product.id)
-                            product.cur_price = cur_price
-                    except ValueError:
-                        errors.append("%s: розничная цена" % line['article'])
-                product.save()
-                products.add(product.id)
-                for idx, quantity in enumerate(line['suppliers']):
+            sp_cur_price = sp_cur_code = ws_cur_price = ws_cur_code = cur_price = None
+            if line['sp_cur_code'] != '0':
+                try:
+                    sp_cur_price = int(round(float(line['sp_cur_price'].replace('\xA0', ''))))
+                    sp_cur_code = int(line['sp_cur_code'])
+                except ValueError:
+                    sp_cur_price = None
+                    parse_errors[imported].append(('sp', "%s: цена СП" % line['article']))
+            if line['ws_cur_code'] != '0':
+                try:
+                    ws_cur_price = float(line['ws_cur_price'].replace('\xA0', ''))
+                    ws_cur_code = int(line['ws_cur_code'])
+                    if ws_cur_price > 0:
+                        ws_cur_price = Decimal(ws_cur_price).quantize(Decimal('0.01'), rounding=ROUND_HALF_EVEN)
+                    else:
+                        ws_cur_price = None
+                except ValueError:
+                    ws_cur_price = None
+                    parse_errors[imported].append(('ws', "%s: оптовая цена" % line['article']))
+            if line['cur_code'] != '0':
+                try:
+                    cur_price = float(line['cur_price'].replace('\xA0', ''))
+                    if cur_price > 0:
+                        cur_price = Decimal(cur_price).quantize(Decimal('1'), rounding=ROUND_HALF_EVEN)
+                    else:
+                        cur_price = None
+                except ValueError:
+                    parse_errors[imported].append(('cur', "%s: розничная цена" % line['article']))
+            product_copy.write('\t'.join(map(copy_value, (
+                imported, line['article'], sp_cur_price, sp_cur_code, ws_cur_price, ws_cur_code, cur_price
+            ))) + '\n')
+            for idx, quantity in enumerate(line.get('suppliers', [])):
+                try:
                     if suppliers[idx] is None:
                         continue
-                    try:
-                        quantity = float(quantity.replace('\xA0', '').replace(',', '.'))
-                        correction, reason = corrected_stocks.get(product.id, {}).get(suppliers[idx].id, (0, ''))
-                        if (quantity or correction) and product.article != 'г66356':
-                            table_copy.write('{}\t{}\t{}\t{}\t{}\n'.format(quantity, product.id, suppliers[idx].id, correction, reason))
-                        try:
-                            del corrected_stocks[product.id][suppliers[idx].id]
-                            if not corrected_stocks[product.id]:
-                                del corrected_stocks[product.id]
-                        except KeyError:
-                            pass
-                        """
-                        count = Stock.objects.filter(product=product, supplier=suppliers[idx]).update(quantity=quantity)
-                        if count and quantity == 0.0:
-                            s = Stock.objects.get(product=product, supplier=suppliers[idx])
-                            if s.correction == 0.0:
-                                s.delete()
-                        if not count and quantity > 0.0:
-                            s = Stock.objects.create(product=product, supplier=suppliers[idx], quantity=quantity)
-                        """
-                    except ValueError:
-                        errors.append("%s: состояние складa" % line['article'])
-                    except IndexError:
-                        errors.append("%s: неправильное количество складов" % line['article'])
-                updated = updated + 1
-            except MultipleObjectsReturned:
-                errors.append("%s: артикль не уникален" % line['article'])
-            except ObjectDoesNotExist:
-                # errors.append("%s: товар отсутствует" % line['article'])
-                pass
-
-        if updated_products:
-            post_update_products.s(updated_products).delay()
-
-        for product, stocks in corrected_stocks.items():
-            for stock, (correction, reason) in stocks.items():
-                table_copy.write('{}\t{}\t{}\t{}\t{}\n'.format(0, product, stock, correction, reason))
-        table_copy.seek(0)
+                    quantity = float(quantity.replace('\xA0', '').replace(',', '.'))
+                    if quantity:
+                        stock_copy.write('{}\t{}\t{}\n'.format(imported, suppliers[idx].id, quantity))
+                except ValueError:
+                    parse_errors[imported].append(('stock', "%s: состояние складa" % line['article']))
+                except IndexError:
+                    parse_errors[imported].append(('stock', "%s: неправильное количество складов" % line['article']))
+
+        product_copy.seek(0)
+        stock_copy.seek(0)
         with connection.cursor() as cursor:
-            log.info('Start 1C_IMPORT_COPYING')
-            enable_flag('1C_IMPORT_COPYING')
-            cursor.execute("BEGIN")
-            cursor.execute("DELETE FROM shop_stock")
-            # cursor.execute("TRUNCATE TABLE shop_stock RESTART IDENTITY")
-            log.info('Continue 1C_IMPORT_COPYING')
-            cursor.copy_from(table_copy, 'shop_stock', columns=('quantity', 'product_id', 'supplier_id', 'correction', 'reason'))
-            cursor.execute("COMMIT")
-            disable_flag('1C_IMPORT_COPYING')
-            log.info('Stop 1C_IMPORT_COPYING')
-    table_copy.close()
+            try:
+                with transaction.atomic():
+                    cursor.execute("""CREATE TEMPORARY TABLE import1c_product (line integer PRIMARY KEY, article text,
+                                      sp_cur_price numeric(10,2), sp_cur_code integer, ws_cur_price numeric(10,2),
+                                      ws_cur_code integer, cur_price numeric(10,2))""")
+                    cursor.execute("CREATE TEMPORARY TABLE import1c_stock (line integer, supplier_id bigint, quantity double precision)")
+                    cursor.copy_from(product_copy, 'import1c_product')
+                    cursor.copy_from(stock_copy, 'import1c_stock')
+                    cursor.execute("ANALYZE import1c_product")
+
+                    cursor.execute("""SELECT s.line, s.article FROM import1c_product s INNER JOIN shop_product p ON (p.article = s.article)
+                                      GROUP BY s.line, s.article HAVING COUNT(p.id) > 1""")
+                    for line, article in cursor.fetchall():
+                        line_errors[line] = ["%s: артикль не уникален" % article]
+
+                    """ rows with unknown currency are skipped as if product is missing """
+                    cursor.execute("""CREATE TEMPORARY TABLE import1c_matched AS
+                                      SELECT s.*, p.id AS product_id, p.forbid_price_import, p.forbid_ws_price_import
+                                      FROM import1c_product s INNER JOIN shop_product p ON (p.article = s.article)
+                                      WHERE NOT EXISTS (SELECT 1 FROM shop_product d WHERE d.article = s.article AND d.id <> p.id)
+                                      AND (s.sp_cur_code IS NULL OR s.sp_cur_code IN (SELECT code FROM shop_currency))
+                                      AND (s.ws_cur_code IS NULL OR p.forbid_ws_price_import
+                                           OR s.ws_cur_code IN (SELECT code FROM shop_currency))""")
+                    cursor.execute("CREATE INDEX ON import1c_matched (product_id)")
+                    cursor.execute("ANALYZE import1c_matched")
+
+                    cursor.execute("SELECT line, product_id, forbid_price_import, forbid_ws_price_import FROM import1c_matched")
+                    for line, product_id, forbid_price_import, forbid_ws_price_import in cursor.fetchall():
+                        updated = updated + 1
+                        line_errors[line] = [error for kind, error in parse_errors.get(line, [])
+                                             if not (kind == 'ws' and forbid_ws_price_import or kind == 'cur' and forbid_price_import)]
+
+                    cursor.execute("""SELECT p.id FROM shop_product p INNER JOIN
+                                      (SELECT DISTINCT ON (product_id) * FROM import1c_matched ORDER BY product_id, line DESC) m
+                                      ON (p.id = m.product_id) WHERE m.cur_price IS NOT NULL AND NOT p.forbid_price_import
+                                      AND p.cur_code_id = 643 AND p.cur_price <> m.cur_price""")
+                    updated_products = [row[0] for row in cursor.fetchall()]
+
+                    cursor.execute("""UPDATE shop_product p SET
+                                          sp_cur_price = COALESCE(m.sp_cur_price, p.sp_cur_price),
+                                          sp_cur_code_id = COALESCE(m.sp_cur_code, p.sp_cur_code_id),
+                                          ws_cur_price = CASE WHEN p.forbid_ws_price_import THEN p.ws_cur_price
+                                                         ELSE COALESCE(m.ws_cur_price, p.ws_cur_price) END,
+                                          ws_cur_code_id = CASE WHEN p.forbid_ws_price_import THEN p.ws_cur_code_id
+                                                           ELSE COALESCE(m.ws_cur_code, p.ws_cur_code_id) END,
+                                          cur_price = CASE WHEN p.forbid_price_import OR p.cur_code_id <> 643 THEN p.cur_price
+                                                      ELSE COALESCE(m.cur_price, p.cur_price) END
+                                      FROM (SELECT DISTINCT ON (product_id) * FROM import1c_matched ORDER BY product_id, line DESC) m
+                                      WHERE p.id = m.product_id""")
+                    cursor.execute("""UPDATE shop_product p SET price = p.cur_price * c.rate, ws_price = p.ws_cur_price * w.rate,
+                                          sp_price = p.sp_cur_price * s.rate
+                                      FROM shop_currency c, shop_currency w, shop_currency s
+                                      WHERE p.id IN (SELECT product_id FROM import1c_matched) AND c.code = p.cur_code_id
+                                      AND w.code = p.ws_cur_code_id AND s.code = p.sp_cur_code_id AND (NOT p.recalculate_price
+                                      OR NOT EXISTS (SELECT 1 FROM shop_productset ps WHERE ps.declaration_id = p.id))""")
+
+                    """ recalculate prices of affected product sets once, in dependency order """
+                    cursor.execute("SELECT DISTINCT product_id FROM import1c_matched")
+                    updated_products.extend(reprice_kits([row[0] for row in cursor.fetchall()]))
+
+                """ merge new stock into shop_stock touching only changed rows, so readers are never blocked by full table rewrite """
+                log.info('Start 1C_IMPORT_COPYING')
+                enable_flag('1C_IMPORT_COPYING')
+                with transaction.atomic():
+                    cursor.execute("""CREATE TEMPORARY TABLE import1c_stock_new AS
+                                      SELECT COALESCE(i.quantity, 0) AS quantity, COALESCE(i.product_id, c.product_id) AS product_id,
+                                             COALESCE(i.supplier_id, c.supplier_id) AS supplier_id,
+                                             COALESCE(c.correction, 0) AS correction, COALESCE(c.reason, '') AS reason
+                                      FROM (SELECT DISTINCT ON (m.product_id, s.supplier_id) m.product_id, s.supplier_id, s.quantity
+                                            FROM import1c_stock s INNER JOIN import1c_matched m ON (m.line = s.line)
+                                            WHERE m.article <> 'г66356' ORDER BY m.product_id, s.supplier_id, m.line DESC) i
+                                      FULL OUTER JOIN (SELECT product_id, supplier_id, correction, reason FROM shop_stock
+                                                       WHERE correction <> 0) c
+                                      ON (c.product_id = i.product_id AND c.supplier_id = i.supplier_id)""")
+                    cursor.execute("CREATE UNIQUE INDEX ON import1c_stock_new (product_id, supplier_id)")
+                    cursor.execute("ANALYZE import1c_stock_new")
+                    log.info('Continue 1C_IMPORT_COPYING')
+                    cursor.execute("""DELETE FROM shop_stock s WHERE NOT EXISTS (SELECT 1 FROM import1c_stock_new n
+                                      WHERE n.product_id = s.product_id AND n.supplier_id = s.supplier_id) RETURNING s.product_id""")
+                    changed_products.update(row[0] for row in cursor.fetchall())
+                    cursor.execute("""UPDATE shop_stock s SET quantity = n.quantity, correction = n.correction, reason = n.reason
+                                      FROM import1c_stock_new n WHERE n.product_id = s.product_id AND n.supplier_id = s.supplier_id
+                                      AND (s.quantity <> n.quantity OR s.correction <> n.correction OR s.reason <> n.reason)
+                                      RETURNING s.product_id""")
+                    changed_products.update(row[0] for row in cursor.fetchall())
+                    cursor.execute("""INSERT INTO shop_stock (quantity, product_id, supplier_id, correction, reason)
+                                      SELECT n.quantity, n.product_id, n.supplier_id, n.correction, n.reason FROM import1c_stock_new n
+                                      WHERE NOT EXISTS (SELECT 1 FROM shop_stock s
+                                                        WHERE s.product_id = n.product_id AND s.supplier_id = n.supplier_id)
+                                      RETURNING product_id""")
+                    changed_products.update(row[0] for row in cursor.fetchall())
+                disable_flag('1C_IMPORT_COPYING')
+                log.info('Stop 1C_IMPORT_COPYING')
+            finally:
+                cursor.execute("DROP TABLE IF EXISTS import1c_product, import1c_stock, import1c_matched, import1c_stock_new")
+
+        invalidate_product_facets()
+        invalidate_feeds()
+        log.info('Stock changed for %d products' % len(changed_products))
+
+    for line in sorted(line_errors.keys()):
+        errors.extend(line_errors[line])
+
+    product_copy.close()
+    stock_copy.close()
     tmp_file.close()
 
-    for product_id in products:
-        product = Product.objects.only('num').get(pk=product_id)
-        product.num = -1
-        product.save()
-        if product_id in frozen_products.keys() and product.instock > 0:
+    available_products = set()
+    for chunk in batched(sorted(changed_products), AVAILABILITY_BATCH_SIZE):
+        available_products.update(ProductAvailability.objects.update_products(chunk))
+
+    if updated_products or available_products:
+        products_changed.send(sender=Product, product_ids=available_products.union(updated_products))
+
+    for product_id, instock in Product.objects.filter(pk__in=frozen_products.keys()).values_list('id', 'num'):
+        if instock > 0:
             orders.update(frozen_products[product_id])
-        if product_id in frozen_products.keys():
-            log.error('F %d %d' % (product.pk, product.instock))
+        log.error('F %d %d' % (product_id, instock))
 
     log.info('Frozen orders %s' % str(orders))
 
@@ -669,14 +703,13 @@ def import1c(file):
 @shared_task(autoretry_for=(EnvironmentError, DatabaseError), retry_backoff=60, retry_jitter=False)
 def remove_outdated_baskets():
     threshold = timezone.now() - timedelta(seconds=settings.SESSION_COOKIE_AGE)
-    baskets = Basket.objects.filter(created__lt=threshold)
-    num = len(baskets)
-    for basket in baskets.all():
-        basket.delete()
-    log.info('Deleted %d baskets' % num)
-    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
-    SessionStore.clear_expired()
-    log.info('Cleared expired sessions')
+    baskets, items = delete_outdated_baskets(threshold)
+    log.info('Deleted %d baskets with %d items' % (baskets, items))
+    sessions = clear_expired_sessions()
+    if sessions is None:
+        log.info('Cleared expired sessions')
+    else:
+        log.info('Cleared %d expired sessions' % sessions)
 
 
 @shared_task(bind=True, autoretry_for=(EnvironmentError, DatabaseError), retry_backoff=3, retry_jitter=False)
@@ -736,36 +769,16 @@ def notify_abandoned_basket(self, basket_id, email, phone):
 
 @shared_task(autoretry_for=(EnvironmentError, DatabaseError), retry_backoff=3, retry_jitter=False)
 def notify_abandoned_baskets(first_try=True):
-    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
-
     if first_try:
         lt = timezone.now() - timedelta(hours=3)
         gt = lt - timedelta(hours=1)
     else:
         lt = timezone.now() - timedelta(days=3)
         gt = lt - timedelta(days=1)
-    baskets = Basket.objects.filter(secondary=False, created__lt=lt, created__gte=gt)
     num = 0
-    for basket in baskets.all():
-        if basket.items.count() == 0:
-            continue
-
-        email = None
-        phone = None
-
-        session = SessionStore(session_key=basket.session_id).load()
-        uid = session.get('_auth_user_id')
-        if uid:
-            user = ShopUser.objects.get(id=uid)
-            if user.email:
-                email = user.email
-            if user.phone:
-                phone = user.phone
-        if phone is None and basket.phone:
-            phone = basket.phone
-
+    for basket_id, email, phone in get_abandoned_baskets(gt, lt):
         if email:  # or phone: отключили отправку смс
-            notify_abandoned_basket.delay(basket.id, email, phone)
+            notify_abandoned_basket.delay(basket_id, email, phone)
             num = num + 1
     log.info('Sent notifications for %d abandoned baskets' % num)
     return num
@@ -938,7 +951,6 @@ def update_cbrf_currencies(self):
 @shared_task(bind=True, autoretry_for=(OSError, DatabaseError), retry_backoff=600, retry_jitter=False)
 def update_user_bonuses(self):
     reload_maybe()
-    bonused_users = set(ShopUser.objects.filter(bonuses__gt=0).values_list('id', flat=True))
     filename = 'БонусныеБаллыИнфо.txt'  # БонусныеБаллыНаДР.txt
     url = 'https://cloud-api.yandex.net/v1/disk/resources?path={}'.format(quote('disk:/' + filename))
     headers = {
@@ -962,40 +974,11 @@ def update_user_bonuses(self):
         if md5 != bonus_md5:
             log.error('MD5 checksums differ')
             raise self.retry(countdown=3600, max_retries=4)  # 1 hour
-        num = 0
         records = csv.DictReader(io.StringIO(result.decode('windows-1251')), delimiter=';')
         log.info('Processing file')
-        for line in records:
-            try:
-                if line['ШтрихКод'] and line['КоличествоБаллов']:
-                    bonuses = float(line['КоличествоБаллов'].replace('\xA0', '').replace(' ', '').replace(',', '.'))
-                    if bonuses < 0:
-                        continue
-                    user, created = ShopUser.objects.get_or_create(phone=ShopUserManager.normalize_phone(line['ШтрихКод']))
-                    user.bonuses = int(bonuses)
-                    if not created:
-                        bonused_users.discard(user.id)
-                    if line['КСписанию']:
-                        expiring_bonuses = float(line['КСписанию'].replace('\xA0', '').replace(' ', '').replace(',', '.'))
-                        user.expiring_bonuses = int(expiring_bonuses)
-                        if line['ДатаСписания']:
-                            expiration_date = datetime.strptime(line['ДатаСписания'], '%d.%m.%Y %H:%M:%S')
-                            user.expiration_date = timezone.make_aware(expiration_date)
-                    if not user.name:
-                        name = line['ФИО']
-                        if name and not name.startswith('Держатель карты'):
-                            name = re.sub(r'[:,]?\s?(?:Штрихкод)?:?\s?\d+', '', name)
-                            user.name = name.title()
-                    user.save()
-                    num = num + 1
-            except ValueError:
-                log.error("Wrong bonus number '%s' for '%s'" % (line['КоличествоБаллов'], line['ШтрихКод']))
-        for user_id in bonused_users:
-            user = ShopUser.objects.get(pk=user_id)
-            user.bonuses = 0
-            user.save()
-            num = num + 1
-        return num
+        result = load_user_bonuses(parse_bonus_records(records))
+        log.info('Created {created}, updated {updated} and zeroed {zeroed} bonused users'.format(**result))
+        return result
     except HTTPError as e:
         content = e.read()
         error = json.loads(content.decode('utf-8'))
@@ -1140,7 +1123,7 @@ def ym_upload_user(user_id, order_id):
 
 @shared_task(autoretry_for=(OSError, DatabaseError), retry_backoff=600, retry_jitter=False)
 def ym_upload_order(order_id):
-    order = Order.objects.get(id=order_id)
+    order = Order.objects.with_totals().select_related('user').get(id=order_id)
     data = {
         "orders": [
             {
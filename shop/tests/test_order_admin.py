@@ -0,0 +1,52 @@
+from unittest import mock
+
+from django.contrib import admin
+from django.contrib.admin.utils import lookup_field
+from django.contrib.sites.models import Site
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from shop.models import Courier, Manager, Order, OrderItem, Product, ShopUser
+
+
+class OrderChangelistQueriesTest(TestCase):
+    """ Order changelist page is fetched with the same number of queries whatever the page size is """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.site = Site.objects.create(domain='test.sewing-world.ru', name='test')
+        cls.superuser = ShopUser.objects.create_superuser('+79000000000', 'password')
+        cls.managers = Manager.objects.bulk_create([Manager(name='manager {}'.format(num)) for num in range(3)])
+        cls.couriers = Courier.objects.bulk_create([Courier(name='courier {}'.format(num)) for num in range(3)])
+        cls.products = Product.objects.bulk_create([Product(code='test{}'.format(num), title='product {}'.format(num), price=100 * (num + 1))
+                                                    for num in range(5)])
+
+    def create_orders(self, start, count):
+        # orders are created without signals, they would schedule notifications
+        users = ShopUser.objects.bulk_create([ShopUser(phone='+7901{:07d}'.format(num), name='user {}'.format(num))
+                                              for num in range(start, start + count)])
+        orders = Order.objects.bulk_create([Order(site=self.site, user=user, manager=self.managers[num % 3], courier=self.couriers[num % 3],
+                                                  owner=self.superuser if num % 2 else None, name=user.name, phone=user.phone)
+                                            for num, user in enumerate(users)])
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=product, product_price=product.price, quantity=num % 3 + 1)
+                                       for num, order in enumerate(orders) for product in self.products[:num % 5 + 1]])
+
+    def count_changelist_queries(self):
+        model_admin = admin.site._registry[Order]
+        request = RequestFactory().get('/admin/shop/order/', {'status': 'all'})
+        request.user = self.superuser
+        with mock.patch.object(model_admin, 'list_per_page', 500), CaptureQueriesContext(connection) as context:
+            changelist = model_admin.get_changelist_instance(request)
+            for order in changelist.result_list:
+                for name in model_admin.get_list_display(request):
+                    lookup_field(name, order, model_admin)
+        return len(changelist.result_list), len(context.captured_queries)
+
+    def test_query_budget(self):
+        self.create_orders(0, 10)
+        num_small, queries_small = self.count_changelist_queries()
+        self.create_orders(10, 90)
+        num_large, queries_large = self.count_changelist_queries()
+        self.assertEqual((num_small, num_large), (10, 100))
+        self.assertEqual(queries_small, queries_large)
@@ -7,6 +7,7 @@ from django.dispatch import receiver
 from sewingworld.tasks import PRIORITY_IDLE
 
 from shop.models import Product, ProductIntegration, Integration
+from shop.models.availability import availability_changed
 
 
 logger = logging.getLogger('wb')
@@ -29,6 +30,12 @@ def product_saved(sender, **kwargs):
                 pass
 
 
+@receiver(availability_changed, dispatch_uid='availability_changed_wb_receiver')
+def availability_changed_wb(sender, product_ids, **kwargs):
+    integrations = [integration.pk for integration in SITE_WB.integrations.all() if integration.settings.get('warehouse_id', 0) != 0]
+    ProductIntegration.objects.filter(product_id__in=product_ids, integration_id__in=integrations).update(notify_stock=True)
+
+
 @receiver(m2m_changed, sender=Product.integrations.through, dispatch_uid='product_integration_changed_wb_receiver')
 def product_integration_changed(sender, **kwargs):  # used to clean remote warehouse if product is removed from integration
     product = kwargs.get('instance', None)
@@ -1,29 +1,28 @@
 import json
 import logging
 from datetime import datetime
-from importlib import import_module
 from itertools import batched
-from time import sleep
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError
 
 import django.db
-from django.db.models import Sum, F, Q
-from django.conf import settings
-from django.contrib import auth
 from django.contrib.sites.models import Site
 
 from celery import shared_task
 
+from sewingworld.integration_client import IntegrationClient, ResponseError, get_user_session
 from sewingworld.tasks import PRIORITY_IDLE
 
-from shop.models import Integration, Basket, Order, Product, ProductIntegration, ShopUser
+from shop.models import Integration, Basket, Order, Product, ProductAvailability, ProductIntegration, ShopUser
 from shop.tasks import send_message, update_order
 
 
 logger = logging.getLogger('wb')
 SITE_WB = Site.objects.get(domain='wildberries.ru')
 
+WB_CARDS_LIMIT = 100  # maximum page size of cards list
+WB_CONTENT_RATE = 100  # content API requests per minute
+WB_MARKETPLACE_RATE = 300  # marketplace API requests per minute
+WB_STOCKS_BATCH_SIZE = 1000  # maximum number of stocks in one request
+
 WB_ORDER_STATUS = {
     # supplierStatus
     'new': None,                        # новое сборочное задание
@@ -49,31 +48,28 @@ class TaskFailure(Exception):
     pass
 
 
+def get_client(integration, api='marketplace', rate=None):
+    """ API client of the account, rate is requests per minute which is limited separately for each API """
+    headers = {
+        'Authorization': integration.settings.get('api_key', ''),
+        'Content-Type': 'application/json; charset=utf-8'
+    }
+    return IntegrationClient('wb', account=integration.utm_source, base_url='https://{}-api.wildberries.ru'.format(api), headers=headers,
+                             rate=rate, period=60, limit_key='wb-{}-{}'.format(api, integration.utm_source))
+
+
 def get_warehouses(account):
     integration = Integration.objects.get(utm_source=account)
 
-    api_key = integration.settings.get('api_key', '')
-
-    url = 'https://marketplace-api.wildberries.ru/api/v3/warehouses'
-    headers = {
-        'Authorization': api_key
-    }
-    request = Request(url, None, headers)
-    logger.info('<<< ' + request.full_url)
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client(integration).get('/api/v3/warehouses')
+        result = response.json()
         logger.debug(result)
         warehouses = {warehouse['id']: warehouse['name'] for warehouse in result}
         return warehouses
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
-        logger.error(error)
-        try:
-            message = error.get('detail', 'Неизвестная ошибка взаимодействия с Wildberries!')
-        except:  # noqa #722
-            message = error
+    except ResponseError as e:
+        logger.error(e.content)
+        message = e.message('Неизвестная ошибка взаимодействия с Wildberries!', 'detail')
         raise TaskFailure(message) from e
 
 
@@ -83,17 +79,9 @@ def get_integration_new_orders(self, account):
     warehouseId = integration.settings.get('warehouse_id', '')
     warehouses = get_warehouses(account)
 
-    api_key = integration.settings.get('api_key', '')
-
-    url = 'https://marketplace-api.wildberries.ru/api/v3/orders/new'
-    headers = {
-        'Authorization': api_key
-    }
-    request = Request(url, None, headers)
-    logger.info('<<< ' + request.full_url)
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client(integration).get('/api/v3/orders/new')
+        result = response.json()
         logger.debug(result)
         num = 0
         user = ShopUser.objects.get(phone='0003')
@@ -102,13 +90,7 @@ def get_integration_new_orders(self, account):
          'createdAt': '2023-10-13T06:35:01Z', 'offices': ['Москва_Север'], 'skus': ['4650254750105'], 'id': 1119437040, 'warehouseId': 825523, 'nmId': 181465736,
          'chrtId': 299656738, 'price': 53900, 'convertedPrice': 53900, 'currencyCode': 643, 'convertedCurrencyCode': 643, 'cargoType': 1, 'isLargeCargo': False}]}
         """
-        SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
-        session = SessionStore()
-        session.cycle_key()
-        session[auth.SESSION_KEY] = user._meta.pk.value_to_string(user)
-        session[auth.BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
-        session[auth.HASH_SESSION_KEY] = user.get_session_auth_hash()
-        session.save()
+        session_key = get_user_session(user)
         for wb_order in result.get('orders', []):
             logger.debug(wb_order)
             wirehouse_id = wb_order.get('warehouseId', 0)
@@ -120,7 +102,7 @@ def get_integration_new_orders(self, account):
             if order is not None:
                 continue
 
-            basket = Basket.objects.create(site=integration.site, session_id=session.session_key, utm_source=account, secondary=True)
+            basket = Basket.objects.create(site=integration.site, session_id=session_key, utm_source=account, secondary=True)
 
             has_problem = False
             for sku in wb_order.get('skus', []):
@@ -156,14 +138,9 @@ def get_integration_new_orders(self, account):
 
             num = num + 1
         return num
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
-        logger.error(error)
-        try:
-            message = error.get('detail', 'Неизвестная ошибка взаимодействия с Wildberries!')
-        except:  # noqa E722
-            message = error
+    except ResponseError as e:
+        logger.error(e.content)
+        message = e.message('Неизвестная ошибка взаимодействия с Wildberries!', 'detail')
         raise TaskFailure(message) from e
 
 
@@ -184,18 +161,10 @@ def get_integration_detached_orders(self, account):
     if len(list(filter(lambda k: k != warehouseId, warehouses.keys()))) == 0:
         return
 
-    api_key = integration.settings.get('api_key', '')
-
     date_from = int(datetime.now().timestamp()) - 30 * 60  # last 30 minutes
-    url = 'https://marketplace-api.wildberries.ru/api/v3/orders?limit=1000&next=0&dateFrom=' + str(date_from)
-    headers = {
-        'Authorization': api_key
-    }
-    request = Request(url, None, headers)
-    logger.info('<<< ' + request.full_url)
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client(integration).get('/api/v3/orders', params={'limit': 1000, 'next': 0, 'dateFrom': date_from})
+        result = response.json()
         logger.debug(result)
         num = 0
         user = ShopUser.objects.get(phone='0003')
@@ -204,13 +173,7 @@ def get_integration_detached_orders(self, account):
          'createdAt': '2023-10-13T06:35:01Z', 'offices': ['Москва_Север'], 'skus': ['4650254750105'], 'id': 1119437040, 'warehouseId': 825523, 'nmId': 181465736,
          'chrtId': 299656738, 'price': 53900, 'convertedPrice': 53900, 'currencyCode': 643, 'convertedCurrencyCode': 643, 'cargoType': 1, 'isLargeCargo': False}]}
         """
-        SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
-        session = SessionStore()
-        session.cycle_key()
-        session[auth.SESSION_KEY] = user._meta.pk.value_to_string(user)
-        session[auth.BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
-        session[auth.HASH_SESSION_KEY] = user.get_session_auth_hash()
-        session.save()
+        session_key = get_user_session(user)
         for wb_order in result.get('orders', []):
             logger.debug(wb_order)
             warehouse_id = wb_order.get('warehouseId', 0)
@@ -224,7 +187,7 @@ def get_integration_detached_orders(self, account):
             if order is not None:
                 continue
 
-            basket = Basket.objects.create(site=integration.site, session_id=session.session_key, utm_source=account, secondary=True)
+            basket = Basket.objects.create(site=integration.site, session_id=session_key, utm_source=account, secondary=True)
 
             has_problem = False
             for sku in wb_order.get('skus', []):
@@ -254,14 +217,9 @@ def get_integration_detached_orders(self, account):
 
             num = num + 1
         return num
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
-        logger.error(error)
-        try:
-            message = error.get('detail', 'Неизвестная ошибка взаимодействия с Wildberries!')
-        except:  # noqa E722
-            message = error
+    except ResponseError as e:
+        logger.error(e.content)
+        message = e.message('Неизвестная ошибка взаимодействия с Wildberries!', 'detail')
         raise TaskFailure(message) from e
 
 
@@ -277,26 +235,15 @@ def get_detached_orders():
 @shared_task(bind=True, autoretry_for=(OSError, django.db.Error, json.decoder.JSONDecodeError), retry_backoff=300, retry_jitter=False)
 def get_integration_order_statuses(self, account):
     integration = Integration.objects.get(utm_source=account)
-    api_key = integration.settings.get('api_key', '')
-
-    url = 'https://marketplace-api.wildberries.ru/api/v3/orders/status'
-    headers = {
-        'Authorization': api_key,
-        'Content-Type': 'application/json; charset=utf-8'
-    }
 
     orders = list(map(lambda n: int(n), Order.objects.filter(integration=integration, status__lt=Order.STATUS_DONE).values_list('delivery_tracking_number', flat=True)))
     if not orders:
         return 0
 
     data = {'orders': orders}
-    data_encoded = json.dumps(data).encode('utf-8')
-    request = Request(url, data_encoded, headers, method='POST')
-    logger.info('<<< ' + request.full_url)
-    logger.info(data_encoded)
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client(integration).post('/api/v3/orders/status', data)
+        result = response.json()
         logger.debug(result)
         num = 0
         for wb_order in result.get('orders', []):
@@ -320,14 +267,9 @@ def get_integration_order_statuses(self, account):
                 update_order.delay(order.pk, update)
                 num = num + 1
         return num
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
-        logger.error(error)
-        try:
-            message = error.get('detail', 'Неизвестная ошибка взаимодействия с Wildberries!')
-        except:  # noqa E722
-            message = error
+    except ResponseError as e:
+        logger.error(e.content)
+        message = e.message('Неизвестная ошибка взаимодействия с Wildberries!', 'detail')
         raise TaskFailure(message) from e
 
 
@@ -340,115 +282,135 @@ def get_order_statuses():
     return total
 
 
-@shared_task(bind=True, autoretry_for=(OSError, django.db.Error, json.decoder.JSONDecodeError), rate_limit='1/s', retry_backoff=300, retry_jitter=False)
-def notify_product_stocks(self, products, account, zero_out=False):
-    integration = Integration.objects.get(utm_source=account)
+def disable_product_integration(product_integration, reason):
+    product_integration.delete()
+    for phone in SITE_WB.profile.manager_phones.split(','):
+        send_message.s(phone, 'У товара {} отключена интеграция "{}" ({})'.format(
+            product_integration.product.code, product_integration.integration.utm_source, reason)).apply_async(priority=PRIORITY_IDLE)
 
-    api_key = integration.settings.get('api_key', '')
 
-    headers = {
-        'Authorization': api_key,
-        'Content-Type': 'application/json; charset=utf-8'
-    }
+def resolve_chrt_ids(integration, product_integrations):
+    """
+    Finds chrtIDs of products which do not have them yet by paging through seller cards list and
+    stores them in product integration meta. Returns False if API limit is exceeded.
+    """
+    missing = {}
+    for product_integration in product_integrations:
+        if product_integration.meta is not None and product_integration.meta.get('chrtID', None) is not None:
+            continue
+        if not product_integration.product.gtin:
+            disable_product_integration(product_integration, 'отсутствует штрих-код')
+            continue
+        missing[product_integration.product.gtin] = product_integration
+    if not missing:
+        return True
 
-    products = Product.objects.filter(pk__in=products)
-    product_integrations = {}
-    chrtIDs = {}
-
-    url = 'https://content-api.wildberries.ru/content/v2/get/cards/list'
-    for product in products:
-        product_integration = ProductIntegration.objects.order_by().filter(product=product, integration=integration).first()
-        product_integrations[product.pk] = product_integration
-        if product_integration.meta is None or product_integration.meta.get('chrtID', None) is None:
-            if not product.gtin:
-                product_integration.delete()
-                for phone in SITE_WB.profile.manager_phones.split(','):
-                    send_message.s(phone, 'У товара {} отключена интеграция "{}" (отсутствует штрих-код)'.format(product.code, integration.utm_source)).apply_async(priority=PRIORITY_IDLE)
-                continue
-            data = {'settings': {'filter': {'textSearch': product.gtin, 'withPhoto': -1}}}
-            data_encoded = json.dumps(data).encode('utf-8')
-            request = Request(url, data_encoded, headers, method='POST')
-            logger.info('<<< ' + request.full_url)
-            logger.info(data_encoded)
-            try:
-                sleep(10)
-                response = urlopen(request)
-                result = json.loads(response.read().decode('utf-8'))
-                for card in result.get('cards', []):
-                    for size in card.get('sizes', []):
-                        if product.gtin in size.get('skus', []):
-                            product_integration.meta = {'chrtID': size.get('chrtID')}
-                            product_integration.save()
-                if product_integration.meta is None or product_integration.meta.get('chrtID', None) is None:
-                    product_integration.delete()
-                    for phone in SITE_WB.profile.manager_phones.split(','):
-                        send_message.s(phone, 'У товара {} отключена интеграция "{}" (не найден штрих-код)'.format(product.code, integration.utm_source)).apply_async(priority=PRIORITY_IDLE)
-                    continue
-            except HTTPError as e:
-                content = e.read()
-                error = json.loads(content.decode('utf-8'))
-                logger.error(error)
-                if error.get('status', 0) == 429:
-                    return False
-                else:
-                    continue
-        chrtIDs[product.gtin] = product_integration.meta.get('chrtID')
+    client = get_client(integration, 'content', WB_CONTENT_RATE)
+    resolved = []
+    cursor = {'limit': WB_CARDS_LIMIT}
+    exhausted = False
+    while missing and not exhausted:
+        data = {'settings': {'cursor': cursor, 'filter': {'withPhoto': -1}}}
+        try:
+            response = client.post('/content/v2/get/cards/list', data)
+            result = response.json()
+        except ResponseError as e:
+            logger.error(e.content)
+            ProductIntegration.objects.bulk_update(resolved, ['meta'])
+            return e.code != 429
+        cards = result.get('cards', [])
+        for card in cards:
+            for size in card.get('sizes', []):
+                for sku in size.get('skus', []):
+                    product_integration = missing.pop(sku, None)
+                    if product_integration is not None:
+                        product_integration.meta = dict(product_integration.meta or {}, chrtID=size.get('chrtID'))
+                        resolved.append(product_integration)
+        exhausted = len(cards) < WB_CARDS_LIMIT
+        if not exhausted:
+            cursor = {
+                'limit': WB_CARDS_LIMIT,
+                'updatedAt': result['cursor']['updatedAt'],
+                'nmID': result['cursor']['nmID']
+            }
 
-    warehouseId = integration.settings.get('warehouse_id', '')
-    url = 'https://marketplace-api.wildberries.ru/api/v3/stocks/{warehouseId}'.format(warehouseId=warehouseId)
+    ProductIntegration.objects.bulk_update(resolved, ['meta'])
+    if exhausted:  # all cards are seen
+        for product_integration in missing.values():
+            disable_product_integration(product_integration, 'не найден штрих-код')
+    return True
 
-    stocks = []
-    notified_products = []
 
-    for product in products:
-        if product.gtin not in chrtIDs:
-            continue
-        if zero_out:
-            amount = 0
-        else:
-            amount = max(0, min(20, int(product.get_stock(integration=integration))))
-        stocks.append({
-            'chrtId': chrtIDs[product.gtin],
-            'amount': amount
-        })
-        notified_products.append(product)
-
-    if len(stocks) == 0:
+@shared_task(bind=True, autoretry_for=(OSError, django.db.Error, json.decoder.JSONDecodeError), retry_backoff=300, retry_jitter=False)
+def notify_product_stocks(self, products, account, zero_out=False):
+    integration = Integration.objects.get(utm_source=account)
+
+    products = ProductAvailability.objects.annotate_products(Product.objects.filter(pk__in=products), integration=integration).in_bulk()
+    product_integrations = list(ProductIntegration.objects.order_by().filter(product_id__in=products.keys(), integration=integration))
+    for product_integration in product_integrations:
+        product_integration.product = products[product_integration.product_id]
+        product_integration.integration = integration
+
+    if not resolve_chrt_ids(integration, product_integrations):
+        return False
+    product_integrations = [product_integration for product_integration in product_integrations
+                            if product_integration.pk is not None and product_integration.meta
+                            and product_integration.meta.get('chrtID', None) is not None]
+    if len(product_integrations) == 0:
         return False
 
-    data = {'stocks': stocks}
-    data_encoded = json.dumps(data).encode('utf-8')
-    request = Request(url, data_encoded, headers, method='PUT')
-    logger.info('<<< ' + request.full_url)
-    logger.info(data_encoded)
-    try:
-        response = urlopen(request)
-        for product in notified_products:
-            product_integration = product_integrations[product.pk]
-            product_integration.notify_stock = False
-            product_integration.save()
-        return True
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
-        logger.error(error)
-        if isinstance(error, list):
-            first_error = error[0]
-            if 'data' in first_error:
-                for item in first_error['data']:
-                    if item.get('code') == 'NotFound' and 'sku' in item:
-                        sku = item.get('sku')
-                        ProductIntegration.objects.filter(product__gtin=sku, integration=integration).delete()
-                        # {'data': [{'sku': '374318830018', 'chrtId': 0, 'amount': 4}], 'code': 'NotFound', 'message': 'Not found'}
-                        for phone in SITE_WB.profile.manager_phones.split(','):
-                            send_message.s(phone, 'У товара с штрих-кодом {} отключена интеграция WB'.format(sku)).apply_async(priority=PRIORITY_IDLE)
-            return True
-        else:
+    warehouseId = integration.settings.get('warehouse_id', '')
+    url = '/api/v3/stocks/{warehouseId}'.format(warehouseId=warehouseId)
+    client = get_client(integration, rate=WB_MARKETPLACE_RATE)
+
+    notified = []
+    for chunk in batched(product_integrations, WB_STOCKS_BATCH_SIZE):
+        # whole chunk is rejected if it contains unknown barcodes, the rest of it is sent once again
+        for attempt in range(2):
+            stocks = [{
+                'chrtId': product_integration.meta.get('chrtID'),
+                'amount': 0 if zero_out else max(0, min(20, int(product_integration.product.available)))
+            } for product_integration in chunk]
+
+            data = {'stocks': stocks}
             try:
-                message = error.get('detail', 'Неизвестная ошибка взаимодействия с Wildberries!')
-            except:  # noqa E722
-                message = error
-            raise TaskFailure(message) from e
+                client.put(url, data)
+                for product_integration in chunk:
+                    product_integration.notify_stock = False
+                    notified.append(product_integration)
+                break
+            except ResponseError as e:
+                try:
+                    error = e.json()
+                except ValueError:
+                    error = None
+                logger.error(error if error is not None else e)
+                if isinstance(error, list):
+                    skus, chrt_ids = set(), set()
+                    first_error = error[0]
+                    if 'data' in first_error:
+                        for item in first_error['data']:
+                            if item.get('code') == 'NotFound' and 'sku' in item:
+                                sku = item.get('sku')
+                                skus.add(str(sku))
+                                if item.get('chrtId'):
+                                    chrt_ids.add(item['chrtId'])
+                                ProductIntegration.objects.filter(product__gtin=sku, integration=integration).delete()
+                                # {'data': [{'sku': '374318830018', 'chrtId': 0, 'amount': 4}], 'code': 'NotFound', 'message': 'Not found'}
+                                for phone in SITE_WB.profile.manager_phones.split(','):
+                                    send_message.s(phone, 'У товара с штрих-кодом {} отключена интеграция WB'.format(sku)).apply_async(priority=PRIORITY_IDLE)
+                    rest = [product_integration for product_integration in chunk if product_integration.product.gtin not in skus
+                            and product_integration.meta.get('chrtID') not in chrt_ids]
+                    if attempt or not rest or len(rest) == len(chunk):
+                        break
+                    chunk = rest
+                else:
+                    ProductIntegration.objects.bulk_update(notified, ['notify_stock'])
+                    message = e.message('Неизвестная ошибка взаимодействия с Wildberries!', 'detail')
+                    raise TaskFailure(message) from e
+
+    ProductIntegration.objects.bulk_update(notified, ['notify_stock'])
+    return len(notified)
 
 
 @shared_task(bind=True, autoretry_for=(OSError, django.db.Error, json.decoder.JSONDecodeError), retry_backoff=300, retry_jitter=False)
@@ -460,11 +422,8 @@ def notify_marked_stocks(self):
 
         products = ProductIntegration.objects.order_by().filter(integration=integration, notify_stock=True)
         products = list(products.values_list('product_id', flat=True).distinct())
-        if products:
-            countdown = 0
-            for chunk in batched(products, 20):
-                notify_product_stocks.s(chunk, integration.utm_source).apply_async(countdown=countdown, priority=PRIORITY_IDLE)
-                countdown += 20
+        for chunk in batched(products, WB_STOCKS_BATCH_SIZE):
+            notify_product_stocks.s(chunk, integration.utm_source).apply_async(priority=PRIORITY_IDLE)
         total += len(products)
     return total
 
@@ -479,18 +438,12 @@ def notify_integration_stocks(self):
         products = Product.objects.order_by().filter(integration=integration).exclude(gtin__exact='')
 
         if integration.output_available:
-            products = products.annotate(
-                quantity=Sum('stock_item__quantity', filter=Q(stock_item__supplier__integration=integration)),
-                correction=Sum('stock_item__correction', filter=Q(stock_item__supplier__integration=integration)),
-                available=F('quantity') + F('correction')
-            ).filter(available__gt=0)
+            products = ProductAvailability.objects.annotate_products(products, integration=integration).filter(available__gt=0)
 
         products = list(products.values_list('id', flat=True).distinct())
 
-        countdown = 0
-        for chunk in batched(products, 20):
-            notify_product_stocks.s(chunk, integration.utm_source).apply_async(countdown=countdown, priority=PRIORITY_IDLE)
-            countdown += 60
+        for chunk in batched(products, WB_STOCKS_BATCH_SIZE):
+            notify_product_stocks.s(chunk, integration.utm_source).apply_async(priority=PRIORITY_IDLE)
 
         total += len(products)
 
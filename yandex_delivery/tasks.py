@@ -1,11 +1,11 @@
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError
 import json
 
 import django.db
 from celery import shared_task
 from djconfig import config, reload_maybe
 
+from sewingworld.integration_client import IntegrationClient, ResponseError
+
 from shop.models import Order
 
 
@@ -13,6 +13,14 @@ class TaskFailure(Exception):
     pass
 
 
+def get_client():
+    headers = {
+        'Authorization': 'OAuth {oauth_token}'.format(oauth_token=config.sw_yd_token),
+        'Content-Type': 'application/json; charset=utf-8'
+    }
+    return IntegrationClient('yandex_delivery', base_url='https://api.delivery.yandex.ru', headers=headers)
+
+
 def create_delivery_draft_order(order_id, warehouse, first_name, middle_name, last_name):
     order = Order.objects.get(id=order_id)
 
@@ -81,21 +89,13 @@ def create_delivery_draft_order(order_id, warehouse, first_name, middle_name, la
 
     import sys
     print(json.dumps(data), file=sys.stderr)
-    data_encoded = json.dumps(data).encode('utf-8')
-    url = 'https://api.delivery.yandex.ru/orders'
-    headers = {
-        'Authorization': 'OAuth {oauth_token}'.format(oauth_token=config.sw_yd_token),
-        'Content-Type': 'application/json; charset=utf-8'
-    }
-    request = Request(url, data_encoded, headers, method='POST')
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client().post('/orders', data)
+        result = response.json()
         print(result, file=sys.stderr)
         return result
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
+    except ResponseError as e:
+        error = e.json()
         message = '{}: {}'.format(error.get('type', 'UNKNOWN'), error.get('message', 'Неизвестная ошибка взаимодействия с Яндекс.Доставка'))
         print(message, file=sys.stderr)
         raise RuntimeError(message) from e
@@ -106,7 +106,7 @@ def create_delivery_draft_order_task(self, order_id, warehouse, first_name, midd
     try:
         reload_maybe()
         return create_delivery_draft_order(order_id, warehouse, first_name, middle_name, last_name)
-    except HTTPError as e:
+    except ResponseError as e:
         raise self.retry(countdown=60 * 10, max_retries=12, exc=e)  # 10 minutes
 
 
@@ -136,21 +136,13 @@ def get_delivery_options(total, paid, warehouse, city, weight, width, height, le
 
     import sys
     print(json.dumps(data), file=sys.stderr)
-    data_encoded = json.dumps(data).encode('utf-8')
-    url = 'https://api.delivery.yandex.ru/delivery-options'
-    headers = {
-        'Authorization': 'OAuth {oauth_token}'.format(oauth_token=config.sw_yd_token),
-        'Content-Type': 'application/json; charset=utf-8'
-    }
-    request = Request(url, data_encoded, headers, method='PUT')
     try:
-        response = urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
+        response = get_client().put('/delivery-options', data)
+        result = response.json()
         print(result, file=sys.stderr)
         return result
-    except HTTPError as e:
-        content = e.read()
-        error = json.loads(content.decode('utf-8'))
+    except ResponseError as e:
+        error = e.json()
         print(error, file=sys.stderr)
         message = '{}: {}'.format(error.get('type', 'UNKNOWN'), error.get('message', 'Неизвестная ошибка взаимодействия с Яндекс.Доставка'))
         print(message, file=sys.stderr)